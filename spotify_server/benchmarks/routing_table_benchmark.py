@@ -0,0 +1,108 @@
+"""
+Compares the bucket based FingerTable with the ArrayRoutingTable, with and
+without NumPy, on tables of 10k and 100k contacts: building the table, the k
+closest nodes to random keys and listing every node.
+
+Buckets are left unbounded so every table holds all the contacts.
+
+Run from the spotify_server directory with:
+    python -m benchmarks.routing_table_benchmark
+"""
+
+import random
+import time
+
+from spotify.distributed_layer import array_routing_table
+from spotify.distributed_layer.array_routing_table import ArrayRoutingTable
+from spotify.distributed_layer.finger_table import FingerTable
+from spotify.distributed_layer.remote_node import RemoteNode
+from spotify.distributed_layer.utils import sha1_hash
+
+SIZES = (10_000, 100_000)
+K = 20
+KEYS = 200
+
+
+class _Owner:
+    def __init__(self):
+        self.ip: str = "10.255.255.254"
+        self.id: int = sha1_hash(self.ip)
+
+
+def _contacts(size: int) -> list[RemoteNode]:
+    ips = [f"10.{i >> 16}.{(i >> 8) & 255}.{i & 255}" for i in range(size)]
+    return [RemoteNode(ip, sha1_hash(ip)) for ip in ips]
+
+
+def _finger_table(owner: _Owner, size: int) -> FingerTable:
+    table = FingerTable(owner)
+    for bucket in table.buckets:
+        bucket.k = size
+    return table
+
+
+def _per_second(function, seconds: float = 1.0) -> float:
+    calls: int = 0
+    started: float = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        function()
+        calls += 1
+    return calls / (time.perf_counter() - started)
+
+
+def _measure(make_table, contacts: list[RemoteNode], keys: list[int]) -> list[float]:
+    started: float = time.perf_counter()
+    table = make_table()
+    for node in contacts:
+        table.add_node(node)
+    build: float = time.perf_counter() - started
+    assert len(table.get_all_nodes()) == len(contacts)
+
+    key_iter = iter(keys * 1000)
+    lookups: float = _per_second(lambda: table.get_k_closets_nodes(next(key_iter), K))
+    listings: float = _per_second(table.get_all_nodes)
+    return [build * 1000, lookups, listings]
+
+
+def run() -> None:
+    owner = _Owner()
+    rng = random.Random(0)
+    keys: list[int] = [rng.getrandbits(160) for _ in range(KEYS)]
+    numpy = array_routing_table.np
+    tables = [("FingerTable", lambda size: _finger_table(owner, size), numpy)]
+    if numpy is not None:
+        tables.append(
+            (
+                "ArrayRoutingTable (numpy)",
+                lambda size: ArrayRoutingTable(owner, None),
+                numpy,
+            )
+        )
+    tables.append(
+        (
+            "ArrayRoutingTable (python)",
+            lambda size: ArrayRoutingTable(owner, None),
+            None,
+        )
+    )
+    print(
+        f"{'table':30} {'contacts':>9} {'build ms':>9} "
+        f"{'k-closest/s':>12} {'all nodes/s':>12}"
+    )
+    for size in SIZES:
+        contacts: list[RemoteNode] = _contacts(size)
+        for name, make_table, np in tables:
+            array_routing_table.np = np
+            try:
+                build, lookups, listings = _measure(
+                    lambda: make_table(size), contacts, keys
+                )
+            finally:
+                array_routing_table.np = numpy
+            print(
+                f"{name:30} {size:>9} {build:>9.0f} {lookups:>12.0f} {listings:>12.0f}"
+            )
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,73 @@
+"""
+Compares the JSON and binary codecs of the RPC layer on GET_NEARS_NODE and
+GET_ALL_KEYS payloads.
+
+Run from the spotify_server directory with:
+    python -m benchmarks.rpc_codec_benchmark
+"""
+
+import random
+import timeit
+
+from spotify.distributed_layer.rpc_message import (
+    BINARY_CODEC,
+    JSON_CODEC,
+    Codec,
+    RpcRequest,
+    RpcResponse,
+)
+from spotify.distributed_layer.utils import sha1_hash
+
+GENRES = ["rock", "pop", "jazz", "salsa", "reggaeton", "unknown"]
+
+
+def _nears_node_payloads(k: int) -> tuple[RpcRequest, RpcResponse]:
+    request = RpcRequest(sha1_hash("10.0.11.2"), "get_nears_node", [sha1_hash("key")])
+    nodes = [{"id": sha1_hash(f"10.0.11.{i}"), "ip": f"10.0.11.{i}"} for i in range(k)]
+    return request, RpcResponse(nodes)
+
+
+def _all_keys_payloads(songs: int) -> tuple[RpcRequest, RpcResponse]:
+    rng = random.Random(0)
+    request = RpcRequest(sha1_hash("10.0.11.2"), "get_all_keys", [])
+    metadata = [
+        {
+            "title": f"Song {i}",
+            "artist": f"Artist {rng.randint(0, songs // 10)}",
+            "size": rng.randint(2_000_000, 12_000_000),
+            "duration": rng.uniform(120, 420),
+            "album": f"Album {rng.randint(0, songs // 5)}",
+            "genre": rng.choice(GENRES),
+            "image": f"10.0.11.2/media/song_images/Song {i}img.jpg",
+        }
+        for i in range(songs)
+    ]
+    return request, RpcResponse(metadata)
+
+
+def _measure(codec: Codec, message, number: int) -> tuple[int, float, float]:
+    encoded = message.encode(codec)
+    decode = type(message).decode
+    encode_time = timeit.timeit(lambda: message.encode(codec), number=number)
+    decode_time = timeit.timeit(lambda: decode(encoded, codec), number=number)
+    return len(encoded), number / encode_time, number / decode_time
+
+
+def run(number: int = 2000) -> None:
+    cases = [
+        ("GET_NEARS_NODE request", _nears_node_payloads(20)[0], number),
+        ("GET_NEARS_NODE response (k=20)", _nears_node_payloads(20)[1], number),
+        ("GET_ALL_KEYS request", _all_keys_payloads(0)[0], number),
+        ("GET_ALL_KEYS response (1000)", _all_keys_payloads(1000)[1], number // 100),
+    ]
+    print(f"{'payload':34} {'codec':7} {'bytes':>9} {'enc/s':>10} {'dec/s':>10}")
+    for name, message, n in cases:
+        for codec in (JSON_CODEC, BINARY_CODEC):
+            size, encodes, decodes = _measure(codec, message, max(n, 1))
+            print(
+                f"{name:34} {codec.name:7} {size:>9} {encodes:>10.0f} {decodes:>10.0f}"
+            )
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,103 @@
+"""
+Measures the negotiated zlib compression of the RPC layer on GET_ALL_KEYS and
+GET_KEYS_BY_QUERY responses of a synthetic 50k song catalog: bytes on the
+wire and the end-to-end time to encode, send, receive and decode them.
+
+The transfer runs over a local socket pair, which is far faster than any real
+link, so the time the same bytes would take on slower links is also shown.
+
+Run from the spotify_server directory with:
+    python -m benchmarks.rpc_compression_benchmark
+"""
+
+import socket
+import threading
+import time
+
+from spotify.distributed_layer.rpc_message import (
+    BINARY_CODEC,
+    JSON_CODEC,
+    Codec,
+    MessageType,
+    RpcResponse,
+    encode_message,
+    read_frame,
+    response_from_frame,
+    write_frame,
+)
+
+from .rpc_codec_benchmark import _all_keys_payloads
+
+CATALOG_SIZE = 50_000
+QUERY_RESULTS = 500
+# Link speeds in bytes per second
+LINKS: dict[str, float] = {"100Mbit": 100e6 / 8, "1Gbit": 1e9 / 8}
+
+
+def _round_trip(
+    message: RpcResponse, codec: Codec, compress: bool, level: int
+) -> tuple[int, float, float]:
+    """Wire bytes, CPU seconds spent encoding and decoding and total seconds"""
+    sender, receiver = socket.socketpair()
+    received: list = []
+
+    def _receive():
+        frame = read_frame(receiver)
+        started = time.perf_counter()
+        received.append((response_from_frame(frame), time.perf_counter() - started))
+
+    reader = threading.Thread(target=_receive)
+    reader.start()
+    started = time.perf_counter()
+    body, flags = encode_message(message, codec, compress, level)
+    encoded = time.perf_counter() - started
+    write_frame(sender, MessageType.RESPONSE, 1, body, flags)
+    reader.join()
+    total = time.perf_counter() - started
+    sender.close()
+    receiver.close()
+
+    response, decoded = received[0]
+    assert len(response.result) == len(message.result)
+    return len(body), encoded + decoded, total
+
+
+def run(repeat: int = 3) -> None:
+    catalog: RpcResponse = _all_keys_payloads(CATALOG_SIZE)[1]
+    cases = [
+        (f"GET_ALL_KEYS ({CATALOG_SIZE})", catalog),
+        (
+            f"GET_KEYS_BY_QUERY ({QUERY_RESULTS})",
+            RpcResponse(catalog.result[:QUERY_RESULTS]),
+        ),
+    ]
+    modes = [("off", False, 0), ("zlib-1", True, 1), ("zlib-6", True, 6)]
+    links = "".join(f" {name + ' ms':>12}" for name in LINKS)
+    print(
+        f"{'payload':26} {'codec':7} {'mode':7} {'bytes':>10} {'ratio':>6} "
+        f"{'cpu ms':>8} {'local ms':>9}{links}"
+    )
+    for name, message in cases:
+        for codec in (JSON_CODEC, BINARY_CODEC):
+            plain: int | None = None
+            for mode, compress, level in modes:
+                # Best of a few runs, the first one also warms up the codecs
+                size, cpu, total = min(
+                    (
+                        _round_trip(message, codec, compress, level)
+                        for _ in range(repeat)
+                    ),
+                    key=lambda result: result[2],
+                )
+                plain = plain or size
+                on_links = "".join(
+                    f" {(cpu + size / speed) * 1000:>12.1f}" for speed in LINKS.values()
+                )
+                print(
+                    f"{name:26} {codec.name:7} {mode:7} {size:>10} {plain / size:>6.1f} "
+                    f"{cpu * 1000:>8.1f} {total * 1000:>9.1f}{on_links}"
+                )
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,97 @@
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from enum import Enum
+
+from .remote_node import RemoteFunctions
+
+from ..logs import write_log
+
+
+class RequestClass(Enum):
+    CONTROL = "control"
+    LOOKUP = "lookup"
+    QUERY = "query"
+    BULK = "bulk"
+
+
+REQUEST_CLASSES: dict[str, RequestClass] = {
+    RemoteFunctions.PING.value: RequestClass.CONTROL,
+    RemoteFunctions.GET_NEARS_NODE.value: RequestClass.LOOKUP,
+    RemoteFunctions.GET_ALL_NODES.value: RequestClass.LOOKUP,
+    RemoteFunctions.CONSTAINS_KEY.value: RequestClass.LOOKUP,
+    RemoteFunctions.GET_KEYS_BY_QUERY.value: RequestClass.QUERY,
+    RemoteFunctions.GET_ALL_KEYS.value: RequestClass.QUERY,
+    RemoteFunctions.BATCH.value: RequestClass.QUERY,
+    RemoteFunctions.SAVE_KEY.value: RequestClass.BULK,
+}
+
+# Workers and extra queued requests of every class. Each class has its own
+# workers, so song uploads and catalog crawls can not starve pings and lookups
+CLASS_BUDGETS: dict[RequestClass, tuple[int, int]] = {
+    RequestClass.CONTROL: (2, 256),
+    RequestClass.LOOKUP: (6, 256),
+    RequestClass.QUERY: (4, 32),
+    RequestClass.BULK: (4, 0),
+}
+
+
+def request_class(function: str) -> RequestClass:
+    # Unknown functions are answered right away, so they are cheap
+    return REQUEST_CLASSES.get(function, RequestClass.CONTROL)
+
+
+class AdmissionControl:
+    """
+    Bounds the requests of every class the server holds at once, running or
+    queued. Over the bound a request is rejected at once with a busy answer
+    instead of waiting behind the others.
+    """
+
+    def __init__(self, budgets: dict[RequestClass, tuple[int, int]] = CLASS_BUDGETS):
+        self.executors: dict[RequestClass, ThreadPoolExecutor] = {
+            cls: ThreadPoolExecutor(workers, thread_name_prefix=f"rpc-{cls.value}")
+            for cls, (workers, _) in budgets.items()
+        }
+        self.capacity: dict[RequestClass, int] = {
+            cls: workers + queued for cls, (workers, queued) in budgets.items()
+        }
+        self.in_flight: dict[RequestClass, int] = {cls: 0 for cls in budgets}
+        self.rejected: dict[RequestClass, int] = {cls: 0 for cls in budgets}
+        self._lock = threading.Lock()
+
+    def try_admit(self, cls: RequestClass) -> bool:
+        with self._lock:
+            if self.in_flight[cls] >= self.capacity[cls]:
+                self.rejected[cls] += 1
+                write_log(f"Rejecting {cls.value} request, server is busy", 3)
+                return False
+            self.in_flight[cls] += 1
+            return True
+
+    def release(self, cls: RequestClass) -> None:
+        with self._lock:
+            self.in_flight[cls] -= 1
+
+    def submit(self, cls: RequestClass, function, *args) -> Future:
+        """
+        Runs an admitted request on the workers of its class. The slot is
+        released once a worker is done with it, even if whoever waits for the
+        result gave up before.
+        """
+        try:
+            future: Future = self.executors[cls].submit(function, *args)
+        except RuntimeError:
+            self.release(cls)
+            raise
+        future.add_done_callback(lambda _: self.release(cls))
+        return future
+
+    async def run(self, cls: RequestClass, function, *args):
+        """Awaits part of an admitted request, the caller releases its slot"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executors[cls], function, *args)
+
+    def shutdown(self) -> None:
+        for executor in self.executors.values():
+            executor.shutdown(wait=False)
@@ -0,0 +1,197 @@
+import threading
+import time
+from collections.abc import Callable
+from heapq import nsmallest
+
+try:
+    import numpy as np
+except ImportError:
+    # NumPy only makes the distance scans faster, plain Python works too
+    np = None
+
+from .finger_table import K_BUCKET_SIZE, active_nodes, bucket_fill, stale_buckets
+from .liveness import is_alive
+from .remote_node import RemoteNode
+
+from ..logs import write_log
+
+ID_BITS = 160
+# A 160 bit id is kept as two 64 bit words and a 32 bit one, most significant
+# first, so distances compare word by word
+WORD_SHIFTS = (96, 32, 0)
+WORD_MASKS = (2**64 - 1, 2**64 - 1, 2**32 - 1)
+
+
+def _id_words(node_id: int) -> tuple[int, int, int]:
+    return tuple(
+        (node_id >> shift) & mask for shift, mask in zip(WORD_SHIFTS, WORD_MASKS)
+    )
+
+
+class RoutingSnapshot:
+    """
+    Immutable view of the routing table, readers use it without any lock.
+
+    Snapshots share append-only buffers: a writer appends past the size of
+    the latest snapshot and publishes a new one, so older snapshots never see
+    the change. Only growing the buffers and removing a node copy them.
+    """
+
+    def __init__(self, nodes: list[RemoteNode], ids=None, size: int = 0):
+        self._nodes: list[RemoteNode] = nodes
+        # (capacity, 3) uint64 array of the id words, None without NumPy
+        self._ids = ids
+        self.size: int = size
+
+    def __len__(self) -> int:
+        return self.size
+
+    @property
+    def nodes(self) -> list[RemoteNode]:
+        return self._nodes[: self.size]
+
+    def with_node(self, node: RemoteNode) -> "RoutingSnapshot":
+        """Only for writers, on the latest snapshot"""
+        nodes: list[RemoteNode] = self._nodes
+        ids = self._ids
+        if len(nodes) > self.size:
+            # Not the latest snapshot, its buffers are copied before appending
+            nodes = nodes[: self.size]
+            ids = ids[: self.size].copy() if ids is not None else None
+        nodes.append(node)
+        if np is not None:
+            if ids is None or len(ids) == self.size:
+                grown = np.empty((max(16, 2 * self.size), 3), dtype=np.uint64)
+                if ids is not None:
+                    grown[: self.size] = ids[: self.size]
+                elif self.size:
+                    grown[: self.size] = [_id_words(n.id) for n in nodes[: self.size]]
+                ids = grown
+            ids[self.size] = _id_words(node.id)
+        return RoutingSnapshot(nodes, ids, self.size + 1)
+
+    def without(self, index: int) -> "RoutingSnapshot":
+        nodes: list[RemoteNode] = self.nodes
+        del nodes[index]
+        ids = None
+        if self._ids is not None:
+            ids = np.delete(self._ids[: self.size], index, axis=0)
+        return RoutingSnapshot(nodes, ids, self.size - 1)
+
+    def closest(self, key: int, m: int) -> list[RemoteNode]:
+        """The m nodes closest to key, closest first"""
+        if m <= 0 or not self.size:
+            return []
+        if self._ids is None:
+            return nsmallest(m, self.nodes, key=lambda n: n.id ^ key)
+
+        distances = self._ids[: self.size] ^ np.array(_id_words(key), dtype=np.uint64)
+        high = distances[:, 0]
+        if m < len(high):
+            # Partial sort on the high word, only the ties at the m-th
+            # distance need the lower words to be ordered
+            kth = np.partition(high, m - 1)[m - 1]
+            candidates = np.flatnonzero(high <= kth)
+        else:
+            candidates = np.arange(len(high))
+        near = distances[candidates]
+        order = candidates[np.lexsort((near[:, 2], near[:, 1], near[:, 0]))]
+        return [self._nodes[i] for i in order[:m]]
+
+
+class ArrayRoutingTable:
+    """
+    Routing table keeping every contact in one contiguous id array instead of
+    160 buckets of sets. The k closest are found with a vectorized XOR and a
+    partial sort. It has the interface of FingerTable.
+
+    Buckets are still bounded, but a newcomer to a full bucket only replaces
+    a node the liveness state reports down.
+    """
+
+    def __init__(
+        self,
+        node,
+        bucket_size: int | None = K_BUCKET_SIZE,
+        on_change: Callable[[RemoteNode], None] | None = None,
+    ):
+        self.node = node
+        self.bucket_size: int | None = bucket_size
+        # Called with every node that enters or leaves the table
+        self.on_change = on_change
+        self._snapshot: RoutingSnapshot = RoutingSnapshot([])
+        # Only writers touch these, under the lock
+        self._members: set[RemoteNode] = set()
+        # The members of every bucket, so a full one is searched on its own
+        self._buckets: list[set[RemoteNode]] = [set() for _ in range(ID_BITS)]
+        # When a lookup last went through the range of each bucket
+        self._touched: list[float] = [0] * ID_BITS
+        self._lock = threading.Lock()
+
+    @property
+    def snapshot(self) -> RoutingSnapshot:
+        return self._snapshot
+
+    def get_all_nodes(self) -> list[RemoteNode]:
+        return self._snapshot.nodes
+
+    def get_active_nodes(self, k) -> list[RemoteNode]:
+        return active_nodes(self._snapshot.nodes, k)
+
+    def get_k_closets_nodes(self, key: int, k: int) -> list[RemoteNode]:
+        snapshot: RoutingSnapshot = self._snapshot
+        m: int = k
+        while True:
+            closest: list[RemoteNode] = snapshot.closest(key, m)
+            result: list[RemoteNode] = [n for n in closest if is_alive(n)][:k]
+            # Look further only when nodes known to be down filled the slots
+            if len(result) == k or len(closest) < m:
+                break
+            m *= 2
+        write_log(f"Returning {result}", 1)
+        return result
+
+    def touch(self, key: int) -> None:
+        distance_bit: int = self.get_bit_distance(key)
+        if distance_bit >= 0:
+            self._touched[distance_bit] = time.monotonic()
+
+    def stale_buckets(self, max_age: float) -> list[int]:
+        return stale_buckets(self._bucket_counts(), self._touched, max_age)
+
+    def bucket_fill(self) -> dict:
+        return bucket_fill(self._bucket_counts(), self.bucket_size)
+
+    def _bucket_counts(self) -> list[int]:
+        return [len(bucket) for bucket in self._buckets]
+
+    def add_node(self, remote_node: RemoteNode):
+        if remote_node in self._members or remote_node.id == self.node.id:
+            return
+        distance_bit: int = self.get_bit_distance(remote_node.id)
+        with self._lock:
+            if remote_node in self._members:
+                return
+            bucket: set[RemoteNode] = self._buckets[distance_bit]
+            snapshot: RoutingSnapshot = self._snapshot
+            removed: RemoteNode | None = None
+            if self.bucket_size is not None and len(bucket) >= self.bucket_size:
+                removed = next((n for n in bucket if not is_alive(n)), None)
+                if removed is None:
+                    return
+                write_log(f"Replacing {removed} with {remote_node}")
+                self._members.discard(removed)
+                bucket.discard(removed)
+                # Copies the snapshot anyway, finding the index costs no more
+                snapshot = snapshot.without(snapshot.nodes.index(removed))
+            self._members.add(remote_node)
+            bucket.add(remote_node)
+            self._snapshot = snapshot.with_node(remote_node)
+        if self.on_change is not None:
+            if removed is not None:
+                self.on_change(removed)
+            self.on_change(remote_node)
+
+    def get_bit_distance(self, key: int) -> int:
+        distance: int = key ^ self.node.id
+        return distance.bit_length() - 1
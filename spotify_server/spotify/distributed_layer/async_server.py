@@ -0,0 +1,216 @@
+import asyncio
+from concurrent.futures import Future
+
+from .admission import RequestClass, request_class
+from .connection_pool import DHT_PORT, SERVER_IDLE_TIMEOUT, get_server_context
+from .rpc_message import (
+    BUSY,
+    Codec,
+    Frame,
+    MessageType,
+    RpcRequest,
+    RpcResponse,
+    aread_body,
+    aread_chunks,
+    aread_frame,
+    awrite_frame,
+    encode_message,
+    get_codec,
+    request_from_frame,
+)
+from .song_receiver import IncomingTransfer
+
+from ..logs import write_log
+
+LISTEN_BACKLOG = 1024
+
+
+class AsyncRpcServer:
+    def __init__(self, network_interface):
+        self.network_interface = network_interface
+        # Handlers touch the Django ORM, which is blocking, so they run on the
+        # workers of their class while the loop keeps serving the connections
+        self.admission = network_interface.admission
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self._server: asyncio.Server | None = None
+
+    def run(self):
+        asyncio.run(self._serve())
+
+    def stop(self):
+        if self.loop and self._server:
+            self.loop.call_soon_threadsafe(self._server.close)
+
+    async def _serve(self):
+        node = self.network_interface.node
+        write_log(
+            f"starting asyncio listening in ip: {node.ip} node with id : {node.id}"
+        )
+        self.loop = asyncio.get_running_loop()
+        self._server = await asyncio.start_server(
+            self.handle_connection,
+            "0.0.0.0",
+            DHT_PORT,
+            ssl=get_server_context(),
+            backlog=LISTEN_BACKLOG,
+            reuse_address=True,
+        )
+        try:
+            async with self._server:
+                await self._server.serve_forever()
+        except asyncio.CancelledError:
+            write_log("Asyncio server stopped")
+
+    async def handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        addr = writer.get_extra_info("peername")
+        write_log(f"Handling connection from {addr}")
+        handlers: set[asyncio.Task] = set()
+        compress: bool = False
+        try:
+            while self.network_interface.listening:
+                try:
+                    frame: Frame | None = await asyncio.wait_for(
+                        aread_frame(reader), SERVER_IDLE_TIMEOUT
+                    )
+                except asyncio.TimeoutError:
+                    write_log(f"Closing idle connection from {addr}")
+                    break
+                if frame is None:
+                    break
+                if frame.message_type == MessageType.HELLO:
+                    compress, answer = self.network_interface.negotiate_hello(frame)
+                    await awrite_frame(
+                        writer, MessageType.HELLO, frame.request_id, answer
+                    )
+                    continue
+                if frame.message_type != MessageType.REQUEST:
+                    write_log(f"Unexpected frame {frame} from {addr}", 3)
+                    break
+
+                codec: Codec = get_codec(frame.flags)
+                request: RpcRequest | None = request_from_frame(frame)
+                if not request:
+                    write_log("Invalid request received")
+                    break
+
+                write_log(f"Received request {request} from {addr}")
+                cls: RequestClass = request_class(request.function)
+                if not self.admission.try_admit(cls):
+                    await awrite_frame(
+                        writer, MessageType.ERROR, request.request_id, BUSY
+                    )
+                    continue
+                if cls == RequestClass.BULK:
+                    # The song body follows on this connection, so it is read here
+                    try:
+                        response: RpcResponse | None = await self._handle_receive_song(
+                            reader, writer, addr, request, codec
+                        )
+                    finally:
+                        self.admission.release(cls)
+                    if response is None:
+                        await awrite_frame(
+                            writer, MessageType.ERROR, request.request_id, BUSY
+                        )
+                    else:
+                        await self._send_response(writer, request, response, codec)
+                    continue
+
+                # Started here, so the slot follows the worker even when the
+                # connection closes before the handler gets to run
+                work: Future = self.admission.submit(
+                    cls, self.network_interface.run_request, request, addr
+                )
+                task = asyncio.create_task(
+                    self._respond(writer, addr, request, codec, compress, work)
+                )
+                handlers.add(task)
+                task.add_done_callback(handlers.discard)
+        except Exception as e:
+            write_log(f"Error handling connection {e}", 3)
+        finally:
+            for task in handlers:
+                task.cancel()
+            writer.close()
+
+    async def _send_response(
+        self,
+        writer: asyncio.StreamWriter,
+        request: RpcRequest,
+        response: RpcResponse,
+        codec: Codec,
+        compress: bool = False,
+    ):
+        await awrite_frame(
+            writer,
+            MessageType.RESPONSE,
+            request.request_id,
+            *encode_message(response, codec, compress),
+        )
+
+    async def _respond(
+        self,
+        writer: asyncio.StreamWriter,
+        addr: tuple[str, str],
+        request: RpcRequest,
+        codec: Codec,
+        compress: bool,
+        work: Future,
+    ):
+        try:
+            response: RpcResponse | None = await asyncio.wrap_future(work)
+            if response is None:
+                return
+            write_log(f"Sending response {response} to {addr}", 4)
+            await self._send_response(writer, request, response, codec, compress)
+        except Exception as e:
+            write_log(f"Error answering {request} from {addr}: {e}", 3)
+
+    async def _handle_receive_song(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        addr: tuple[str, str],
+        request: RpcRequest,
+        codec: Codec,
+    ) -> RpcResponse | None:
+        """None when the same song is already being received"""
+        write_log(f"Received request of save song from {addr}", 1)
+        stored: RpcResponse | None = await self.admission.run(
+            RequestClass.BULK, self.network_interface.stored_song_response, request
+        )
+        if stored:
+            return stored
+        # Resuming hashes the chunks already stored, so it stays off the loop
+        transfer: IncomingTransfer | None = await asyncio.to_thread(
+            self.network_interface.incoming_transfer, request
+        )
+        if transfer is None:
+            return None
+        image, audio = transfer.image, transfer.audio
+        try:
+            await self._send_response(
+                writer, request, RpcResponse(transfer.handshake), codec
+            )
+            if transfer.chunk_size:
+                await aread_chunks(
+                    reader, request.request_id, image.feed_chunk, transfer.chunk_size
+                )
+                await aread_chunks(
+                    reader, request.request_id, audio.feed_chunk, transfer.chunk_size
+                )
+            else:
+                await aread_body(reader, request.request_id, image.feed)
+                await aread_body(reader, request.request_id, audio.feed)
+            return await self.admission.run(
+                RequestClass.BULK,
+                self.network_interface.store_received_song,
+                request,
+                addr,
+                image,
+                audio,
+            )
+        finally:
+            transfer.close()
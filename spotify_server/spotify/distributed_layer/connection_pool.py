@@ -0,0 +1,582 @@
+import asyncio
+import itertools
+import select
+import socket
+import ssl
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+from .rpc_message import (
+    JSON_CODEC,
+    Codec,
+    Frame,
+    FrameError,
+    MessageType,
+    RpcRequest,
+    RpcResponse,
+    aread_frame,
+    awrite_frame,
+    encode_message,
+    hello_offer,
+    parse_hello_answer,
+    read_frame,
+    response_from_frame,
+    write_frame,
+)
+from ..logs import write_log
+
+CERT_FILE = "./spotify/distributed_layer/cert.pem"
+KEY_FILE = "./spotify/distributed_layer/key.pem"
+DHT_PORT = 1729
+
+MAX_CONNECTIONS_PER_PEER = 4
+# Clients drop idle connections well before the server does, so a pooled
+# connection is never reused right when the server is closing it
+IDLE_TIMEOUT = 10
+SERVER_IDLE_TIMEOUT = 30
+# Seconds between two sweeps closing the idle pooled connections
+PRUNE_INTERVAL = 5
+CONNECT_TIMEOUT = 2
+MAX_IN_FLIGHT = 128
+
+_context_lock = threading.Lock()
+_client_context: ssl.SSLContext | None = None
+_server_context: ssl.SSLContext | None = None
+
+
+def get_client_context() -> ssl.SSLContext:
+    global _client_context
+    with _context_lock:
+        if _client_context is None:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            context.check_hostname = False
+            context.load_verify_locations(CERT_FILE)
+            _client_context = context
+        return _client_context
+
+
+def get_server_context() -> ssl.SSLContext:
+    global _server_context
+    with _context_lock:
+        if _server_context is None:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile=CERT_FILE, keyfile=KEY_FILE)
+            _server_context = context
+        return _server_context
+
+
+class PooledConnection:
+    def __init__(
+        self,
+        ip: str,
+        sock: ssl.SSLSocket,
+        codec: Codec = JSON_CODEC,
+        compress: bool = False,
+    ):
+        self.ip: str = ip
+        self.sock: ssl.SSLSocket = sock
+        self.codec: Codec = codec
+        # Whether both ends agreed to compress big bodies
+        self.compress: bool = compress
+        self.created_at: float = time.monotonic()
+        self.last_used: float = self.created_at
+        self.uses: int = 0
+        self._request_ids = itertools.count(1)
+
+    def next_request_id(self) -> int:
+        return next(self._request_ids) & 0xFFFFFFFF
+
+    @property
+    def reused(self) -> bool:
+        return self.uses > 1
+
+    def is_idle_expired(self, idle_timeout: float) -> bool:
+        return time.monotonic() - self.last_used > idle_timeout
+
+    def is_healthy(self) -> bool:
+        """
+        An idle connection must have nothing to read. If the socket is readable
+        either the peer closed it or a previous response was left unread.
+        """
+        try:
+            if self.sock.fileno() < 0:
+                return False
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            if not readable and not self.sock.pending():
+                return True
+            timeout = self.sock.gettimeout()
+            self.sock.setblocking(False)
+            try:
+                data = self.sock.recv(1)
+            except ssl.SSLWantReadError:
+                # Only TLS records (e.g. session tickets) were pending
+                return True
+            finally:
+                self.sock.settimeout(timeout)
+            # Either the peer closed the connection (b"") or stale bytes are left
+            write_log(f"Connection to {self.ip} is not clean, read {data!r}")
+            return False
+        except (OSError, ValueError):
+            return False
+
+    def close(self) -> None:
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+    def __str__(self) -> str:
+        return f"PooledConnection({self.ip}, codec: {self.codec.name}, compression: {self.compress}, uses: {self.uses})"
+
+
+class ConnectionPool:
+    def __init__(
+        self,
+        ip: str,
+        max_size: int = MAX_CONNECTIONS_PER_PEER,
+        idle_timeout: float = IDLE_TIMEOUT,
+    ):
+        self.ip: str = ip
+        self.max_size: int = max_size
+        self.idle_timeout: float = idle_timeout
+        self._idle: deque[PooledConnection] = deque()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+
+    def _open(
+        self, timeout: float, connect_timeout: float = CONNECT_TIMEOUT
+    ) -> PooledConnection:
+        sock = socket.create_connection((self.ip, DHT_PORT), timeout=connect_timeout)
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            ssock = get_client_context().wrap_socket(sock, server_hostname=self.ip)
+        except Exception:
+            sock.close()
+            raise
+        try:
+            ssock.settimeout(timeout)
+            codec, compress = self._negotiate_codec(ssock)
+        except Exception:
+            ssock.close()
+            raise
+        write_log(
+            f"Opened new connection to {self.ip} using {codec.name} codec, compression: {compress}"
+        )
+        return PooledConnection(self.ip, ssock, codec, compress)
+
+    def _negotiate_codec(self, ssock: ssl.SSLSocket) -> tuple[Codec, bool]:
+        write_frame(ssock, MessageType.HELLO, 0, hello_offer())
+        frame = read_frame(ssock)
+        if frame is None or frame.message_type != MessageType.HELLO:
+            raise FrameError(f"Expected HELLO from {self.ip} but got {frame}")
+        return parse_hello_answer(frame.body)
+
+    def _take_idle(self) -> PooledConnection | None:
+        with self._lock:
+            while self._idle:
+                conn = self._idle.pop()
+                if conn.is_idle_expired(self.idle_timeout) or not conn.is_healthy():
+                    write_log(f"Discarding stale connection {conn}")
+                    conn.close()
+                    continue
+                return conn
+        return None
+
+    def acquire(
+        self, timeout: float, connect_timeout: float = CONNECT_TIMEOUT
+    ) -> PooledConnection:
+        if not self._slots.acquire(timeout=timeout):
+            raise socket.timeout(f"No free connection to {self.ip}")
+        try:
+            conn = self._take_idle()
+            if conn is None:
+                conn = self._open(timeout, connect_timeout)
+            conn.sock.settimeout(timeout)
+            conn.uses += 1
+            return conn
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, conn: PooledConnection, reusable: bool = True) -> None:
+        try:
+            if reusable:
+                conn.last_used = time.monotonic()
+                with self._lock:
+                    self._idle.append(conn)
+            else:
+                conn.close()
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(
+        self,
+        timeout: float,
+        reusable: bool = True,
+        connect_timeout: float = CONNECT_TIMEOUT,
+    ):
+        conn = self.acquire(timeout, connect_timeout)
+        try:
+            yield conn
+        except BaseException:
+            self.release(conn, reusable=False)
+            raise
+        self.release(conn, reusable)
+
+    def prune(self) -> None:
+        with self._lock:
+            alive = deque()
+            for conn in self._idle:
+                if conn.is_idle_expired(self.idle_timeout):
+                    conn.close()
+                else:
+                    alive.append(conn)
+            self._idle = alive
+
+    def close(self) -> None:
+        with self._lock:
+            while self._idle:
+                self._idle.pop().close()
+
+
+async def open_async_connection(
+    ip: str, timeout: float, connect_timeout: float = CONNECT_TIMEOUT
+) -> tuple[asyncio.StreamReader, asyncio.StreamWriter, Codec, bool]:
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(
+            ip,
+            DHT_PORT,
+            ssl=get_client_context(),
+            server_hostname=ip,
+        ),
+        connect_timeout,
+    )
+    try:
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        await awrite_frame(writer, MessageType.HELLO, 0, hello_offer())
+        frame = await asyncio.wait_for(aread_frame(reader), timeout)
+        if frame is None or frame.message_type != MessageType.HELLO:
+            raise FrameError(f"Expected HELLO from {ip} but got {frame}")
+        codec, compress = parse_hello_answer(frame.body)
+    except BaseException:
+        writer.close()
+        raise
+    write_log(
+        f"Opened new async connection to {ip} using {codec.name} codec, compression: {compress}"
+    )
+    return reader, writer, codec, compress
+
+
+class MultiplexedConnection:
+    """
+    One connection per peer shared by every in-flight RPC. Each request gets
+    its own id and a reader task hands every response to whoever is waiting
+    for that id, so responses may arrive in any order.
+    """
+
+    def __init__(
+        self,
+        ip: str,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        codec: Codec,
+        compress: bool = False,
+        max_in_flight: int = MAX_IN_FLIGHT,
+    ):
+        self.ip: str = ip
+        self.reader: asyncio.StreamReader = reader
+        self.writer: asyncio.StreamWriter = writer
+        self.codec: Codec = codec
+        self.compress: bool = compress
+        self.closed: bool = False
+        self.sent: int = 0
+        self.last_used: float = time.monotonic()
+        self._pending: dict[int, asyncio.Future] = {}
+        self._request_ids = itertools.count(1)
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._reader_task = asyncio.create_task(self._read_responses())
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._pending)
+
+    def is_usable(self, idle_timeout: float) -> bool:
+        if self.closed or self.writer.is_closing():
+            return False
+        idle = time.monotonic() - self.last_used
+        return bool(self._pending) or idle <= idle_timeout
+
+    def _next_request_id(self) -> int:
+        while True:
+            request_id = next(self._request_ids) & 0xFFFFFFFF
+            if request_id and request_id not in self._pending:
+                return request_id
+
+    async def _read_responses(self):
+        error: Exception = ConnectionResetError(f"{self.ip} closed the connection")
+        try:
+            while True:
+                frame = await aread_frame(self.reader)
+                if frame is None:
+                    break
+                future = self._pending.get(frame.request_id)
+                if future is None or future.done():
+                    write_log(f"Dropping late response {frame} from {self.ip}")
+                    continue
+                future.set_result(frame)
+        except Exception as e:
+            error = e if isinstance(e, ConnectionError) else ConnectionResetError(e)
+        finally:
+            self.closed = True
+            self.writer.close()
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(error)
+
+    async def call(self, request: RpcRequest, timeout: float) -> RpcResponse | None:
+        """
+        Sends the request and waits for the response carrying its id. On
+        timeout or cancellation the call stops waiting and a late answer is
+        dropped by the reader task.
+        """
+        return await asyncio.wait_for(self._call(request), timeout)
+
+    async def _call(self, request: RpcRequest) -> RpcResponse | None:
+        async with self._slots:
+            if self.closed:
+                raise ConnectionResetError(f"Connection to {self.ip} is closed")
+            request.request_id = self._next_request_id()
+            future = asyncio.get_running_loop().create_future()
+            self._pending[request.request_id] = future
+            self.sent += 1
+            self.last_used = time.monotonic()
+            try:
+                await awrite_frame(
+                    self.writer,
+                    MessageType.REQUEST,
+                    request.request_id,
+                    *encode_message(request, self.codec, self.compress),
+                )
+                frame: Frame = await future
+            finally:
+                self._pending.pop(request.request_id, None)
+                self.last_used = time.monotonic()
+        if frame.message_type not in (MessageType.RESPONSE, MessageType.ERROR):
+            raise FrameError(f"Unexpected {frame} waiting for {request.request_id}")
+        return response_from_frame(frame)
+
+    def close(self) -> None:
+        self.closed = True
+        self._reader_task.cancel()
+        self.writer.close()
+
+    def __str__(self) -> str:
+        return f"MultiplexedConnection({self.ip}, codec: {self.codec.name}, in flight: {self.in_flight})"
+
+
+class AsyncPooledConnection:
+    def __init__(
+        self,
+        ip: str,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        codec: Codec = JSON_CODEC,
+        compress: bool = False,
+    ):
+        self.ip: str = ip
+        self.reader: asyncio.StreamReader = reader
+        self.writer: asyncio.StreamWriter = writer
+        self.codec: Codec = codec
+        self.compress: bool = compress
+        self.last_used: float = time.monotonic()
+        self.uses: int = 0
+        self._request_ids = itertools.count(1)
+
+    def next_request_id(self) -> int:
+        return next(self._request_ids) & 0xFFFFFFFF
+
+    @property
+    def reused(self) -> bool:
+        return self.uses > 1
+
+    def is_idle_expired(self, idle_timeout: float) -> bool:
+        return time.monotonic() - self.last_used > idle_timeout
+
+    def is_healthy(self) -> bool:
+        return not self.writer.is_closing() and not self.reader.at_eof()
+
+    def close(self) -> None:
+        self.writer.close()
+
+    def __str__(self) -> str:
+        return f"AsyncPooledConnection({self.ip}, codec: {self.codec.name}, uses: {self.uses})"
+
+
+class AsyncConnectionPool:
+    """
+    Same policy as ConnectionPool for coroutines, it must only be used from
+    the DHT event loop
+    """
+
+    def __init__(
+        self,
+        ip: str,
+        max_size: int = MAX_CONNECTIONS_PER_PEER,
+        idle_timeout: float = IDLE_TIMEOUT,
+    ):
+        self.ip: str = ip
+        self.max_size: int = max_size
+        self.idle_timeout: float = idle_timeout
+        self._idle: deque[AsyncPooledConnection] = deque()
+        self._slots = asyncio.Semaphore(max_size)
+
+    async def _open(
+        self, timeout: float, connect_timeout: float = CONNECT_TIMEOUT
+    ) -> AsyncPooledConnection:
+        reader, writer, codec, compress = await open_async_connection(
+            self.ip, timeout, connect_timeout
+        )
+        return AsyncPooledConnection(self.ip, reader, writer, codec, compress)
+
+    def _take_idle(self) -> AsyncPooledConnection | None:
+        while self._idle:
+            conn = self._idle.pop()
+            if conn.is_idle_expired(self.idle_timeout) or not conn.is_healthy():
+                write_log(f"Discarding stale connection {conn}")
+                conn.close()
+                continue
+            return conn
+        return None
+
+    async def acquire(
+        self, timeout: float, connect_timeout: float = CONNECT_TIMEOUT
+    ) -> AsyncPooledConnection:
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout)
+        except asyncio.TimeoutError as e:
+            raise socket.timeout(f"No free connection to {self.ip}") from e
+        try:
+            conn = self._take_idle()
+            if conn is None:
+                conn = await self._open(timeout, connect_timeout)
+            conn.uses += 1
+            return conn
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn: AsyncPooledConnection, reusable: bool = True) -> None:
+        try:
+            if reusable:
+                conn.last_used = time.monotonic()
+                self._idle.append(conn)
+            else:
+                conn.close()
+        finally:
+            self._slots.release()
+
+    @asynccontextmanager
+    async def connection(
+        self,
+        timeout: float,
+        reusable: bool = True,
+        connect_timeout: float = CONNECT_TIMEOUT,
+    ):
+        conn = await self.acquire(timeout, connect_timeout)
+        try:
+            yield conn
+        except BaseException:
+            self.release(conn, reusable=False)
+            raise
+        self.release(conn, reusable)
+
+    def prune(self) -> None:
+        alive = deque()
+        for conn in self._idle:
+            if conn.is_idle_expired(self.idle_timeout):
+                conn.close()
+            else:
+                alive.append(conn)
+        self._idle = alive
+
+    def close(self) -> None:
+        while self._idle:
+            self._idle.pop().close()
+
+
+_pools: dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(ip: str) -> ConnectionPool:
+    with _pools_lock:
+        pool = _pools.get(ip)
+        if pool is None:
+            pool = ConnectionPool(ip)
+            _pools[ip] = pool
+        return pool
+
+
+def prune_pools() -> None:
+    with _pools_lock:
+        pools: list[ConnectionPool] = list(_pools.values())
+    for pool in pools:
+        pool.prune()
+
+
+def close_all_pools() -> None:
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+
+
+_async_pools: dict[str, AsyncConnectionPool] = {}
+
+
+def get_async_pool(ip: str) -> AsyncConnectionPool:
+    pool = _async_pools.get(ip)
+    if pool is None:
+        pool = AsyncConnectionPool(ip)
+        _async_pools[ip] = pool
+    return pool
+
+
+_multiplexed: dict[str, MultiplexedConnection] = {}
+_multiplexed_locks: dict[str, asyncio.Lock] = {}
+
+
+async def get_multiplexed_connection(
+    ip: str, timeout: float, connect_timeout: float = CONNECT_TIMEOUT
+) -> MultiplexedConnection:
+    conn = _multiplexed.get(ip)
+    if conn and conn.is_usable(IDLE_TIMEOUT):
+        return conn
+    lock = _multiplexed_locks.setdefault(ip, asyncio.Lock())
+    async with lock:
+        conn = _multiplexed.get(ip)
+        if conn and conn.is_usable(IDLE_TIMEOUT):
+            return conn
+        if conn:
+            conn.close()
+        reader, writer, codec, compress = await open_async_connection(
+            ip, timeout, connect_timeout
+        )
+        conn = MultiplexedConnection(ip, reader, writer, codec, compress)
+        _multiplexed[ip] = conn
+        return conn
+
+
+async def aprune_pools() -> None:
+    """Closes the idle async connections, it must run on the DHT event loop"""
+    for pool in _async_pools.values():
+        pool.prune()
+    for ip, conn in list(_multiplexed.items()):
+        if not conn.is_usable(IDLE_TIMEOUT):
+            conn.close()
+            del _multiplexed[ip]
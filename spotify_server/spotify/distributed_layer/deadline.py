@@ -0,0 +1,30 @@
+import os
+import time
+
+# Seconds an API request may spend in the DHT unless its endpoint sets another
+DEFAULT_REQUEST_DEADLINE = float(os.getenv("DHT_REQUEST_DEADLINE", "5"))
+
+
+class Deadline:
+    """
+    Point in time by which a request must be answered. Every RPC made on its
+    behalf waits at most the time left, and carries it so the peer can drop
+    the work once nobody waits for it anymore.
+    """
+
+    def __init__(self, seconds: float = DEFAULT_REQUEST_DEADLINE):
+        self.expires_at: float = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+    def timeout(self, timeout: float) -> float:
+        """The given timeout, cut down to the time left"""
+        return min(timeout, self.remaining())
+
+    def __str__(self) -> str:
+        return f"Deadline({self.remaining():.3f}s left)"
@@ -1,6 +1,7 @@
 import socket
 
 from spotify.distributed_layer.remote_node import RemoteNode
+from .deadline import Deadline
 from .kademlia_node import KademliaNode
 from .song_dto import SongKey, SongMetadataDto, SongDto
 from ..logs import write_log
@@ -21,20 +22,24 @@ class DistributedInterface:
         return cls._instance
 
     def search_song_streamers(
-        self, song_key: SongKey
+        self, song_key: SongKey, deadline: Deadline | None = None
     ) -> tuple[list[RemoteNode], list[RemoteNode]]:
-        return self._distributed_node.search_song_streamers(song_key)
+        return self._distributed_node.search_song_streamers(song_key, deadline)
 
-    def store_song(self, song: SongDto) -> tuple[bool, list[RemoteNode]]:
-        return self._distributed_node.store_song(song)
+    def store_song(
+        self, song: SongDto, deadline: Deadline | None = None
+    ) -> tuple[bool, list[RemoteNode]]:
+        return self._distributed_node.store_song(song, deadline)
 
     def stream_song(self, song_key: SongKey, rang: tuple[int, int]):
         return self._distributed_node.stream_song(song_key, rang)
 
-    def get_all_songs(self) -> tuple[list[SongMetadataDto], list[RemoteNode]]:
-        return self._distributed_node.get_all_songs()
+    def get_all_songs(
+        self, deadline: Deadline | None = None
+    ) -> tuple[list[SongMetadataDto], list[RemoteNode]]:
+        return self._distributed_node.get_all_songs(deadline)
 
     def search_songs_by(
-        self, search_by: str, query: str
+        self, search_by: str, query: str, deadline: Deadline | None = None
     ) -> tuple[list[SongMetadataDto], list[RemoteNode]]:
-        return self._distributed_node.search_songs_by(search_by, query)
+        return self._distributed_node.search_songs_by(search_by, query, deadline)
@@ -0,0 +1,60 @@
+import asyncio
+import threading
+from collections.abc import Awaitable, Coroutine
+
+from ..logs import write_log
+
+
+class DhtEventLoop:
+    """
+    Long lived event loop running in its own thread. Every outbound async RPC
+    is driven by it, synchronous code hands coroutines over with run().
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self._run, name="dht-event-loop", daemon=True
+        )
+        self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        write_log("Starting DHT event loop")
+        self.loop.run_forever()
+
+    def run(self, coroutine: Coroutine, timeout: float | None = None):
+        if threading.current_thread() is self.thread:
+            coroutine.close()
+            raise RuntimeError("run() would block the DHT event loop from itself")
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            future.cancel()
+            raise
+
+    def submit(self, coroutine: Coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+
+_dht_loop: DhtEventLoop | None = None
+_dht_loop_lock = threading.Lock()
+
+
+def get_dht_loop() -> DhtEventLoop:
+    global _dht_loop
+    with _dht_loop_lock:
+        if _dht_loop is None:
+            _dht_loop = DhtEventLoop()
+        return _dht_loop
+
+
+async def gather_bounded(concurrency: int, *awaitables: Awaitable) -> list:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _bounded(awaitable: Awaitable):
+        async with semaphore:
+            return await awaitable
+
+    return await asyncio.gather(*(_bounded(a) for a in awaitables))
@@ -1,71 +1,163 @@
-from heapq import heappop, heappush
-from concurrent.futures import ThreadPoolExecutor
-from random import randint
+import random
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+from random import shuffle
+from .event_loop import get_dht_loop
+from .liveness import is_alive
+from .peer_health import peer_rtt
 from .remote_node import RemoteNode
 
 from ..logs import write_log
 
 K_BUCKET_SIZE = 4
+# Newcomers kept per full bucket, the most recently seen replace dead nodes
+REPLACEMENT_CACHE_SIZE = K_BUCKET_SIZE
+
+
+def random_id_in_bucket(node_id: int, index: int) -> int:
+    """A random id whose distance to node_id falls in the given bucket"""
+    return node_id ^ ((1 << index) | random.getrandbits(index))
+
+
+def stale_buckets(counts: list[int], touched: list[float], max_age: float) -> list[int]:
+    """
+    Buckets not touched by a lookup for max_age seconds, from the closest
+    one holding a node outwards. Closer buckets cover ranges with no nodes.
+    """
+    closest: int | None = next((i for i, count in enumerate(counts) if count), None)
+    if closest is None:
+        return []
+    now: float = time.monotonic()
+    return [i for i in range(closest, len(counts)) if now - touched[i] >= max_age]
+
+
+def active_nodes(nodes: list[RemoteNode], k: int) -> list[RemoteNode]:
+    """Nodes believed alive from the liveness state, no network I/O"""
+    candidates: list[RemoteNode] = [n for n in nodes if is_alive(n)]
+    # Prefer the peers that answer fastest, unmeasured ones in random order
+    shuffle(candidates)
+    candidates.sort(key=lambda n: peer_rtt(n.ip))
+    return candidates[:k]
+
+
+def bucket_fill(counts: list[int], bucket_size: int | None) -> dict:
+    return {
+        "nodes": sum(counts),
+        "buckets": sum(1 for count in counts if count),
+        "full": (
+            sum(1 for count in counts if count >= bucket_size) if bucket_size else 0
+        ),
+        "closest_bucket": next((i for i, count in enumerate(counts) if count), None),
+        "fill": {i: count for i, count in enumerate(counts) if count},
+    }
 
 
 class KBucket:
-    def __init__(self, node_id: int, k: int = K_BUCKET_SIZE) -> None:
+    """
+    Nodes of one distance range, least recently seen first. A newcomer to a
+    full bucket waits in the replacement cache while the least recently seen
+    node is pinged on the DHT loop, and takes its place if it does not answer.
+    """
+
+    def __init__(
+        self,
+        node_id: int,
+        k: int = K_BUCKET_SIZE,
+        on_change: Callable[[RemoteNode], None] | None = None,
+    ) -> None:
         self.k: int = k
         self.node_id = node_id
-        self._nodes: set[RemoteNode] = set()
-        self._failures: set[RemoteNode] = set()
+        # Called with every node that enters or leaves the bucket
+        self.on_change = on_change
+        self._nodes: OrderedDict[RemoteNode, None] = OrderedDict()
+        self._replacements: OrderedDict[RemoteNode, None] = OrderedDict()
+        self._checking: bool = False
+        # When a lookup last went through the range of the bucket
+        self.last_touched: float = 0
+        self._lock = threading.Lock()
 
     def add_node(self, node: RemoteNode) -> None:
-        if node in self._nodes:
-            write_log(f"Node {node} is already in kbucket")
+        with self._lock:
+            if node in self._nodes:
+                self._nodes.move_to_end(node)
+                return
+            if len(self._nodes) < self.k:
+                write_log(f"Adding node {node} to kbucket")
+                self._nodes[node] = None
+                self._replacements.pop(node, None)
+                oldest: RemoteNode | None = None
+            else:
+                self._replacements[node] = None
+                self._replacements.move_to_end(node)
+                if len(self._replacements) > REPLACEMENT_CACHE_SIZE:
+                    self._replacements.popitem(last=False)
+                if self._checking:
+                    return
+                self._checking = True
+                oldest = next(iter(self._nodes))
+        if oldest is None:
+            self._changed(node)
             return
-        write_log(f"Adding node {node} to kbucket")
-        if len(self._nodes) < self.k:
-            self._nodes.add(node)
-        else:
-            write_log("Kbucket is full, checking nodes")
-            with ThreadPoolExecutor(3) as executor:
-                executor.map(self.check_node, self._nodes)
-
-            if len(self._failures) > 0:
-                self._nodes.remove(self._failures.pop())
-                self._nodes.add(node)
-                self._failures.clear()
-
-    def check_node(self, node: RemoteNode) -> None:
-        aviable, _ = node.ping(self.node_id)
-        if not aviable:
-            write_log(f"Check node {node} returned False")
-            self._failures.add(node)
-        else:
-            write_log(f"Check node {node} returned True")
+        write_log(f"Kbucket is full, checking its oldest node {oldest}")
+        get_dht_loop().submit(self._check_oldest(oldest))
+
+    async def _check_oldest(self, oldest: RemoteNode) -> None:
+        try:
+            # Nodes already known to be down are not pinged again
+            alive: bool = is_alive(oldest) and (await oldest.aping(self.node_id))[0]
+        except Exception as e:
+            write_log(f"Error checking node {oldest}: {e}", 3)
+            alive = False
+        newcomer: RemoteNode | None = None
+        with self._lock:
+            self._checking = False
+            if oldest not in self._nodes:
+                return
+            if alive:
+                write_log(f"Check node {oldest} returned True")
+                self._nodes.move_to_end(oldest)
+                return
+            write_log(f"Check node {oldest} returned False")
+            del self._nodes[oldest]
+            if self._replacements:
+                newcomer, _ = self._replacements.popitem()
+                self._nodes[newcomer] = None
+        self._changed(oldest)
+        if newcomer is not None:
+            self._changed(newcomer)
+
+    def _changed(self, node: RemoteNode) -> None:
+        if self.on_change is not None:
+            self.on_change(node)
 
     @property
     def nodes(self) -> list[RemoteNode]:
-        return list(self._nodes)
+        with self._lock:
+            return list(self._nodes)
+
+    @property
+    def replacements(self) -> list[RemoteNode]:
+        with self._lock:
+            return list(self._replacements)
+
+    def __len__(self) -> int:
+        return len(self._nodes)
 
 
 class FingerTable:
-    def __init__(self, node):
+    def __init__(self, node, on_change: Callable[[RemoteNode], None] | None = None):
         self.node = node
-        self.buckets: list[KBucket] = [KBucket(self.node.id) for _ in range(160)]
+        self.buckets: list[KBucket] = [
+            KBucket(self.node.id, on_change=on_change) for _ in range(160)
+        ]
 
     def get_all_nodes(self) -> list[RemoteNode]:
         return [node for bucket in self.buckets for node in bucket.nodes]
 
     def get_active_nodes(self, k) -> list[RemoteNode]:
-        nodes: list[RemoteNode] = self.get_all_nodes()
-        for _ in range(len(nodes)):
-            n: RemoteNode = nodes[randint(0, len(nodes) - 1)]
-            if n.ping(self.node.id)[0]:
-                write_log(f"Node {n} is up")
-                nodes.append(n)
-            else:
-                write_log(f"Node {n} is down")
-            if len(nodes) >= k:
-                break
-
-        return nodes
+        return active_nodes(self.get_all_nodes(), k)
 
     def get_k_closets_nodes(self, key: int, k: int) -> list[RemoteNode]:
         closest_nodes: list[RemoteNode] = []
@@ -73,7 +165,7 @@ class FingerTable:
         write_log(f"The distance bit between self and {key} is {distance_bit}", 1)
 
         for remote_node in self.buckets[distance_bit].nodes:
-            heappush(closest_nodes, (-(remote_node.id ^ key), remote_node))
+            closest_nodes.append(remote_node)
 
         next_k_bucket: int = distance_bit + 1
         previous_k_bucket: int = distance_bit - 1
@@ -82,30 +174,42 @@ class FingerTable:
             still_searching = False
             if next_k_bucket < len(self.buckets):
                 for remote_node in self.buckets[next_k_bucket].nodes:
-                    heappush(closest_nodes, (-(remote_node.id ^ key), remote_node))
+                    closest_nodes.append(remote_node)
 
                 next_k_bucket += 1
                 still_searching = True
 
             if previous_k_bucket > 0:
                 for remote_node in self.buckets[previous_k_bucket].nodes:
-                    heappush(closest_nodes, (-(remote_node.id ^ key), remote_node))
+                    closest_nodes.append(remote_node)
 
                 previous_k_bucket -= 1
                 still_searching = True
 
-        result = []
-        write_log("Verifying closest nodes", 1)
-        while closest_nodes and len(result) < k:
-            current: RemoteNode = heappop(closest_nodes)[1]
-            write_log(f"Checking node {current}", 1)
-
-            if current.ping(self.node.id)[0]:
-                result.append(current)
-
+        # Liveness comes from the background tracker, nodes that died since
+        # are dropped by the lookup when they fail to answer
+        result: list[RemoteNode] = sorted(
+            (n for n in closest_nodes if is_alive(n)),
+            key=lambda node: node.id ^ key,
+        )[:k]
         write_log(f"Returning {result}", 1)
         return result
 
+    def touch(self, key: int) -> None:
+        distance_bit: int = self.get_bit_distance(key)
+        if distance_bit >= 0:
+            self.buckets[distance_bit].last_touched = time.monotonic()
+
+    def stale_buckets(self, max_age: float) -> list[int]:
+        return stale_buckets(
+            [len(bucket) for bucket in self.buckets],
+            [bucket.last_touched for bucket in self.buckets],
+            max_age,
+        )
+
+    def bucket_fill(self) -> dict:
+        return bucket_fill([len(bucket) for bucket in self.buckets], K_BUCKET_SIZE)
+
     def add_node(self, remote_node: RemoteNode):
         distance_bit: int = self.get_bit_distance(remote_node.id)
         write_log(
@@ -0,0 +1,106 @@
+import asyncio
+import os
+import threading
+from collections.abc import Awaitable, Callable
+from typing import TypeVar
+
+from .peer_health import get_peer_health
+from .remote_node import RemoteNode
+
+from ..logs import write_log
+
+# Hedging is opt-in, it trades some extra load for shorter tail latencies
+HEDGED_READS = os.getenv("DHT_HEDGED_READS", "0") == "1"
+HEDGE_PERCENTILE = 0.95
+# Used as hedge delay until the peer has enough latency samples
+HEDGE_DEFAULT_DELAY = 0.25
+# Hedges may add at most this fraction of extra reads, plus a small burst
+HEDGE_MAX_EXTRA_LOAD = 0.1
+HEDGE_BURST = 5
+
+T = TypeVar("T")
+
+
+class HedgeStats:
+    def __init__(self):
+        self.reads: int = 0
+        self.fired: int = 0
+        self.won: int = 0
+        self._lock = threading.Lock()
+
+    def count_read(self) -> None:
+        with self._lock:
+            self.reads += 1
+
+    def can_fire(self) -> bool:
+        with self._lock:
+            return self.fired < self.reads * HEDGE_MAX_EXTRA_LOAD + HEDGE_BURST
+
+    def count_fire(self) -> None:
+        with self._lock:
+            self.fired += 1
+
+    def count_win(self) -> None:
+        with self._lock:
+            self.won += 1
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {"reads": self.reads, "fired": self.fired, "won": self.won}
+
+
+_stats = HedgeStats()
+
+
+def get_hedge_stats() -> HedgeStats:
+    return _stats
+
+
+async def hedged_read(
+    function: str,
+    primary: RemoteNode,
+    next_candidate: Callable[[], RemoteNode | None],
+    call: Callable[[RemoteNode], Awaitable[T]],
+) -> tuple[RemoteNode, T]:
+    """
+    Runs call on primary, and if it has not answered by the peer's p95
+    latency runs it on the next candidate too. The first useful answer wins
+    and the other call is cancelled. Returns who answered and the answer.
+    """
+    _stats.count_read()
+    delay: float | None = get_peer_health(primary.ip).latency_percentile(
+        function, HEDGE_PERCENTILE
+    )
+    tasks: dict[asyncio.Task, RemoteNode] = {
+        asyncio.create_task(call(primary)): primary
+    }
+    try:
+        done, _ = await asyncio.wait(
+            tasks, timeout=delay if delay is not None else HEDGE_DEFAULT_DELAY
+        )
+        if not done and _stats.can_fire():
+            backup: RemoteNode | None = next_candidate()
+            if backup:
+                _stats.count_fire()
+                write_log(f"Hedging {function} to {primary} with {backup}", 1)
+                tasks[asyncio.create_task(call(backup))] = backup
+
+        pending: set[asyncio.Task] = set(tasks)
+        while True:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            answers: list[tuple[RemoteNode, T]] = [
+                (tasks[task], task.result()) for task in done
+            ]
+            for node, result in answers:
+                if result:
+                    if node is not primary:
+                        _stats.count_win()
+                    return node, result
+            # An empty answer is only taken when nothing better can come
+            if not pending:
+                return answers[0]
+    finally:
+        for task in tasks:
+            task.cancel()
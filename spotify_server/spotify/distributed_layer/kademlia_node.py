@@ -1,60 +1,85 @@
+import asyncio
+import os
 import threading
 import time
-from concurrent.futures import ThreadPoolExecutor
-from heapq import heappush, heappop
+from heapq import nsmallest
 
 from spotify.models import Song
 
 
-from .remote_node import RemoteNode
+from .array_routing_table import ArrayRoutingTable
+from .deadline import Deadline
+from .hedging import HEDGED_READS, get_hedge_stats, hedged_read
+from .liveness import LIVENESS_PROBE_INTERVAL, aprobe
+from .lookup_cache import LookupCache
+from .lookup_stats import get_lookup_stats
+from .peer_health import peer_rtt
+from .remote_node import RemoteFunctions, RemoteNode
+from .routing_checkpoint import CHECKPOINT_INTERVAL, RoutingCheckpoint
 from .utils import sha1_hash
+from .event_loop import DhtEventLoop, gather_bounded, get_dht_loop
 from .network_interface import NetworkInterface
-from .finger_table import FingerTable, K_BUCKET_SIZE
+from .finger_table import FingerTable, K_BUCKET_SIZE, random_id_in_bucket
+from .single_flight import SingleFlight
 from .song_dto import SongDto, SongKey, SongMetadataDto
 
 from ..services.song_services import SongServices
 from ..logs import write_log
 
 ALPHA = 3
+# How many RPCs a single lookup or fan-out keeps in flight on the DHT loop
+LOOKUP_CONCURRENCY = int(os.getenv("DHT_LOOKUP_CONCURRENCY", str(ALPHA)))
+# Buckets no lookup went through for this long are refreshed
+BUCKET_REFRESH_INTERVAL = float(os.getenv("DHT_BUCKET_REFRESH_INTERVAL", "3600"))
+# Refresh lookups running at once
+REFRESH_CONCURRENCY = 4
+# "buckets" for the FingerTable, "array" for the ArrayRoutingTable
+ROUTING_TABLE = os.getenv("DHT_ROUTING_TABLE", "buckets")
+# Seconds between two logs of the lookup counters
+STATS_LOG_INTERVAL = float(os.getenv("DHT_STATS_LOG_INTERVAL", "300"))
+
+
+def _out_of_time(deadline: Deadline | None, running: set[asyncio.Task]) -> bool:
+    """Abandons the running RPCs of a search once its deadline passed"""
+    if deadline is None or not deadline.expired:
+        return False
+    for task in running:
+        task.cancel()
+    return True
 
 
 class KademliaNode:
     def __init__(self, ip: str):
         self.ip: str = ip
         self.id: int = sha1_hash(ip)
+        self.dht_loop: DhtEventLoop = get_dht_loop()
         self.network_interface = NetworkInterface(self)
-        self.finger_table = FingerTable(self)
+        self.lookup_cache = LookupCache()
+        # Concurrent identical lookups and searches share one run
+        self.single_flight = SingleFlight()
+        routing_table = ArrayRoutingTable if ROUTING_TABLE == "array" else FingerTable
+        self.finger_table: FingerTable | ArrayRoutingTable = routing_table(
+            self, on_change=self.lookup_cache.node_changed
+        )
         self.kademlia_interface = KademliaInterface(self)
         self.connected = False
         self.seeds: set[SongKey] = set()
+        self._restore_checkpoint()
         self.network_interface.start_listening()
         self._keep_kademlia_network_connection()
         self._ensure_persistance()
+        self._track_liveness()
+        self._keep_checkpoints()
+        self._refresh_buckets()
+        self._log_stats()
 
-    def get_all_songs(self) -> tuple[list[SongMetadataDto], list[RemoteNode]]:
+    def get_all_songs(
+        self, deadline: Deadline | None = None
+    ) -> tuple[list[SongMetadataDto], list[RemoteNode]]:
         write_log("Getting all songs", 4)
-        nodes: list[RemoteNode] = self._search_all_nodes()
-        songs: set[SongMetadataDto] = set()
-        lock = threading.Lock()
-
-        def _get_songs_from_node(node: RemoteNode):
-            write_log(f"Getting songs from node {node}", 4)
-            songs_from_node: list[SongMetadataDto] | None = node.get_all_keys(self.id)
-            if songs_from_node:
-                write_log(f"Got {len(songs_from_node)} songs from node {node}", 4)
-                for song in songs_from_node:
-                    write_log(f"Got song {song} from node {node}", 4)
-                    with lock:
-                        if song not in songs:
-                            write_log(
-                                f"Adding song {song} with hash {hash(song)} to songs", 4
-                            )
-                            songs.add(song)
-                        else:
-                            write_log(f"Song {song} already in songs", 4)
-
-        with ThreadPoolExecutor(ALPHA) as executor:
-            executor.map(_get_songs_from_node, nodes)
+        songs: set[SongMetadataDto] = set(
+            self.dht_loop.run(self._aget_all_songs(deadline))
+        )
 
         # TODO improve this using hierarchy of nodes
         for song in self.kademlia_interface.get_all_songs():
@@ -63,22 +88,41 @@ class KademliaNode:
         write_log(f"Got {len(songs)} songs in total", 4)
         return list(songs), self.finger_table.get_active_nodes(K_BUCKET_SIZE)
 
-    def search_songs_by(
-        self, search_by: str, query: str
-    ) -> tuple[list[SongMetadataDto], list[RemoteNode]]:
-        nodes: list[RemoteNode] = self._search_all_nodes()
+    async def _aget_all_songs(
+        self, deadline: Deadline | None = None
+    ) -> set[SongMetadataDto]:
+        nodes: list[RemoteNode] = await self._asearch_all_nodes(deadline=deadline)
         songs: set[SongMetadataDto] = set()
-        lock = threading.Lock()
 
-        def _search_songs_by_from_node(node: RemoteNode):
-            write_log(f"Searching songs from node {node}", 5)
-            songs_from_node = node.get_keys_by_query(self.id, search_by, query)
-            write_log(f"Got {len(songs_from_node)} songs from node {node}", 5)
-            with lock:
+        async def _get_songs_from_node(node: RemoteNode):
+            write_log(f"Getting songs from node {node}", 4)
+            songs_from_node: list[SongMetadataDto] | None = await node.aget_all_keys(
+                self.id, deadline=deadline
+            )
+            if songs_from_node:
+                write_log(f"Got {len(songs_from_node)} songs from node {node}", 4)
                 songs.update(songs_from_node)
 
-        with ThreadPoolExecutor(ALPHA) as executor:
-            executor.map(_search_songs_by_from_node, nodes)
+        # Fast peers go first, so they free their slot for the next ones early
+        nodes.sort(key=lambda n: peer_rtt(n.ip))
+        await gather_bounded(
+            LOOKUP_CONCURRENCY, *(_get_songs_from_node(n) for n in nodes)
+        )
+        return songs
+
+    def search_songs_by(
+        self, search_by: str, query: str, deadline: Deadline | None = None
+    ) -> tuple[list[SongMetadataDto], list[RemoteNode]]:
+        songs: set[SongMetadataDto] = set(
+            self.dht_loop.run(
+                self.single_flight.run(
+                    ("search", search_by, query),
+                    lambda: self._asearch_songs_by(search_by, query, deadline),
+                    deadline,
+                )
+            )
+            or ()
+        )
 
         # TODO improve this using hierarchy of nodes
         for song in self.kademlia_interface.get_songs_by_query(search_by, query):
@@ -87,12 +131,32 @@ class KademliaNode:
         write_log(f"Got {len(songs)} songs in total", 5)
         return list(songs), self.finger_table.get_active_nodes(K_BUCKET_SIZE)
 
+    async def _asearch_songs_by(
+        self, search_by: str, query: str, deadline: Deadline | None = None
+    ) -> set[SongMetadataDto]:
+        nodes: list[RemoteNode] = await self._asearch_all_nodes(deadline=deadline)
+        songs: set[SongMetadataDto] = set()
+
+        async def _search_songs_by_from_node(node: RemoteNode):
+            write_log(f"Searching songs from node {node}", 5)
+            songs_from_node = await node.aget_keys_by_query(
+                self.id, search_by, query, deadline=deadline
+            )
+            write_log(f"Got {len(songs_from_node)} songs from node {node}", 5)
+            songs.update(songs_from_node)
+
+        nodes.sort(key=lambda n: peer_rtt(n.ip))
+        await gather_bounded(
+            LOOKUP_CONCURRENCY, *(_search_songs_by_from_node(n) for n in nodes)
+        )
+        return songs
+
     def search_song_streamers(
-        self, song_key: SongKey
+        self, song_key: SongKey, deadline: Deadline | None = None
     ) -> tuple[list[RemoteNode], list[RemoteNode]]:
         write_log(f"Searching song streamers, for key: {song_key}", 1)
         key: int = sha1_hash(str(song_key))
-        nearest: list[RemoteNode] = self._search_k_nearest(key)
+        nearest: list[RemoteNode] = self._search_k_nearest(key, deadline=deadline)
 
         # TODO improve this using hierarchy of nodes
         if len(nearest) < K_BUCKET_SIZE:
@@ -103,32 +167,41 @@ class KademliaNode:
 
         return nearest, self.finger_table.get_active_nodes(K_BUCKET_SIZE)
 
-    def store_song(self, song: SongDto) -> tuple[bool, list[RemoteNode]]:
+    def store_song(
+        self, song: SongDto, deadline: Deadline | None = None
+    ) -> tuple[bool, list[RemoteNode]]:
+        """The deadline bounds the lookup, the transfers have their own timeouts"""
         write_log(f"Storing song,{song}", 1)
         key: int = sha1_hash(str(song.key))
-        nearest: list[RemoteNode] = self._search_k_nearest(key)
+        # Hashed once here, the replicas are asked for this exact audio
+        audio_hash: str = song.audio_hash
+        nearest: list[RemoteNode] = self._search_k_nearest(key, deadline=deadline)
         write_log(f"The nearest nodes to song {song} are {nearest}", 1)
 
         local_save = True
         # TODO improve this using hierarchy of nodes
         if len(nearest) < K_BUCKET_SIZE:
-            local_save = self.kademlia_interface.save_song(song, True)
-            write_log("Saved song in local node and added to seeds", 6)
+            local_save = self._save_song_locally(song, audio_hash)
         elif nearest[-1].id ^ key > self.id ^ key:
             nearest.pop()
-            local_save = self.kademlia_interface.save_song(song, True)
-            write_log("Saved song in local node and added to seeds", 6)
+            local_save = self._save_song_locally(song, audio_hash)
 
-        write_log(
-            f"The distance between farest node and key is {nearest[-1].id ^ key} and the distance between self and key is {self.id ^ key}",
-            1,
-        )
-
-        with ThreadPoolExecutor(ALPHA) as executor:
-            results = executor.map(
-                lambda node: node.save_key(self.id, song, node == nearest[0]), nearest
+        if nearest:
+            write_log(
+                f"The distance between farest node and key is {nearest[-1].id ^ key} and the distance between self and key is {self.id ^ key}",
+                1,
             )
 
+        async def _replicate(node: RemoteNode) -> bool:
+            if await node.aconstains_key(str(song.key), self.id, audio_hash):
+                write_log(f"{node} already stores song {song}", 6)
+                return True
+            return await node.asave_key(self.id, song, node == nearest[0])
+
+        results: list[bool] = self.dht_loop.run(
+            gather_bounded(ALPHA, *(_replicate(node) for node in nearest))
+        )
+
         for n in results:
             write_log("Saved song in node" if n else "Failed to save song in node", 1)
 
@@ -136,6 +209,14 @@ class KademliaNode:
             K_BUCKET_SIZE
         )
 
+    def _save_song_locally(self, song: SongDto, audio_hash: str) -> bool:
+        if self.kademlia_interface.constains_song(song.key, audio_hash):
+            write_log(f"Song {song} is already stored in local node", 6)
+            return True
+        saved: bool = self.kademlia_interface.save_song(song, True)
+        write_log("Saved song in local node and added to seeds", 6)
+        return saved
+
     def stream_song(self, key: SongKey, rang: tuple[int, int]):
         """ """
         if self._constains_song(key):
@@ -147,49 +228,166 @@ class KademliaNode:
     def _constains_song(self, key: SongKey):
         return SongServices.exists_song(key)
 
-    def _search_k_nearest(self, key: int, k: int = K_BUCKET_SIZE) -> list[RemoteNode]:
+    def _search_k_nearest(
+        self, key: int, k: int = K_BUCKET_SIZE, deadline: Deadline | None = None
+    ) -> list[RemoteNode]:
+        cached: list[RemoteNode] | None = self.lookup_cache.get(key, k)
+        if cached is not None:
+            write_log(f"The nearest nodes to key {key} are cached: {cached}", 1)
+            return cached
+        nearest: list[RemoteNode] | None = self.dht_loop.run(
+            self.single_flight.run(
+                ("lookup", key, k),
+                lambda: self._asearch_k_nearest(key, k, deadline=deadline),
+                deadline,
+            )
+        )
+        # Every caller gets its own copy of the shared result
+        return list(nearest or [])
+
+    async def _asearch_k_nearest(
+        self,
+        key: int,
+        k: int = K_BUCKET_SIZE,
+        concurrency: int = LOOKUP_CONCURRENCY,
+        hedge: bool = HEDGED_READS,
+        deadline: Deadline | None = None,
+    ) -> list[RemoteNode]:
+        """
+        Iterative Kademlia lookup. The shortlist is made of the k closest nodes
+        seen, up to concurrency (alpha) of its unqueried members are asked at
+        a time, and the lookup ends once all of them have answered. Nodes that
+        fail are dropped, which lets the next closest into the shortlist.
+
+        When the deadline passes the RPCs still running are abandoned and the
+        closest nodes found so far are returned
+        """
         write_log(f"Searching k nearest nodes to key {key}", 1)
-        nearest: list[RemoteNode] = []
-        pending: set[RemoteNode] = set()
-        already_queried: set[RemoteNode] = set()
-        lock = threading.Lock()
+        self.finger_table.touch(key)
+        # Every node seen, with the hop at which it was learnt
+        learnt_at: dict[RemoteNode, int] = {}
+        # The nodes seen that did not fail
+        alive: set[RemoteNode] = set()
+        queried: set[RemoteNode] = set()
+        answered: set[RemoteNode] = set()
+        rpcs: int = 0
+
+        def _add(remote_node: RemoteNode, hop: int) -> None:
+            if remote_node.id != self.id and remote_node not in learnt_at:
+                learnt_at[remote_node] = hop
+                alive.add(remote_node)
+
+        def _shortlist() -> list[RemoteNode]:
+            return nsmallest(k, alive, key=lambda n: n.id ^ key)
+
+        def _take(candidates) -> RemoteNode | None:
+            for candidate in candidates:
+                if candidate not in queried:
+                    queried.add(candidate)
+                    return candidate
+            return None
+
+        def _next_candidate() -> RemoteNode | None:
+            return _take(_shortlist())
+
+        def _hedge_candidate() -> RemoteNode | None:
+            # A hedge may go past the shortlist, its straggler is dropped if
+            # the hedge wins
+            return _take(sorted(alive, key=lambda n: n.id ^ key))
+
+        def _converged() -> bool:
+            # With no node left every RPC failed, there is nothing to converge on
+            shortlist: list[RemoteNode] = _shortlist()
+            return bool(shortlist) and all(n in answered for n in shortlist)
 
         for remote_node in self.finger_table.get_k_closets_nodes(key, k):
-            heappush(nearest, (-(remote_node.id ^ key), remote_node))
-            pending.add(remote_node)
-
-        def _get_nears_node(_):
-            with lock:
-                current: RemoteNode = pending.pop()
-                already_queried.add(current)
-            new_nodes: list[RemoteNode] | None = current.get_nears_node(self.id, key)
-            if new_nodes:
-                for remote_node in new_nodes:
-                    if remote_node.id == self.id:
-                        continue
-                    with lock:
-                        if (
-                            remote_node not in already_queried
-                            and remote_node not in pending
-                        ):
-                            heappush(nearest, (-(remote_node.id ^ key), remote_node))
-                            pending.add(remote_node)
+            _add(remote_node, 0)
+
+        async def _ask(current: RemoteNode) -> list[RemoteNode] | None:
+            nonlocal rpcs
+            rpcs += 1
+            try:
+                new_nodes: list[RemoteNode] | None = await current.aget_nears_node(
+                    self.id, key, deadline=deadline
+                )
+            except asyncio.CancelledError:
+                # A straggler that lost a hedge counts as unresponsive
+                alive.discard(current)
+                raise
+            if new_nodes is None:
+                alive.discard(current)
+                return None
+            answered.add(current)
+            # It answered, so it is alive and belongs in our buckets
+            self.finger_table.add_node(current)
+            for remote_node in new_nodes:
+                _add(remote_node, learnt_at[current] + 1)
+            return new_nodes
+
+        async def _get_nears_node(current: RemoteNode):
+            if hedge:
+                # A straggler is raced against the next closest candidate
+                await hedged_read(
+                    RemoteFunctions.GET_NEARS_NODE.value,
+                    current,
+                    _hedge_candidate,
+                    _ask,
+                )
+            else:
+                await _ask(current)
 
-        while pending:
-            with ThreadPoolExecutor(ALPHA) as executor:
-                executor.map(_get_nears_node, range(ALPHA))
+        running: set[asyncio.Task] = set()
+        while True:
+            if deadline is not None and deadline.expired:
+                write_log(f"Lookup of key {key} ran out of time", 1)
+                break
+            if _converged():
+                break
+            # Closest candidates first, and only as slots free up, so the ones
+            # still unqueried are there for hedges to pick from
+            while len(running) < concurrency:
+                current: RemoteNode | None = _next_candidate()
+                if current is None:
+                    break
+                running.add(asyncio.create_task(_get_nears_node(current)))
+            if not running:
+                break
+            _, running = await asyncio.wait(
+                running,
+                timeout=deadline.remaining() if deadline else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
 
-        result = [heappop(nearest)[1] for _ in range(min(k, len(nearest)))]
-        write_log(f"The nearest nodes are {result}", 1)
+        result: list[RemoteNode] = _shortlist()
+        converged: bool = _converged()
+        for task in running:
+            task.cancel()
+        # The longest chain of answers that led to the result
+        hops: int = max((learnt_at[n] + 1 for n in answered), default=0)
+        get_lookup_stats().count_lookup(rpcs, hops, converged)
+        # Partial results of a lookup cut short are not worth reusing, nor are
+        # short ones unless every node the lookup reached answered
+        if converged and (len(result) == k or len(alive) == len(learnt_at)):
+            self.lookup_cache.put(key, k, result)
+        write_log(
+            f"The nearest nodes are {result}, found with {rpcs} RPCs in {hops} "
+            f"hops{'' if converged else ' without converging'}",
+            1,
+        )
 
         return result
 
-    def _search_all_nodes(self):
+    def _search_all_nodes(self) -> list[RemoteNode]:
+        return self.dht_loop.run(self._asearch_all_nodes())
+
+    async def _asearch_all_nodes(
+        self, concurrency: int = LOOKUP_CONCURRENCY, deadline: Deadline | None = None
+    ) -> list[RemoteNode]:
         write_log("Searching all nodes", 4)
         nodes: list[RemoteNode] = []
         pendings: set[RemoteNode] = set()
         already_queried: set[RemoteNode] = set()
-        lock = threading.Lock()
+        semaphore = asyncio.Semaphore(concurrency)
 
         for remote_node in self.finger_table.get_all_nodes():
             write_log(
@@ -198,39 +396,43 @@ class KademliaNode:
             nodes.append(remote_node)
             pendings.add(remote_node)
 
-        def _get_all_nodes_from_remote(_):
-            write_log("Getting all nodes from remote", 4)
-            with lock:
+        async def _get_all_nodes_from_remote(current: RemoteNode):
+            write_log(f"Now gettings nodes from {current}", 4)
+            async with semaphore:
+                new_nodes = await current.aget_all_nodes(self.id, deadline=deadline)
+            write_log(f"Got {len(new_nodes)} nodes from {current}", 4)
+            for remote_node in new_nodes:
+                if remote_node.id == self.id:
+                    continue
+                if remote_node not in already_queried and remote_node not in pendings:
+                    write_log(
+                        f"Adding node {remote_node} to pending nodes from discovered nodes",
+                        4,
+                    )
+                    nodes.append(remote_node)
+                    pendings.add(remote_node)
+
+        running: set[asyncio.Task] = set()
+        while pendings or running:
+            if _out_of_time(deadline, running):
+                write_log("Search of all nodes ran out of time", 4)
+                break
+            while pendings:
                 current: RemoteNode = pendings.pop()
-                write_log(f"Now gettings nodes from {current}", 4)
                 already_queried.add(current)
-            new_nodes = current.get_all_nodes()
-            write_log(f"Got {len(new_nodes)} nodes from {current}", 4)
-            if new_nodes:
-                for remote_node in new_nodes:
-                    if remote_node.id == self.id:
-                        continue
-                    with lock:
-                        if (
-                            remote_node not in already_queried
-                            and remote_node not in pendings
-                        ):
-                            write_log(
-                                f"Adding node {remote_node} to pending nodes from discovered nodes",
-                                4,
-                            )
-                            nodes.append(remote_node)
-                            pendings.add(remote_node)
-
-        while pendings:
-            with ThreadPoolExecutor(ALPHA) as executor:
-                executor.map(_get_all_nodes_from_remote, range(ALPHA))
+                running.add(asyncio.create_task(_get_all_nodes_from_remote(current)))
+            _, running = await asyncio.wait(
+                running,
+                timeout=deadline.remaining() if deadline else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
 
         write_log(f"Found {len(nodes)} nodes", 4)
         return nodes
 
     def _keep_connection_to_network(self):
         write_log("Starting to keep connection to network")
+        joined: bool = False
         while True:
             if len(self.finger_table.get_active_nodes(10)) < 3:
                 discovered_nodes: list[RemoteNode] = (
@@ -240,7 +442,14 @@ class KademliaNode:
                 if discovered_nodes:
                     for node in discovered_nodes:
                         self.finger_table.add_node(node)
+                    joined = False
 
+            # Join as soon as there are contacts, restored or discovered
+            if not joined and self.finger_table.get_all_nodes():
+                self._join()
+                joined = True
+
+            if len(self.finger_table.get_active_nodes(10)) < 3:
                 time.sleep(20)
                 write_log("Waiting 20 seconds to discover new nodes")
             else:
@@ -250,36 +459,128 @@ class KademliaNode:
     def _keep_kademlia_network_connection(self):
         threading.Thread(target=self._keep_connection_to_network, args=[]).start()
 
+    def _join(self):
+        self.dht_loop.run(self._ajoin())
+
+    async def _ajoin(self):
+        """
+        Looks up our own id, which fills the buckets closest to us and makes us
+        known to our neighbours, then a random id in the range of every bucket
+        """
+        write_log("Joining the network")
+        await self._asearch_k_nearest(self.id)
+        await self._arefresh_buckets(0)
+        write_log(f"Joined the network, buckets: {self.finger_table.bucket_fill()}")
+
+    async def _arefresh_buckets(self, max_age: float):
+        stale: list[int] = self.finger_table.stale_buckets(max_age)
+        if not stale:
+            return
+        write_log(f"Refreshing buckets {stale}")
+        await gather_bounded(
+            REFRESH_CONCURRENCY,
+            *(self._asearch_k_nearest(random_id_in_bucket(self.id, i)) for i in stale),
+        )
+
+    def _refresh_buckets_service(self):
+        write_log("Starting bucket refresh")
+        while True:
+            time.sleep(min(BUCKET_REFRESH_INTERVAL, 60))
+            self.dht_loop.run(self._arefresh_buckets(BUCKET_REFRESH_INTERVAL))
+            write_log(f"Bucket fill: {self.finger_table.bucket_fill()}")
+
+    def _refresh_buckets(self):
+        threading.Thread(target=self._refresh_buckets_service, args=[]).start()
+
+    def _track_liveness_service(self):
+        write_log("Starting liveness tracking")
+        while True:
+            time.sleep(LIVENESS_PROBE_INTERVAL)
+            self.dht_loop.run(aprobe(self.finger_table.get_all_nodes(), self.id))
+
+    def _track_liveness(self):
+        threading.Thread(target=self._track_liveness_service, args=[]).start()
+
+    def _restore_checkpoint(self):
+        checkpoint: RoutingCheckpoint | None = RoutingCheckpoint.load()
+        if checkpoint is None:
+            return
+        for node in checkpoint.nodes:
+            if node.id != self.id:
+                self.finger_table.add_node(node)
+        self.seeds |= checkpoint.seeds
+        # The restored nodes are used right away, the ones silent for too long
+        # are probed again in the background
+        self.dht_loop.submit(aprobe(checkpoint.nodes, self.id))
+
+    def _checkpoint_service(self):
+        write_log("Starting routing table checkpoints")
+        while True:
+            time.sleep(CHECKPOINT_INTERVAL)
+            checkpoint = RoutingCheckpoint(
+                self.finger_table.get_all_nodes(), set(self.seeds)
+            )
+            try:
+                checkpoint.save()
+            except OSError as e:
+                write_log(f"Error saving the routing table checkpoint: {e}", 3)
+
+    def _keep_checkpoints(self):
+        threading.Thread(target=self._checkpoint_service, args=[]).start()
+
+    def stats(self) -> dict:
+        return {
+            "lookups": get_lookup_stats().to_dict(),
+            "hedges": get_hedge_stats().to_dict(),
+            "lookup_cache": self.lookup_cache.to_dict(),
+            "single_flight": self.single_flight.to_dict(),
+        }
+
+    def _log_stats_service(self):
+        while True:
+            time.sleep(STATS_LOG_INTERVAL)
+            write_log(f"Lookup stats: {self.stats()}")
+
+    def _log_stats(self):
+        threading.Thread(target=self._log_stats_service, args=[]).start()
+
     def _ensure_persistance_service(self):
         write_log("Starting ensure persistance", 6)
         while True:
-            for song in self.seeds:
+            replicas: dict[RemoteNode, list[SongKey]] = {}
+            for song in list(self.seeds):
                 write_log(f"Verifiyng song {song} persistance in network", 6)
                 key = sha1_hash(str(song))
-                nearest = self._search_k_nearest(key)
-                for node in nearest:
-                    if node.constains_key(str(song), self.id):
+                for node in self._search_k_nearest(key):
+                    replicas.setdefault(node, []).append(song)
+
+            # One batched question per replica instead of one per song
+            for node, songs in replicas.items():
+                contained: list[bool] = node.constains_keys(
+                    [str(song) for song in songs], self.id
+                )
+                for song, constains in zip(songs, contained):
+                    if constains:
                         write_log(f"Node {node} already constains song {song}", 6)
                         continue
-                    song_data: Song | None = SongServices.get_song(song)
-                    if not song_data:
-                        write_log("Song is in seeds but is not in the database", 3)
-                        self.seeds.remove(song)
-                    else:
-                        song_dto: SongDto | None = SongDto.from_dict(
-                            song_data.to_dict()
-                        )
-                        if not song_dto:
-                            write_log(
-                                f"Error constructing song dto from song data for {song}",
-                                6,
-                            )
-                        else:
-                            node.save_key(self.id, song_dto)
-                            write_log(f"Saved song {song_dto} in node {node}", 6)
+                    self._replicate_song(node, song)
 
             time.sleep(240)
 
+    def _replicate_song(self, node: RemoteNode, song: SongKey):
+        song_data: Song | None = SongServices.get_song(song)
+        if not song_data:
+            write_log("Song is in seeds but is not in the database", 3)
+            self.seeds.discard(song)
+            return
+        try:
+            song_dto: SongDto = SongServices.song_source(song_data)
+        except OSError as e:
+            write_log(f"Error reading the stored files of {song}: {e}", 6)
+            return
+        node.save_key(self.id, song_dto)
+        write_log(f"Saved song {song_dto} in node {node}", 6)
+
     def _ensure_persistance(self):
         threading.Thread(target=self._ensure_persistance_service, args=[]).start()
 
@@ -321,8 +622,10 @@ class KademliaInterface:
             return True
         return False
 
-    def constains_song(self, song_key: SongKey) -> bool:
-        return SongServices.exists_song(song_key)
+    def constains_song(
+        self, song_key: SongKey, audio_sha256: str | None = None
+    ) -> bool:
+        return SongServices.exists_song(song_key, audio_sha256)
 
     def get_all_nodes(self) -> list[RemoteNode]:
         return self.node.finger_table.get_all_nodes()
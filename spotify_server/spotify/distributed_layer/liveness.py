@@ -0,0 +1,46 @@
+import os
+import time
+
+from .event_loop import gather_bounded
+from .peer_health import PeerHealth, get_peer_health
+from .remote_node import RemoteNode
+
+from ..logs import write_log
+
+# Seconds between two rounds of liveness probes
+LIVENESS_PROBE_INTERVAL = float(os.getenv("DHT_LIVENESS_PROBE_INTERVAL", "15"))
+# Nodes nothing was heard of for this long are probed, so are the suspects
+LIVENESS_MAX_SILENCE = float(os.getenv("DHT_LIVENESS_MAX_SILENCE", "60"))
+LIVENESS_PROBE_CONCURRENCY = 8
+
+
+def is_alive(node: RemoteNode) -> bool:
+    """
+    What the last RPCs to and requests from the node said, without asking it
+    again. Every call updates this, the probes only cover the silent nodes.
+    """
+    health: PeerHealth = get_peer_health(node.ip)
+    return health.available and health.alive
+
+
+def needs_probe(node: RemoteNode, now: float) -> bool:
+    health: PeerHealth = get_peer_health(node.ip)
+    return not health.alive or now - health.last_checked >= LIVENESS_MAX_SILENCE
+
+
+async def aprobe(nodes: list[RemoteNode], sender_id: int) -> int:
+    """
+    Pings the nodes whose liveness is stale or suspect, the RPC layer records
+    the outcome. Returns how many were probed.
+    """
+    now: float = time.time()
+    stale: list[RemoteNode] = [n for n in nodes if needs_probe(n, now)]
+    if stale:
+        answers: list[tuple[bool, int | None]] = await gather_bounded(
+            LIVENESS_PROBE_CONCURRENCY, *(n.aping(sender_id) for n in stale)
+        )
+        write_log(
+            f"Probed {len(stale)} of {len(nodes)} nodes, "
+            f"{sum(ok for ok, _ in answers)} answered"
+        )
+    return len(stale)
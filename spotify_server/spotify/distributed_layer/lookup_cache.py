@@ -0,0 +1,87 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from .liveness import is_alive
+from .remote_node import RemoteNode
+
+from ..logs import write_log
+
+# Resolved lookups kept, least recently used ones go first
+LOOKUP_CACHE_SIZE = int(os.getenv("DHT_LOOKUP_CACHE_SIZE", "1024"))
+# Seconds a resolved lookup is trusted
+LOOKUP_CACHE_TTL = float(os.getenv("DHT_LOOKUP_CACHE_TTL", "30"))
+
+
+class LookupCache:
+    """
+    The k nearest nodes of recently looked up keys. An entry is dropped when
+    it expires, when one of its nodes fails, and when the routing table gains
+    or loses a node that would change it.
+    """
+
+    def __init__(self, size: int = LOOKUP_CACHE_SIZE, ttl: float = LOOKUP_CACHE_TTL):
+        self.size: int = size
+        self.ttl: float = ttl
+        # (key, k) to when it expires and the nodes, closest first
+        self._entries: OrderedDict[tuple[int, int], tuple[float, list[RemoteNode]]] = (
+            OrderedDict()
+        )
+        self.hits: int = 0
+        self.misses: int = 0
+        self.invalidations: int = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: int, k: int) -> list[RemoteNode] | None:
+        with self._lock:
+            entry = self._entries.get((key, k))
+            if entry is not None:
+                expires_at, nodes = entry
+                if time.monotonic() >= expires_at:
+                    del self._entries[(key, k)]
+                elif not all(is_alive(n) for n in nodes):
+                    del self._entries[(key, k)]
+                    self.invalidations += 1
+                else:
+                    self._entries.move_to_end((key, k))
+                    self.hits += 1
+                    return list(nodes)
+            self.misses += 1
+            return None
+
+    def put(self, key: int, k: int, nodes: list[RemoteNode]) -> None:
+        # An empty answer would hide the network until it expires
+        if self.size <= 0 or self.ttl <= 0 or not nodes:
+            return
+        with self._lock:
+            self._entries[(key, k)] = (time.monotonic() + self.ttl, list(nodes))
+            self._entries.move_to_end((key, k))
+            if len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def node_changed(self, node: RemoteNode) -> None:
+        """
+        The node entered or left the routing table. Entries listing it, or
+        with fewer than k nodes or a farther one, might now resolve otherwise.
+        """
+        with self._lock:
+            stale: list[tuple[int, int]] = [
+                (key, k)
+                for (key, k), (_, nodes) in self._entries.items()
+                if node in nodes or len(nodes) < k or node.id ^ key < nodes[-1].id ^ key
+            ]
+            for entry in stale:
+                del self._entries[entry]
+            self.invalidations += len(stale)
+        if stale:
+            write_log(f"{node} changed {len(stale)} cached lookups", 1)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+            }
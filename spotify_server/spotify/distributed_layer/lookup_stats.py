@@ -0,0 +1,48 @@
+import threading
+
+
+class LookupStats:
+    """
+    Cost of the node lookups. A Kademlia lookup should take O(log n) hops
+    and RPCs, growing totals per lookup mean the search is crawling the
+    overlay instead.
+    """
+
+    def __init__(self):
+        self.lookups: int = 0
+        self.rpcs: int = 0
+        self.hops: int = 0
+        self.max_rpcs: int = 0
+        self.max_hops: int = 0
+        self.converged: int = 0
+        self._lock = threading.Lock()
+
+    def count_lookup(self, rpcs: int, hops: int, converged: bool) -> None:
+        with self._lock:
+            self.lookups += 1
+            self.rpcs += rpcs
+            self.hops += hops
+            self.max_rpcs = max(self.max_rpcs, rpcs)
+            self.max_hops = max(self.max_hops, hops)
+            self.converged += converged
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            lookups: int = self.lookups or 1
+            return {
+                "lookups": self.lookups,
+                "converged": self.converged,
+                "rpcs": self.rpcs,
+                "hops": self.hops,
+                "avg_rpcs": self.rpcs / lookups,
+                "avg_hops": self.hops / lookups,
+                "max_rpcs": self.max_rpcs,
+                "max_hops": self.max_hops,
+            }
+
+
+_stats = LookupStats()
+
+
+def get_lookup_stats() -> LookupStats:
+    return _stats
@@ -1,23 +1,67 @@
+import os
 import socket
-import ssl
 import time
 import threading
 import multiprocessing
 from concurrent.futures import ThreadPoolExecutor
-from hashlib import sha256
 
 
-from .rpc_message import RpcRequest, RpcResponse
-from .remote_node import RemoteNode, RemoteFunctions
+from .admission import AdmissionControl, RequestClass, request_class
+from .async_server import AsyncRpcServer
+from .connection_pool import (
+    DHT_PORT,
+    PRUNE_INTERVAL,
+    SERVER_IDLE_TIMEOUT,
+    aprune_pools,
+    get_server_context,
+    prune_pools,
+)
+from .event_loop import get_dht_loop
+from .rpc_message import (
+    BUSY,
+    Codec,
+    Frame,
+    MessageType,
+    RpcRequest,
+    RpcResponse,
+    answer_hello,
+    encode_message,
+    get_codec,
+    read_body,
+    read_chunks,
+    read_frame,
+    request_from_frame,
+    write_frame,
+)
+from .peer_health import get_peer_health
+from .remote_node import SAVE_KEY_STORED, RemoteNode, RemoteFunctions
 from .song_dto import SongDto, SongKey
+from .song_receiver import (
+    MAX_TRANSFER_CHUNK_SIZE,
+    MIN_TRANSFER_CHUNK_SIZE,
+    IncomingPayload,
+    IncomingTransfer,
+    PartialTransferStore,
+)
 
 from ..logs import write_log
 
+# Only for the "thread" mode, where every open connection holds a worker
+MAX_SERVER_WORKERS = 32
+MAX_BATCH_SIZE = 1000
+# "asyncio" multiplexes every connection in one event loop and only hands the
+# decoded requests to the workers, so idle pooled connections cost no thread.
+# "thread" serves every connection from a worker thread of its own
+SERVER_MODE = os.getenv("DHT_SERVER_MODE", "asyncio")
+
 
 class NetworkInterface:
     def __init__(self, node):
         self.node = node
         self.listening: bool = False
+        self.async_server: AsyncRpcServer | None = None
+        self.admission = AdmissionControl()
+        self.partial_transfers = PartialTransferStore()
 
     def _listen_new_nodes_request(self):
         write_log("listening to new nodes requests")
@@ -42,19 +86,16 @@ class NetworkInterface:
         write_log(
             f"starting listening in ip: {self.node.ip} node with id : {self.node.id}"
         )
-        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-        context.load_cert_chain(
-            certfile="./spotify/distributed_layer/cert.pem",
-            keyfile="./spotify/distributed_layer/key.pem",
-        )
+        context = get_server_context()
 
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as listening_socket:
-            listening_socket.bind(("0.0.0.0", 1729))
-            listening_socket.listen(10)
+            listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listening_socket.bind(("0.0.0.0", DHT_PORT))
+            listening_socket.listen(64)
             with context.wrap_socket(
                 listening_socket, server_side=True
             ) as s_listening_socket:
-                with ThreadPoolExecutor(5) as executor:
+                with ThreadPoolExecutor(MAX_SERVER_WORKERS) as executor:
                     while self.listening:
                         conn, addr = s_listening_socket.accept()
                         write_log(f"Accepted conection from {addr}")
@@ -62,11 +103,24 @@ class NetworkInterface:
 
     def start_listening(self):
         self.listening = True
-        threading.Thread(target=self._listen, args=[]).start()
+        if SERVER_MODE == "asyncio":
+            self.async_server = AsyncRpcServer(self)
+            threading.Thread(target=self.async_server.run, args=[]).start()
+        else:
+            threading.Thread(target=self._listen, args=[]).start()
         multiprocessing.Process(target=self._listen_new_nodes_request, args=[]).start()
+        threading.Thread(target=self._prune_connections, args=[]).start()
+
+    def _prune_connections(self):
+        while self.listening:
+            time.sleep(PRUNE_INTERVAL)
+            prune_pools()
+            get_dht_loop().submit(aprune_pools())
 
     def stop_listening(self):
         self.listening = False
+        if self.async_server:
+            self.async_server.stop()
 
     def discover_nodes(self) -> list[RemoteNode]:
         discovered_nodes: list[RemoteNode] = []
@@ -105,90 +159,283 @@ class NetworkInterface:
         write_log("Ended discovering")
         return discovered_nodes
 
+    def _send_response(
+        self,
+        conn: socket.socket,
+        write_lock: threading.Lock,
+        request_id: int,
+        response: RpcResponse,
+        codec: Codec,
+        compress: bool = False,
+    ):
+        with write_lock:
+            write_frame(
+                conn,
+                MessageType.RESPONSE,
+                request_id,
+                *encode_message(response, codec, compress),
+            )
+
+    def _send_busy(
+        self, conn: socket.socket, write_lock: threading.Lock, request_id: int
+    ):
+        with write_lock:
+            write_frame(conn, MessageType.ERROR, request_id, BUSY)
+
     def _handle_receive_song(
-        self, conn: socket.socket, addr: tuple[str, str], request: RpcRequest
+        self,
+        conn: socket.socket,
+        write_lock: threading.Lock,
+        addr: tuple[str, str],
+        request: RpcRequest,
+        codec: Codec,
     ):
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 256)
+        write_log(f"Received request of save song from {addr}", 1)
+        stored: RpcResponse | None = self.stored_song_response(request)
+        if stored:
+            self._send_response(conn, write_lock, request.request_id, stored, codec)
+            return
+        transfer: IncomingTransfer | None = self.incoming_transfer(request)
+        if transfer is None:
+            self._send_busy(conn, write_lock, request.request_id)
+            return
         try:
-            conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 256)
-            conn.settimeout(1)
-            write_log(f"Received request of save song from {addr}", 1)
-            conn.sendall(b"Ok")
-            write_log("Sended Ok", 1)
-            large_data = b""
-            while True:
-                try:
-                    data = conn.recv(1024 * 256)
-                    write_log(f"received {len(data)} bytes more", 1)
-                except socket.timeout:
-                    write_log("No more data", 1)
-                    break
+            self._send_response(
+                conn,
+                write_lock,
+                request.request_id,
+                RpcResponse(transfer.handshake),
+                codec,
+            )
+            write_log(f"Sended {transfer.handshake}", 1)
 
-                large_data += data
-            write_log(f"received {len(large_data)} bytes", 1)
-            if sha256(large_data).hexdigest() == request.arguments[1]:
-                write_log("Image Received", 1)
-                request.arguments[0]["image"]["image_data"] = large_data
-                write_log("Sending confirmation of image", 1)
-                conn.sendall(b"Img Ok")
-                write_log("Sended image ok", 1)
-                large_data = b""
-                while True:
-                    try:
-                        data = conn.recv(1024 * 256)
-                        write_log(f"received {len(data)} bytes more", 1)
-                    except socket.timeout:
-                        write_log("No more data", 1)
-                        break
-
-                    large_data += data
-                write_log(f"received {len(large_data)} bytes", 1)
-                if sha256(large_data).hexdigest() == request.arguments[2]:
-                    write_log("Audio Received", 1)
-                    request.arguments[0]["audio_data"] = large_data
-                    response = self.handle_request(request, addr)
-                    conn.sendall(response.encode())
-
-                else:
-                    write_log("Error receiving audio", 1)
-                    conn.sendall(b"Error")
+            image, audio = transfer.image, transfer.audio
+            if transfer.chunk_size:
+                read_chunks(
+                    conn, request.request_id, image.feed_chunk, transfer.chunk_size
+                )
+                read_chunks(
+                    conn, request.request_id, audio.feed_chunk, transfer.chunk_size
+                )
             else:
-                write_log("Error receiving image", 1)
-                conn.sendall(b"Error")
+                read_body(conn, request.request_id, image.feed)
+                read_body(conn, request.request_id, audio.feed)
+            write_log(f"received {image.received} bytes of image", 1)
+            write_log(f"received {audio.received} bytes of audio", 1)
 
+            response: RpcResponse = self.store_received_song(
+                request, addr, image, audio
+            )
+        finally:
+            transfer.close()
+        self._send_response(conn, write_lock, request.request_id, response, codec)
+
+    def _respond(
+        self,
+        conn: socket.socket,
+        write_lock: threading.Lock,
+        addr: tuple[str, str],
+        request: RpcRequest,
+        codec: Codec,
+        compress: bool,
+    ):
+        try:
+            response: RpcResponse | None = self.run_request(request, addr)
+            if response is None:
+                return
+            write_log(f"Sending response {response} to {addr}", 4)
+            self._send_response(
+                conn, write_lock, request.request_id, response, codec, compress
+            )
         except Exception as e:
-            write_log(f"Error handling song {e}", 3)
+            write_log(f"Error answering {request} from {addr}: {e}", 3)
+
+    def stored_song_response(self, request: RpcRequest) -> RpcResponse | None:
+        """
+        Answers a SAVE_KEY before any payload moves when the song is already
+        stored with the same audio. Only peers that propose a chunk size know
+        this answer, older ones always send the payloads.
+        """
+        if len(request.arguments) < 7:
+            return None
+        song: dict = request.arguments[0]
+        song_key = SongKey(song.get("title"), song.get("artist"))
+        if not self.node.kademlia_interface.constains_song(
+            song_key, request.arguments[2]
+        ):
+            return None
+        write_log(f"Song {song_key} is already stored, skipping its payloads", 6)
+        return RpcResponse(SAVE_KEY_STORED)
+
+    def incoming_transfer(self, request: RpcRequest) -> IncomingTransfer | None:
+        """None when the same song is already being received"""
+        image_hash, audio_hash = request.arguments[1:3]
+        # Older peers do not declare the sizes of the image and the audio, and
+        # only newer ones propose a chunk size to make the transfer resumable
+        sizes: list = request.arguments[4:7] + [None] * (7 - len(request.arguments))
+        image_size, audio_size, chunk_size = sizes
+        if (
+            isinstance(image_size, int)
+            and isinstance(audio_size, int)
+            and isinstance(chunk_size, int)
+            and MIN_TRANSFER_CHUNK_SIZE <= chunk_size <= MAX_TRANSFER_CHUNK_SIZE
+        ):
+            return self.partial_transfers.open(
+                image_hash, audio_hash, image_size, audio_size, chunk_size
+            )
+        return IncomingTransfer(
+            IncomingPayload(image_size, image_hash),
+            IncomingPayload(audio_size, audio_hash),
+        )
 
-        finally:
-            conn.close()
+    def store_received_song(
+        self,
+        request: RpcRequest,
+        addr: tuple[str, str],
+        image: IncomingPayload,
+        audio: IncomingPayload,
+    ) -> RpcResponse:
+        if not image.finish():
+            write_log("Error receiving image", 1)
+            return RpcResponse(False)
+        if not audio.finish():
+            write_log("Error receiving audio", 1)
+            return RpcResponse(False)
+
+        write_log("Image and audio received", 1)
+        request.arguments[0]["image"]["image_data"] = image.data
+        request.arguments[0]["image"]["image_path"] = image.path
+        request.arguments[0]["image"]["image_sha256"] = image.expected_hash
+        request.arguments[0]["audio_data"] = audio.data
+        request.arguments[0]["audio_path"] = audio.path
+        request.arguments[0]["audio_sha256"] = audio.expected_hash
+        return self.handle_request(request, addr)
+
+    def negotiate_hello(self, frame: Frame) -> tuple[bool, bytes]:
+        """Whether responses on the connection may be compressed, and the answer"""
+        codec, compress, answer = answer_hello(frame.body)
+        write_log(f"Negotiated {codec.name} codec, compression: {compress}")
+        return compress, answer
+
+    def _handle_hello(
+        self, conn: socket.socket, write_lock: threading.Lock, frame: Frame
+    ) -> bool:
+        compress, answer = self.negotiate_hello(frame)
+        with write_lock:
+            write_frame(conn, MessageType.HELLO, frame.request_id, answer)
+        return compress
 
     def handle_connection(self, conn: socket.socket, addr: tuple[str, str]):
         write_log(f"Handling connection from {addr}")
         try:
-            data: bytes = conn.recv(8192)
-            request: RpcRequest | None = RpcRequest.decode(data)
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn.settimeout(SERVER_IDLE_TIMEOUT)
+            write_lock = threading.Lock()
+            compress: bool = False
+            # Peers keep their connections pooled, so serve requests until they
+            # close it or it stays idle for too long
+            while self.listening:
+                try:
+                    frame: Frame | None = read_frame(conn)
+                except socket.timeout:
+                    write_log(f"Closing idle connection from {addr}")
+                    break
+                if frame is None:
+                    break
+                if frame.message_type == MessageType.HELLO:
+                    compress = self._handle_hello(conn, write_lock, frame)
+                    continue
+                if frame.message_type != MessageType.REQUEST:
+                    write_log(f"Unexpected frame {frame} from {addr}", 3)
+                    break
+
+                codec: Codec = get_codec(frame.flags)
+                request: RpcRequest | None = request_from_frame(frame)
+                if not request:
+                    write_log("Invalid request received")
+                    break
 
-            if request:
                 write_log(f"Received request {request} from {addr}")
-                if request.function == RemoteFunctions.SAVE_KEY.value:
-                    return self._handle_receive_song(conn, addr, request)
+                cls: RequestClass = request_class(request.function)
+                if not self.admission.try_admit(cls):
+                    self._send_busy(conn, write_lock, request.request_id)
+                    continue
+                if cls == RequestClass.BULK:
+                    # The song body follows on this connection, so it is read here
+                    try:
+                        self._handle_receive_song(
+                            conn, write_lock, addr, request, codec
+                        )
+                    finally:
+                        self.admission.release(cls)
+                    continue
 
-                response: RpcResponse = self.handle_request(request, addr)
-                write_log(f"Sending response {response} to {addr}", 4)
-                conn.sendall(response.encode())
-            else:
-                write_log("Invalid request received")
+                # Requests on one connection are answered as soon as each one is
+                # done, the request id lets the peer match them
+                self.admission.submit(
+                    cls,
+                    self._respond,
+                    conn,
+                    write_lock,
+                    addr,
+                    request,
+                    codec,
+                    compress,
+                )
         except Exception as e:
             write_log(f"Error handling connection {e}", 3)
 
         finally:
             conn.close()
 
+    def run_request(
+        self, request: RpcRequest, addr: tuple[str, str]
+    ) -> RpcResponse | None:
+        """None when the sender stopped waiting while the request was queued"""
+        if request.expired:
+            write_log(f"Dropping {request} from {addr}, its deadline passed", 3)
+            return None
+        return self.handle_request(request, addr)
+
     def handle_request(self, request: RpcRequest, addr: tuple[str, str]) -> RpcResponse:
         request_node = RemoteNode(addr[0], request.sender_id)
+        get_peer_health(addr[0]).record_seen()
         self.node.update_finger_table(request_node)
 
         write_log(f"Received request {request} from {request_node}")
+        return self._dispatch(request, addr)
+
+    def _handle_batch(self, request: RpcRequest, addr: tuple[str, str]) -> list:
+        calls = request.arguments[0] if request.arguments else None
+        if not isinstance(calls, list):
+            write_log(f"Invalid batch {calls!r} from {addr}", 3)
+            return []
+        if len(calls) > MAX_BATCH_SIZE:
+            write_log(f"Batch of {len(calls)} calls is too large", 3)
+            return []
+
+        results: list = []
+        for call in calls:
+            try:
+                function, arguments = call
+                if function in (
+                    RemoteFunctions.BATCH.value,
+                    RemoteFunctions.SAVE_KEY.value,
+                ):
+                    write_log(f"{function} is not allowed inside a batch", 3)
+                    results.append(None)
+                    continue
+                response: RpcResponse | None = self._dispatch(
+                    RpcRequest(request.sender_id, function, arguments), addr
+                )
+            except Exception as e:
+                write_log(f"Error running {call!r} inside a batch: {e}", 3)
+                response = None
+            results.append(response.result if response else None)
+        return results
 
+    def _dispatch(self, request: RpcRequest, addr: tuple[str, str]) -> RpcResponse:
         if request.function == RemoteFunctions.PING.value:
             return RpcResponse(self.node.kademlia_interface.ping())
 
@@ -229,6 +476,16 @@ class NetworkInterface:
             song_key = SongKey.from_string(request.arguments[0])
             if song_key:
                 write_log("Song key valid", 6)
-            return RpcResponse(self.node.kademlia_interface.constains_song(song_key))
+            # Newer peers also send the hash of the audio they mean
+            audio_sha256: str | None = (
+                request.arguments[1] if len(request.arguments) > 1 else None
+            )
+            return RpcResponse(
+                self.node.kademlia_interface.constains_song(song_key, audio_sha256)
+            )
+
+        if request.function == RemoteFunctions.BATCH.value:
+            return RpcResponse(self._handle_batch(request, addr))
 
         write_log(f"Request Function invalid {request}")
+        return RpcResponse(None)
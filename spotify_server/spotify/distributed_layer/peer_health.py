@@ -0,0 +1,308 @@
+import random
+import threading
+import time
+from collections import deque
+from enum import Enum
+
+from ..logs import write_log
+
+# Consecutive failures that open the circuit of a peer
+FAILURE_THRESHOLD = 3
+# How long an open circuit fails fast, doubled every time it opens again
+OPEN_BASE_DELAY = 1.0
+OPEN_MAX_DELAY = 60.0
+# Backoff between the retries of a single call
+RETRY_BASE_DELAY = 0.05
+RETRY_MAX_DELAY = 1.0
+# Smoothing of the RTT estimators, the classic TCP gains
+RTT_ALPHA = 1 / 8
+RTT_BETA = 1 / 4
+RTT_VARIANCE_FACTOR = 4
+# Recent samples kept to answer latency percentiles
+RTT_WINDOW = 64
+# Derived timeouts stay between these bounds, the per call defaults are
+# stretched at most this many times for slow peers
+MIN_RPC_TIMEOUT = 0.2
+MAX_TIMEOUT_FACTOR = 4
+MIN_CONNECT_TIMEOUT = 0.25
+# Opening a connection is TCP, TLS and HELLO, a few round trips
+CONNECT_ROUND_TRIPS = 4
+# Assumed throughput for bulk transfers until one has been measured
+MIN_BULK_THROUGHPUT = 512 * 1024
+
+
+class CircuitState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+def backoff_delay(attempt: int, base: float, maximum: float) -> float:
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(maximum, base * 2**attempt))
+
+
+class RttEstimator:
+    """Smoothed round trip time and its variance, as TCP does it"""
+
+    def __init__(self):
+        self.srtt: float | None = None
+        self.rttvar: float = 0
+        self.samples: int = 0
+        self.recent: deque[float] = deque(maxlen=RTT_WINDOW)
+
+    def observe(self, sample: float) -> None:
+        self.recent.append(sample)
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = (1 - RTT_BETA) * self.rttvar + RTT_BETA * abs(
+                self.srtt - sample
+            )
+            self.srtt = (1 - RTT_ALPHA) * self.srtt + RTT_ALPHA * sample
+        self.samples += 1
+
+    def percentile(self, q: float) -> float | None:
+        if not self.recent:
+            return None
+        ordered: list[float] = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    @property
+    def rto(self) -> float | None:
+        if self.srtt is None:
+            return None
+        return self.srtt + RTT_VARIANCE_FACTOR * self.rttvar
+
+
+class PeerHealth:
+    """
+    Circuit breaker of one peer, shared by every call to it. After
+    FAILURE_THRESHOLD consecutive failures calls fail fast until the cool down
+    ends, then a single trial call decides if the circuit closes again.
+    """
+
+    def __init__(self, ip: str):
+        self.ip: str = ip
+        self.state: CircuitState = CircuitState.CLOSED
+        self.failures: int = 0
+        self.trips: int = 0
+        self.opened_at: float = 0
+        self.open_for: float = 0
+        self._trial_running: bool = False
+        # One estimator per remote function, their work differs a lot
+        self._rtt: dict[str, RttEstimator] = {}
+        self.throughput: float | None = None
+        # Wall clock times of the last sign of life and of the last failure
+        self.last_seen: float = 0
+        self.last_failed: float = 0
+        self._lock = threading.Lock()
+
+    def _cooled_down(self) -> bool:
+        return time.monotonic() - self.opened_at >= self.open_for
+
+    @property
+    def available(self) -> bool:
+        """Whether a call would be attempted, without taking the trial slot"""
+        with self._lock:
+            if self.state == CircuitState.CLOSED:
+                return True
+            if self.state == CircuitState.OPEN:
+                return self._cooled_down()
+            return not self._trial_running
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            if self.state == CircuitState.CLOSED:
+                return True
+            if self.state == CircuitState.OPEN:
+                if not self._cooled_down():
+                    return False
+                write_log(f"Circuit of {self.ip} is half open", 3)
+                self.state = CircuitState.HALF_OPEN
+                self._trial_running = False
+            if self._trial_running:
+                return False
+            self._trial_running = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state != CircuitState.CLOSED:
+                write_log(f"Circuit of {self.ip} is closed again", 3)
+            self.state = CircuitState.CLOSED
+            self.failures = 0
+            self.trips = 0
+            self._trial_running = False
+            self.last_seen = time.time()
+
+    def record_seen(self) -> None:
+        """The peer sent a request, it is alive but says nothing of its circuit"""
+        with self._lock:
+            self.last_seen = time.time()
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self.last_failed = time.time()
+            if (
+                self.state == CircuitState.HALF_OPEN
+                or self.failures >= FAILURE_THRESHOLD
+            ):
+                self.open_for = OPEN_BASE_DELAY + backoff_delay(
+                    self.trips, OPEN_BASE_DELAY, OPEN_MAX_DELAY
+                )
+                self.trips += 1
+                self.opened_at = time.monotonic()
+                self.state = CircuitState.OPEN
+                self._trial_running = False
+                write_log(f"Circuit of {self.ip} is open for {self.open_for:.2f}s", 3)
+
+    @property
+    def alive(self) -> bool:
+        """Whether the last news of the peer were good, unknown peers are alive"""
+        with self._lock:
+            return self.last_seen >= self.last_failed
+
+    @property
+    def last_checked(self) -> float:
+        with self._lock:
+            return max(self.last_seen, self.last_failed)
+
+    def release_trial(self) -> None:
+        """A trial call was abandoned before it could tell anything"""
+        with self._lock:
+            self._trial_running = False
+
+    def observe_rtt(self, function: str, seconds: float) -> None:
+        with self._lock:
+            self._rtt.setdefault(function, RttEstimator()).observe(seconds)
+
+    def observe_transfer(self, size: int, seconds: float) -> None:
+        if seconds <= 0:
+            return
+        sample: float = size / seconds
+        with self._lock:
+            self.throughput = (
+                sample
+                if self.throughput is None
+                else (1 - RTT_ALPHA) * self.throughput + RTT_ALPHA * sample
+            )
+
+    @property
+    def srtt(self) -> float | None:
+        """Best estimate of the network latency, the cheapest call seen"""
+        with self._lock:
+            estimates = [e.srtt for e in self._rtt.values() if e.srtt is not None]
+        return min(estimates) if estimates else None
+
+    def timeout(self, function: str, default: float) -> float:
+        """Read timeout for a call, default until the peer has been measured"""
+        with self._lock:
+            estimator: RttEstimator | None = self._rtt.get(function)
+            rto: float | None = estimator.rto if estimator else None
+        if rto is None:
+            return default
+        return min(default * MAX_TIMEOUT_FACTOR, max(MIN_RPC_TIMEOUT, rto))
+
+    def latency_percentile(self, function: str, q: float) -> float | None:
+        with self._lock:
+            estimator: RttEstimator | None = self._rtt.get(function)
+            return estimator.percentile(q) if estimator else None
+
+    def connect_timeout(self, default: float) -> float:
+        srtt: float | None = self.srtt
+        if srtt is None:
+            return default
+        return min(default, max(MIN_CONNECT_TIMEOUT, CONNECT_ROUND_TRIPS * srtt))
+
+    def bulk_timeout(self, function: str, size: int, default: float) -> float:
+        """Time to wait for a transfer of size bytes to be sent and stored"""
+        with self._lock:
+            throughput: float = max(self.throughput or 0, MIN_BULK_THROUGHPUT)
+        return self.timeout(function, default) + size / throughput
+
+    def to_dict(self) -> dict:
+        """What is worth keeping across restarts, the circuit starts closed"""
+        with self._lock:
+            return {
+                "last_seen": self.last_seen,
+                "last_failed": self.last_failed,
+                "throughput": self.throughput,
+                "rtt": {
+                    function: [e.srtt, e.rttvar, e.samples]
+                    for function, e in self._rtt.items()
+                    if e.srtt is not None
+                },
+            }
+
+    def restore(self, state: dict) -> None:
+        """
+        Loads a saved state, without overwriting what is already known. A
+        malformed state raises KeyError, TypeError or ValueError and changes
+        nothing.
+        """
+        last_seen: float = float(state["last_seen"])
+        last_failed: float = float(state["last_failed"])
+        throughput: float | None = (
+            float(state["throughput"]) if state["throughput"] is not None else None
+        )
+        estimators: dict[str, RttEstimator] = {}
+        for function, (srtt, rttvar, samples) in state["rtt"].items():
+            estimator = RttEstimator()
+            estimator.srtt, estimator.rttvar = float(srtt), float(rttvar)
+            estimator.samples = int(samples)
+            estimators[function] = estimator
+        with self._lock:
+            self.last_seen = max(self.last_seen, last_seen)
+            self.last_failed = max(self.last_failed, last_failed)
+            if self.throughput is None:
+                self.throughput = throughput
+            for function, estimator in estimators.items():
+                self._rtt.setdefault(function, estimator)
+
+    def __str__(self) -> str:
+        return f"PeerHealth({self.ip}, {self.state.value}, failures={self.failures})"
+
+
+class RetryBudget:
+    """Tries and time a single call may spend on one peer"""
+
+    def __init__(self, max_tries: int, time_budget: float | None = None):
+        self.max_tries: int = max_tries
+        self.tries: int = 0
+        self.deadline: float | None = (
+            time.monotonic() + time_budget if time_budget is not None else None
+        )
+
+    def next_delay(self) -> float | None:
+        """
+        Counts a failed try and returns how long to wait before the next one,
+        or None when the budget is spent
+        """
+        self.tries += 1
+        if self.tries >= self.max_tries:
+            return None
+        delay: float = backoff_delay(self.tries, RETRY_BASE_DELAY, RETRY_MAX_DELAY)
+        if self.deadline is not None and time.monotonic() + delay >= self.deadline:
+            return None
+        return delay
+
+
+_peers: dict[str, PeerHealth] = {}
+_peers_lock = threading.Lock()
+
+
+def get_peer_health(ip: str) -> PeerHealth:
+    health = _peers.get(ip)
+    if health is None:
+        with _peers_lock:
+            health = _peers.setdefault(ip, PeerHealth(ip))
+    return health
+
+
+def peer_rtt(ip: str) -> float:
+    """Smoothed RTT of a peer, unmeasured peers go after the measured ones"""
+    srtt: float | None = get_peer_health(ip).srtt
+    return srtt if srtt is not None else float("inf")
@@ -1,13 +1,60 @@
+import asyncio
 import socket
-import ssl
 import time
-from hashlib import sha256
 from enum import Enum
 
-from .rpc_message import RpcRequest, RpcResponse
+from .connection_pool import (
+    CONNECT_TIMEOUT,
+    AsyncConnectionPool,
+    AsyncPooledConnection,
+    ConnectionPool,
+    MultiplexedConnection,
+    PooledConnection,
+    get_async_pool,
+    get_multiplexed_connection,
+    get_pool,
+)
+from .rpc_message import (
+    FILE_CHUNK_SIZE,
+    Frame,
+    FrameError,
+    MessageType,
+    RpcRequest,
+    RpcResponse,
+    ServerBusyError,
+    aread_frame,
+    awrite_body,
+    awrite_chunks,
+    awrite_file_body,
+    awrite_frame,
+    encode_message,
+    iter_chunks,
+    read_frame,
+    response_from_frame,
+    write_body,
+    write_chunks,
+    write_file_body,
+    write_frame,
+)
+from .deadline import Deadline
+from .peer_health import PeerHealth, RetryBudget, get_peer_health
 from .song_dto import SongDto, SongMetadataDto
 from ..logs import write_log
 
+# A call never spends more than this many timeouts retrying the same peer
+CALL_BUDGET_TIMEOUTS = 2
+SAVE_KEY_TRIES = 3
+# The receiver checks its storage and reopens any partial transfer before it
+# answers a SAVE_KEY, which the latency of small calls says nothing about
+SAVE_KEY_TIMEOUT = 3
+# First answer to a SAVE_KEY when the receiver has the same song already
+SAVE_KEY_STORED = "stored"
+# Chunk size proposed for resumable song transfers, a broken transfer is resumed
+# after the last whole chunk the receiver stored
+TRANSFER_CHUNK_SIZE = FILE_CHUNK_SIZE
+BATCH_TIMEOUT = 2
+BATCH_TIMEOUT_PER_CALL = 0.01
+
 
 class RemoteFunctions(Enum):
     GET_KEYS_BY_QUERY = "get_keys_by_query"
@@ -17,6 +64,88 @@ class RemoteFunctions(Enum):
     GET_ALL_KEYS = "get_all_keys"
     GET_ALL_NODES = "get_nodes"
     CONSTAINS_KEY = "constains_key"
+    BATCH = "batch"
+
+
+class CallAttempts:
+    """
+    The tries of one call to a peer, for the blocking and the asyncio RPCs
+    alike: whether the peer's circuit lets them through, how every outcome
+    counts in its health and how long to wait before trying again.
+    """
+
+    def __init__(
+        self,
+        node: "RemoteNode",
+        request: RpcRequest,
+        max_tries: int,
+        time_budget: float | None = None,
+    ):
+        self.node: RemoteNode = node
+        self.request: RpcRequest = request
+        self.health: PeerHealth = get_peer_health(node.ip)
+        self.budget = RetryBudget(max_tries, time_budget)
+
+    def allowed(self) -> bool:
+        if self.health.allow_request():
+            return True
+        write_log(f"Skipping {self.request} to {self.node}, its circuit is open", 3)
+        return False
+
+    def answered(self, response: RpcResponse | None, started: float) -> RpcResponse:
+        """Records a valid answer, an invalid one fails the try"""
+        if response is None:
+            raise ValueError(f"Invalid response from {self.node}")
+        self.health.observe_rtt(self.request.function, time.monotonic() - started)
+        self.health.record_success()
+        return response
+
+    def abandon(self) -> None:
+        """The try stopped before it could tell anything of the peer"""
+        self.health.release_trial()
+
+    def failed(
+        self,
+        error: Exception,
+        reused: bool = False,
+        resumable: bool = False,
+        cut_short: bool = False,
+    ) -> float | None:
+        """
+        Counts a failed try and returns how long to wait before the next one,
+        or None to give up. reused is for tries over a pooled connection,
+        resumable for transfers the next try resumes and cut_short for tries
+        whose timeout a deadline shortened.
+        """
+        failed: bool = True
+        if isinstance(error, (socket.timeout, asyncio.TimeoutError)):
+            write_log(f"Timeout making request {self.request} to {self.node}", 3)
+            # Cut short by the deadline, the peer may well be healthy
+            failed = not cut_short
+        elif isinstance(error, ServerBusyError):
+            write_log(f"{self.node} is busy, retrying {self.request} later", 3)
+            # The peer answered, it is alive, just overloaded
+            failed = False
+        elif isinstance(error, ConnectionError):
+            write_log(
+                f"Connection error making {self.request} to {self.node} : {error}", 3
+            )
+            if not reused and not resumable:
+                self.health.record_failure()
+                return None
+            if not resumable:
+                # A pooled connection went stale, that says nothing of the peer
+                failed = False
+        else:
+            write_log(
+                f"Exception ocurred making {self.request} to {self.node} : {error}", 3
+            )
+
+        if failed:
+            self.health.record_failure()
+        else:
+            self.health.release_trial()
+        return self.budget.next_delay()
 
 
 class RemoteNode:
@@ -24,379 +153,589 @@ class RemoteNode:
         self.ip: str = ip
         self.id: int = node_id
 
-    def save_key(self, sender_id: int, song: SongDto, seed: bool = False):
-        tries: int = 0
-        while True:
+    def _exchange(self, conn: PooledConnection, request_id: int) -> RpcResponse | None:
+        frame: Frame | None = read_frame(conn.sock)
+        return self._response_from_frame(frame, request_id)
+
+    async def _aexchange(
+        self, conn: AsyncPooledConnection, request_id: int
+    ) -> RpcResponse | None:
+        frame: Frame | None = await aread_frame(conn.reader)
+        return self._response_from_frame(frame, request_id)
+
+    def _response_from_frame(
+        self, frame: Frame | None, request_id: int
+    ) -> RpcResponse | None:
+        if frame is None:
+            raise ConnectionResetError(f"{self} closed the connection")
+        if frame.request_id != request_id or frame.message_type not in (
+            MessageType.RESPONSE,
+            MessageType.ERROR,
+        ):
+            raise FrameError(f"Unexpected {frame} waiting for request {request_id}")
+        return response_from_frame(frame)
+
+    def _call(
+        self,
+        request: RpcRequest,
+        default_timeout: float,
+        max_tries: int,
+        log_type: int = 0,
+        timeout: float | None = None,
+    ) -> RpcResponse | None:
+        health: PeerHealth = get_peer_health(self.ip)
+        # The default is only used until the peer's latency is known
+        if timeout is None:
+            timeout = health.timeout(request.function, default_timeout)
+        connect_timeout: float = health.connect_timeout(CONNECT_TIMEOUT)
+        attempts = CallAttempts(
+            self, request, max_tries, timeout * CALL_BUDGET_TIMEOUTS
+        )
+        pool: ConnectionPool = get_pool(self.ip)
+        while attempts.allowed():
+            reused: bool = False
             try:
-                write_log("Trying to save key", 2)
-                context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-                context.check_hostname = False
-                context.load_verify_locations("./spotify/distributed_layer/cert.pem")
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                    with context.wrap_socket(sock, server_hostname=self.ip) as ssock:
-                        ssock.settimeout(3)
-
-                        port = ssock.getsockname()[1]
-                        request = RpcRequest(
-                            sender_id,
-                            RemoteFunctions.SAVE_KEY.value,
-                            [
-                                song.to_dict(),
-                                sha256(song.image.image_data).hexdigest(),
-                                sha256(song.audio_data).hexdigest(),
-                                seed,
-                            ],
-                        )
-                        write_log(f"Enconding request {request}", 1)
-                        ssock.connect((self.ip, 1729))
-                        write_log(f"Connected to remote node {self}", 1)
-                        ssock.sendall(request.encode())
-                        write_log("Sended request", 1)
-                        response = ssock.recv(8192)
-                        if response.decode() == "Ok":
-                            ssock.sendall(song.image.image_data)
-                            write_log(
-                                f"Imagen enviada con {len(song.image.image_data)} bytes y hash {sha256(song.image.image_data).hexdigest()}",
-                                1,
-                            )
-                            response_image: bytes = ssock.recv(8192)
-                            if response_image.decode() == "Img Ok":
-                                write_log("Confirmacion de envio de imagen recibida", 1)
-                                ssock.sendall(song.audio_data)
-                            else:
-                                write_log("Error enviando imagen", 1)
-                                break
-                        else:
-                            write_log("Error enviando cancion", 1)
-                            break
-
-                        write_log("Cancion enviada", 1)
-                        data: bytes = ssock.recv(8192)
-                        response: RpcResponse | None = RpcResponse.decode(data)
-                        write_log(
-                            f"Received response {response} to request save_key", 1
-                        )
-                        if response:
-                            return bool(response.result)
-
-            except socket.timeout:
-                write_log(f"Timeout making request {request} to {self}", 3)
-                tries += 1
-                time.sleep(0.00002)
-            except ConnectionError as error:
-                write_log(f"Connection error making {request} to {self} : {error}", 3)
-                break
+                with pool.connection(timeout, connect_timeout=connect_timeout) as conn:
+                    reused = conn.reused
+                    request_id: int = conn.next_request_id()
+                    write_log(
+                        f"Sending request {request} to {self} over {conn}", log_type
+                    )
+                    started: float = time.monotonic()
+                    write_frame(
+                        conn.sock,
+                        MessageType.REQUEST,
+                        request_id,
+                        *encode_message(request, conn.codec, conn.compress),
+                    )
+                    response: RpcResponse | None = self._exchange(conn, request_id)
+                    write_log(
+                        f"Received response {response} to request {request}", log_type
+                    )
+                    return attempts.answered(response, started)
             except Exception as e:
-                tries += 1
-                time.sleep(0.00002)
-                write_log(f"Exception ocurred making {request} to {self} : {e}", 3)
-
-            if tries > 2:
-                break
-
-        return False
-
-    def get_keys_by_query(
-        self, sender_id, search_by: str, query: str
-    ) -> list[SongMetadataDto] | None:
-        tries: int = 0
-        while True:
+                delay: float | None = attempts.failed(e, reused=reused)
+                if delay is None:
+                    break
+                time.sleep(delay)
+
+        return None
+
+    async def _acall(
+        self,
+        request: RpcRequest,
+        default_timeout: float,
+        max_tries: int,
+        log_type: int = 0,
+        timeout: float | None = None,
+        deadline: Deadline | None = None,
+    ) -> RpcResponse | None:
+        """
+        Calls share a single multiplexed connection to the peer. Cancelling the
+        awaiting task abandons the call without disturbing the others. An
+        explicit timeout overrides the one derived from the peer's latency, and
+        a deadline cuts every try and the retries down to the time left.
+        """
+        health: PeerHealth = get_peer_health(self.ip)
+        if timeout is None:
+            timeout = health.timeout(request.function, default_timeout)
+        connect_timeout: float = health.connect_timeout(CONNECT_TIMEOUT)
+        time_budget: float = timeout * CALL_BUDGET_TIMEOUTS
+        if deadline is not None:
+            time_budget = deadline.timeout(time_budget)
+        attempts = CallAttempts(self, request, max_tries, time_budget)
+        while attempts.allowed():
+            try_timeout: float = timeout
+            if deadline is not None:
+                if deadline.expired:
+                    write_log(f"Deadline of {request} to {self} expired", 3)
+                    attempts.abandon()
+                    break
+                try_timeout = deadline.timeout(timeout)
+                # The peer drops the request once this try stops waiting for it
+                request.deadline = try_timeout
+            reused: bool = False
             try:
-                context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-                context.check_hostname = False
-                context.load_verify_locations("./spotify/distributed_layer/cert.pem")
-                with socket.socket() as sock:
-                    with context.wrap_socket(sock, server_hostname=self.ip) as ssock:
-                        ssock.settimeout(3)
-
-                        port = ssock.getsockname()[1]
-                        request = RpcRequest(
-                            sender_id,
-                            RemoteFunctions.GET_KEYS_BY_QUERY.value,
-                            [search_by, query],
-                        )
-                        ssock.connect((self.ip, 1729))
-                        write_log(
-                            f"Connecting to ip: {self.ip} from address{port} sending request {request}",
-                            5,
-                        )
-                        ssock.sendall(request.encode())
-
-                        data: bytes = ssock.recv(8192)
-                        response: RpcResponse | None = RpcResponse.decode(data)
-                        write_log(f"Received response {response} to request", 5)
-                        if response:
-                            return [
-                                SongMetadataDto.from_dict(n) for n in response.result
-                            ]
-
-            except socket.timeout:
-                write_log(f"Timeout making request{request} to {self.ip}", 3)
-                tries += 1
-                time.sleep(0.00002)
-            except ConnectionError as e:
+                conn: MultiplexedConnection = await get_multiplexed_connection(
+                    self.ip, try_timeout, min(connect_timeout, try_timeout)
+                )
+                reused = conn.sent > 0
+                write_log(f"Sending request {request} to {self} over {conn}", log_type)
+                started: float = time.monotonic()
+                response: RpcResponse | None = await conn.call(request, try_timeout)
                 write_log(
-                    f"Connection error making request {request} to {self}: {e}", 3
+                    f"Received response {response} to request {request}", log_type
                 )
-                break
+                return attempts.answered(response, started)
+            except asyncio.CancelledError:
+                attempts.abandon()
+                raise
             except Exception as e:
-                write_log(f"Exception ocurred making {request} to {self} : {e}", 3)
-                tries += 1
-                time.sleep(0.00002)
+                delay: float | None = attempts.failed(
+                    e, reused=reused, cut_short=try_timeout < timeout
+                )
+                if delay is None:
+                    break
+                await asyncio.sleep(delay)
+
+        return None
+
+    def _save_key_request(
+        self, sender_id: int, song: SongDto, seed: bool
+    ) -> RpcRequest:
+        return RpcRequest(
+            sender_id,
+            RemoteFunctions.SAVE_KEY.value,
+            [
+                song.to_dict(),
+                song.image.image_hash,
+                song.audio_hash,
+                seed,
+                # Declared sizes let the receiver preallocate and verify early
+                song.image.image_size,
+                song.audio_size,
+                TRANSFER_CHUNK_SIZE,
+            ],
+        )
 
-            if tries > 2:
-                break
+    @staticmethod
+    def _resume_points(response: RpcResponse) -> dict | None:
+        """
+        Chunks the receiver already holds, {} for older peers that take the
+        whole payloads unchunked and None when it refused the song
+        """
+        if response.result == "Ok":
+            return {}
+        if isinstance(response.result, dict):
+            return response.result
+        return None
+
+    def _save_key_handshake(
+        self, attempts: CallAttempts, response: RpcResponse | None, started: float
+    ) -> dict | bool:
+        """
+        Where to resume each payload from, or the outcome of the whole
+        transfer when no payload has to be sent
+        """
+        response = attempts.answered(response, started)
+        if response.result == SAVE_KEY_STORED:
+            write_log(f"{self} already stores the song", 6)
+            return True
+        resume: dict | None = self._resume_points(response)
+        if resume is None:
+            write_log("Error enviando cancion", 1)
+            return False
+        return resume
 
-        return []
+    @staticmethod
+    def _save_key_answer_timeout(health: PeerHealth, song: SongDto) -> float:
+        """
+        The receiver verifies the digests of the whole payloads before it
+        answers, the chunks kept from an interrupted attempt included
+        """
+        return health.bulk_timeout(
+            RemoteFunctions.SAVE_KEY.value,
+            song.image.image_size + song.audio_size,
+            SAVE_KEY_TIMEOUT,
+        )
+
+    def _save_key_result(
+        self,
+        attempts: CallAttempts,
+        response: RpcResponse | None,
+        sent: int,
+        started: float,
+    ) -> bool:
+        if response is None:
+            raise ValueError(f"Invalid response from {self}")
+        attempts.health.observe_transfer(sent, time.monotonic() - started)
+        write_log(f"Received response {response} to request save_key", 1)
+        return bool(response.result)
 
-    def get_all_keys(self, sender_id: int) -> list[SongMetadataDto] | None:
-        tries: int = 0
-        while True:
+    @staticmethod
+    def _write_payload(
+        sock: socket.socket,
+        request_id: int,
+        data: bytes | None,
+        path: str | None,
+        first_chunk: int | None,
+    ) -> int:
+        if first_chunk is not None:
+            return write_chunks(
+                sock,
+                request_id,
+                iter_chunks(data, path, first_chunk, TRANSFER_CHUNK_SIZE),
+                first_chunk,
+            )
+        # Songs stored in MEDIA_ROOT go straight from their files to the socket
+        if path:
+            return write_file_body(sock, path, request_id)
+        return write_body(sock, request_id, data or b"")
+
+    @staticmethod
+    async def _awrite_payload(
+        writer: asyncio.StreamWriter,
+        request_id: int,
+        data: bytes | None,
+        path: str | None,
+        first_chunk: int | None,
+    ) -> int:
+        if first_chunk is not None:
+            return await awrite_chunks(
+                writer,
+                request_id,
+                iter_chunks(data, path, first_chunk, TRANSFER_CHUNK_SIZE),
+                first_chunk,
+            )
+        if path:
+            return await awrite_file_body(writer, path, request_id)
+        return await awrite_body(writer, request_id, data or b"")
+
+    def save_key(self, sender_id: int, song: SongDto, seed: bool = False):
+        request: RpcRequest = self._save_key_request(sender_id, song, seed)
+        attempts = CallAttempts(self, request, SAVE_KEY_TRIES)
+        health: PeerHealth = attempts.health
+        while attempts.allowed():
+            reused: bool = False
+            # Once the payloads flow a broken connection is retried, the next
+            # try resumes where this one stopped
+            transferring: bool = False
             try:
-                context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-                context.check_hostname = False
-                context.load_verify_locations("./spotify/distributed_layer/cert.pem")
-                with socket.socket() as sock:
-                    with context.wrap_socket(sock, server_hostname=self.ip) as ssock:
-
-                        ssock.settimeout(2)
-                        port = ssock.getsockname()[1]
-                        request = RpcRequest(
-                            sender_id,
-                            RemoteFunctions.GET_ALL_KEYS.value,
-                            [],
-                        )
-                        ssock.connect((self.ip, 1729))
-                        write_log(
-                            f"Trying to connect to ip: {self.ip} from address{port} sending request {request}",
-                            4,
-                        )
-                        ssock.sendall(request.encode())
-                        write_log("Sended request get all keys", 4)
-
-                        data: bytes = ssock.recv(8192)
-                        write_log(f"Received data {data}", 4)
-                        response: RpcResponse | None = RpcResponse.decode(data)
-                        write_log(f"Received response {response} to request", 4)
-                        if response:
-                            return [
-                                SongMetadataDto.from_dict(n) for n in response.result
-                            ]
-
-            except socket.timeout:
-                write_log(f"Timeout making request{request} to {self.ip}", 3)
-                tries += 1
-                time.sleep(0.00002)
-            except ConnectionError as e:
-                write_log(str(e), 3)
-                break
+                write_log("Trying to save key", 2)
+                with get_pool(self.ip).connection(
+                    SAVE_KEY_TIMEOUT,
+                    connect_timeout=health.connect_timeout(CONNECT_TIMEOUT),
+                ) as conn:
+                    write_log(f"Connected to remote node {self}", 1)
+                    reused = conn.reused
+                    request_id: int = conn.next_request_id()
+                    started: float = time.monotonic()
+                    write_frame(
+                        conn.sock,
+                        MessageType.REQUEST,
+                        request_id,
+                        *encode_message(request, conn.codec, conn.compress),
+                    )
+                    write_log("Sended request", 1)
+                    resume: dict | bool = self._save_key_handshake(
+                        attempts, self._exchange(conn, request_id), started
+                    )
+                    if not isinstance(resume, dict):
+                        return resume
+
+                    transferring = True
+                    sent: int = self._write_payload(
+                        conn.sock,
+                        request_id,
+                        song.image.image_data,
+                        song.image.image_path,
+                        resume.get("image"),
+                    )
+                    write_log(
+                        f"Imagen enviada con {sent} bytes y hash {request.arguments[1]}",
+                        1,
+                    )
+                    audio_sent: int = self._write_payload(
+                        conn.sock,
+                        request_id,
+                        song.audio_data,
+                        song.audio_path,
+                        resume.get("audio"),
+                    )
+                    write_log(f"Cancion enviada con {audio_sent} bytes", 1)
+                    sent += audio_sent
+
+                    # Storing the song on the other side takes longer the bigger it is
+                    conn.sock.settimeout(self._save_key_answer_timeout(health, song))
+                    return self._save_key_result(
+                        attempts, self._exchange(conn, request_id), sent, started
+                    )
             except Exception as e:
-                write_log(str(e), 3)
-                tries += 1
-                time.sleep(0.00002)
-
-            if tries > 10:
-                break
+                delay: float | None = attempts.failed(
+                    e, reused=reused, resumable=transferring
+                )
+                if delay is None:
+                    break
+                time.sleep(delay)
 
-        return []
+        return False
 
-    def get_nears_node(
-        self, sender_id: int, target_id: int
-    ) -> list["RemoteNode"] | None:
-        tries: int = 0
-        while True:
+    async def asave_key(self, sender_id: int, song: SongDto, seed: bool = False):
+        request: RpcRequest = self._save_key_request(sender_id, song, seed)
+        attempts = CallAttempts(self, request, SAVE_KEY_TRIES)
+        health: PeerHealth = attempts.health
+        while attempts.allowed():
+            reused: bool = False
+            transferring: bool = False
             try:
-                context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-                context.check_hostname = False
-                context.load_verify_locations("./spotify/distributed_layer/cert.pem")
-                with socket.socket() as sock:
-                    with context.wrap_socket(sock, server_hostname=self.ip) as ssock:
-
-                        ssock.settimeout(2)
-                        port = ssock.getsockname()[1]
-                        request = RpcRequest(
-                            sender_id,
-                            RemoteFunctions.GET_NEARS_NODE.value,
-                            [target_id],
-                        )
-                        ssock.connect((self.ip, 1729))
-                        write_log(
-                            f"Trying to connect to ip: {self.ip} from address{port} sending request {request}"
-                        )
-                        ssock.sendall(request.encode())
-
-                        data: bytes = ssock.recv(8192)
-                        response: RpcResponse | None = RpcResponse.decode(data)
-                        write_log(f"Received response {response} to request")
-                        if response:
-                            return [RemoteNode.from_dict(n) for n in response.result]
-
-                        return None
-
-            except socket.timeout:
-                write_log(f"Timeout making request{request} to {self.ip}")
-                tries += 1
-                time.sleep(0.00002)
-
-            except ConnectionError as e:
-                write_log(str(e))
-                break
-
+                write_log("Trying to save key", 2)
+                async with get_async_pool(self.ip).connection(
+                    SAVE_KEY_TIMEOUT,
+                    connect_timeout=health.connect_timeout(CONNECT_TIMEOUT),
+                ) as conn:
+                    reused = conn.reused
+                    request_id: int = conn.next_request_id()
+                    started: float = time.monotonic()
+                    await awrite_frame(
+                        conn.writer,
+                        MessageType.REQUEST,
+                        request_id,
+                        *encode_message(request, conn.codec, conn.compress),
+                    )
+                    resume: dict | bool = self._save_key_handshake(
+                        attempts,
+                        await asyncio.wait_for(
+                            self._aexchange(conn, request_id), SAVE_KEY_TIMEOUT
+                        ),
+                        started,
+                    )
+                    if not isinstance(resume, dict):
+                        return resume
+
+                    transferring = True
+                    sent: int = await self._awrite_payload(
+                        conn.writer,
+                        request_id,
+                        song.image.image_data,
+                        song.image.image_path,
+                        resume.get("image"),
+                    )
+                    write_log(f"Imagen enviada con {sent} bytes", 1)
+                    audio_sent: int = await self._awrite_payload(
+                        conn.writer,
+                        request_id,
+                        song.audio_data,
+                        song.audio_path,
+                        resume.get("audio"),
+                    )
+                    write_log(f"Cancion enviada con {audio_sent} bytes", 1)
+                    sent += audio_sent
+
+                    response: RpcResponse | None = await asyncio.wait_for(
+                        self._aexchange(conn, request_id),
+                        self._save_key_answer_timeout(health, song),
+                    )
+                    return self._save_key_result(attempts, response, sent, started)
+            except asyncio.CancelledError:
+                attempts.abandon()
+                raise
             except Exception as e:
-                write_log(str(e))
-                tries += 1
-                time.sleep(0.00002)
+                delay: float | None = attempts.failed(
+                    e, reused=reused, resumable=transferring
+                )
+                if delay is None:
+                    break
+                await asyncio.sleep(delay)
 
-            if tries > 10:
-                break
+        return False
 
+    @staticmethod
+    def _songs_result(response: RpcResponse | None) -> list[SongMetadataDto]:
+        if response:
+            return [SongMetadataDto.from_dict(n) for n in response.result]
         return []
 
-    def ping(self, sender_id: int) -> tuple[bool, int | None]:
-        tries: int = 0
-        while True:
-            try:
-                context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-                context.check_hostname = False
-                context.load_verify_locations("./spotify/distributed_layer/cert.pem")
-                with socket.socket() as sock:
-                    with context.wrap_socket(sock, server_hostname=self.ip) as ssock:
-
-                        ssock.settimeout(1)
-                        port = ssock.getsockname()[1]
-                        request = RpcRequest(
-                            sender_id,
-                            RemoteFunctions.PING.value,
-                            [],
-                        )
-                        ssock.connect((self.ip, 1729))
-                        write_log(
-                            f"Trying to connect to ip: {self.ip} from address{port} sending request {request}"
-                        )
-                        ssock.sendall(request.encode())
-
-                        data: bytes = ssock.recv(8192)
-                        response: RpcResponse | None = RpcResponse.decode(data)
-                        write_log(f"Received response {response} to request")
-                        if response:
-                            return response.result[0], response.result[1]
-
-                        return False, None
-
-            except socket.timeout:
-                write_log(f"Timeout making request{request} to {self.ip}")
-            except ConnectionError as e:
-                write_log(str(e))
-                break
-            except Exception as e:
-                write_log(str(e))
-                tries += 1
-                time.sleep(0.00002)
-
-            if tries > 10:
-                break
+    @staticmethod
+    def _nodes_result(response: RpcResponse | None) -> list["RemoteNode"]:
+        if response:
+            return [RemoteNode.from_dict(n) for n in response.result]
+        return []
 
+    @staticmethod
+    def _ping_result(response: RpcResponse | None) -> tuple[bool, int | None]:
+        if response:
+            return response.result[0], response.result[1]
         return False, None
 
-    def get_all_nodes(self) -> list["RemoteNode"] | None:
-        tries: int = 0
-        while True:
-            try:
-                context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-                context.check_hostname = False
-                context.load_verify_locations("./spotify/distributed_layer/cert.pem")
-                with socket.socket() as sock:
-                    with context.wrap_socket(sock, server_hostname=self.ip) as ssock:
-
-                        ssock.settimeout(2)
-                        port = ssock.getsockname()[1]
-                        request = RpcRequest(
-                            self.id,
-                            RemoteFunctions.GET_ALL_NODES,
-                            [],
-                        )
-
-                        ssock.connect((self.ip, 1729))
-                        write_log(
-                            f"Trying to connect to ip: {self.ip} from address{port} sending request {request}"
-                        )
-                        ssock.sendall(request.encode())
-
-                        data: bytes = ssock.recv(8192)
-                        response: RpcResponse | None = RpcResponse.decode(data)
-                        write_log(f"Received response {response} to request")
-                        if response:
-                            return [RemoteNode.from_dict(n) for n in response.result]
-
-                        return []
-            except socket.timeout:
-                write_log(f"Timeout making request{request} to {self.ip}")
-                tries += 1
-                time.sleep(0.00002)
-            except ConnectionError as e:
-                write_log(str(e))
-                break
-            except Exception as e:
-                write_log(str(e))
-                tries += 1
-                time.sleep(0.00002)
+    def get_keys_by_query(
+        self, sender_id, search_by: str, query: str
+    ) -> list[SongMetadataDto] | None:
+        request = RpcRequest(
+            sender_id, RemoteFunctions.GET_KEYS_BY_QUERY.value, [search_by, query]
+        )
+        return self._songs_result(self._call(request, 3, 3, 5))
+
+    async def aget_keys_by_query(
+        self,
+        sender_id,
+        search_by: str,
+        query: str,
+        timeout: float | None = None,
+        deadline: Deadline | None = None,
+    ) -> list[SongMetadataDto] | None:
+        request = RpcRequest(
+            sender_id, RemoteFunctions.GET_KEYS_BY_QUERY.value, [search_by, query]
+        )
+        return self._songs_result(
+            await self._acall(request, 3, 3, 5, timeout=timeout, deadline=deadline)
+        )
 
-            if tries > 10:
-                break
+    def get_all_keys(self, sender_id: int) -> list[SongMetadataDto] | None:
+        request = RpcRequest(sender_id, RemoteFunctions.GET_ALL_KEYS.value, [])
+        return self._songs_result(self._call(request, 2, 3, 4))
+
+    async def aget_all_keys(
+        self,
+        sender_id: int,
+        timeout: float | None = None,
+        deadline: Deadline | None = None,
+    ) -> list[SongMetadataDto] | None:
+        request = RpcRequest(sender_id, RemoteFunctions.GET_ALL_KEYS.value, [])
+        return self._songs_result(
+            await self._acall(request, 2, 3, 4, timeout=timeout, deadline=deadline)
+        )
 
-        return []
+    def get_nears_node(
+        self, sender_id: int, target_id: int
+    ) -> list["RemoteNode"] | None:
+        request = RpcRequest(
+            sender_id, RemoteFunctions.GET_NEARS_NODE.value, [target_id]
+        )
+        return self._nodes_result(self._call(request, 2, 3))
+
+    async def aget_nears_node(
+        self,
+        sender_id: int,
+        target_id: int,
+        timeout: float | None = None,
+        deadline: Deadline | None = None,
+    ) -> list["RemoteNode"] | None:
+        request = RpcRequest(
+            sender_id, RemoteFunctions.GET_NEARS_NODE.value, [target_id]
+        )
+        response: RpcResponse | None = await self._acall(
+            request, 2, 3, timeout=timeout, deadline=deadline
+        )
+        # None tells a peer that failed apart from one that knows no other nodes
+        return self._nodes_result(response) if response else None
 
-    def constains_key(self, key: int, sender_id: int) -> bool:
-        tries: int = 0
-        while True:
-            try:
-                write_log(f"Sending request to check if key is in node {self}", 6)
-                context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-                context.check_hostname = False
-                context.load_verify_locations("./spotify/distributed_layer/cert.pem")
-                with socket.socket() as sock:
-                    with context.wrap_socket(sock, server_hostname=self.ip) as ssock:
-
-                        ssock.settimeout(1)
-                        port = ssock.getsockname()[1]
-                        request = RpcRequest(
-                            sender_id,
-                            RemoteFunctions.CONSTAINS_KEY.value,
-                            [key],
-                        )
-                        ssock.connect((self.ip, 1729))
-                        write_log(
-                            f"Trying to connect to ip: {self.ip} from address{port} sending request {request}",
-                            6,
-                        )
-                        ssock.sendall(request.encode())
-
-                        data: bytes = ssock.recv(8192)
-                        response: RpcResponse | None = RpcResponse.decode(data)
-                        write_log(
-                            f"Received response {response} to request {request} to node {self}",
-                            6,
-                        )
-                        if response:
-                            return response.result
-
-                        return False
-
-            except socket.timeout:
-                write_log(f"Timeout making request{request} to {self.ip}")
-                break
-            except ConnectionError as e:
-                write_log(str(e))
-                break
-            except Exception as e:
-                write_log(str(e))
-                tries += 1
-                time.sleep(0.00002)
+    def ping(self, sender_id: int) -> tuple[bool, int | None]:
+        request = RpcRequest(sender_id, RemoteFunctions.PING.value, [])
+        return self._ping_result(self._call(request, 1, 2))
+
+    async def aping(
+        self,
+        sender_id: int,
+        timeout: float | None = None,
+        deadline: Deadline | None = None,
+    ) -> tuple[bool, int | None]:
+        request = RpcRequest(sender_id, RemoteFunctions.PING.value, [])
+        return self._ping_result(
+            await self._acall(request, 1, 2, timeout=timeout, deadline=deadline)
+        )
+
+    def get_all_nodes(self, sender_id: int) -> list["RemoteNode"] | None:
+        request = RpcRequest(sender_id, RemoteFunctions.GET_ALL_NODES.value, [])
+        return self._nodes_result(self._call(request, 2, 3, 4))
+
+    async def aget_all_nodes(
+        self,
+        sender_id: int,
+        timeout: float | None = None,
+        deadline: Deadline | None = None,
+    ) -> list["RemoteNode"] | None:
+        request = RpcRequest(sender_id, RemoteFunctions.GET_ALL_NODES.value, [])
+        return self._nodes_result(
+            await self._acall(request, 2, 3, 4, timeout=timeout, deadline=deadline)
+        )
 
-            if tries > 10:
-                break
+    @staticmethod
+    def _constains_key_arguments(key: str, audio_sha256: str | None) -> list:
+        return [key] if audio_sha256 is None else [key, audio_sha256]
+
+    def constains_key(
+        self, key: str, sender_id: int, audio_sha256: str | None = None
+    ) -> bool:
+        """With a hash, only a song with that same audio counts"""
+        write_log(f"Sending request to check if key is in node {self}", 6)
+        request = RpcRequest(
+            sender_id,
+            RemoteFunctions.CONSTAINS_KEY.value,
+            self._constains_key_arguments(key, audio_sha256),
+        )
+        response: RpcResponse | None = self._call(request, 1, 1, 6)
+        return bool(response.result) if response else False
+
+    async def aconstains_key(
+        self,
+        key: str,
+        sender_id: int,
+        audio_sha256: str | None = None,
+        timeout: float | None = None,
+        deadline: Deadline | None = None,
+    ) -> bool:
+        write_log(f"Sending request to check if key is in node {self}", 6)
+        request = RpcRequest(
+            sender_id,
+            RemoteFunctions.CONSTAINS_KEY.value,
+            self._constains_key_arguments(key, audio_sha256),
+        )
+        response: RpcResponse | None = await self._acall(
+            request, 1, 1, 6, timeout=timeout, deadline=deadline
+        )
+        return bool(response.result) if response else False
+
+    def _batch_request(
+        self, sender_id: int, calls: list[tuple[RemoteFunctions, list]]
+    ) -> RpcRequest:
+        return RpcRequest(
+            sender_id,
+            RemoteFunctions.BATCH.value,
+            [[[function.value, arguments] for function, arguments in calls]],
+        )
 
-        return False
+    @staticmethod
+    def _batch_result(response: RpcResponse | None, size: int) -> list | None:
+        if response and isinstance(response.result, list):
+            if len(response.result) == size:
+                return response.result
+        return None
+
+    def batch(
+        self, sender_id: int, calls: list[tuple[RemoteFunctions, list]]
+    ) -> list | None:
+        """
+        Runs several calls in a single round-trip and returns their raw
+        results in order, or None if the batch itself failed
+        """
+        request: RpcRequest = self._batch_request(sender_id, calls)
+        # Batches vary in size too much for a latency estimate to fit them all
+        timeout: float = BATCH_TIMEOUT + BATCH_TIMEOUT_PER_CALL * len(calls)
+        return self._batch_result(
+            self._call(request, timeout, 3, timeout=timeout), len(calls)
+        )
+
+    async def abatch(
+        self, sender_id: int, calls: list[tuple[RemoteFunctions, list]]
+    ) -> list | None:
+        request: RpcRequest = self._batch_request(sender_id, calls)
+        timeout: float = BATCH_TIMEOUT + BATCH_TIMEOUT_PER_CALL * len(calls)
+        return self._batch_result(
+            await self._acall(request, timeout, 3, timeout=timeout), len(calls)
+        )
+
+    def constains_keys(self, keys: list[str], sender_id: int) -> list[bool]:
+        results: list | None = self.batch(
+            sender_id, [(RemoteFunctions.CONSTAINS_KEY, [key]) for key in keys]
+        )
+        return [bool(r) for r in results] if results else [False] * len(keys)
+
+    async def aconstains_keys(self, keys: list[str], sender_id: int) -> list[bool]:
+        results: list | None = await self.abatch(
+            sender_id, [(RemoteFunctions.CONSTAINS_KEY, [key]) for key in keys]
+        )
+        return [bool(r) for r in results] if results else [False] * len(keys)
+
+    async def aget_nears_nodes(
+        self, sender_id: int, target_ids: list[int]
+    ) -> list[list["RemoteNode"]]:
+        results: list | None = await self.abatch(
+            sender_id,
+            [(RemoteFunctions.GET_NEARS_NODE, [target]) for target in target_ids],
+        )
+        if not results:
+            return [[] for _ in target_ids]
+        return [[RemoteNode.from_dict(n) for n in result or []] for result in results]
 
     def __eq__(self, other):
         return isinstance(other, RemoteNode) and self.id == other.id
@@ -0,0 +1,94 @@
+import os
+import time
+import zlib
+
+from .peer_health import get_peer_health
+from .remote_node import RemoteNode
+from .rpc_message import BINARY_CODEC
+from .song_dto import SongKey
+
+from ..logs import write_log
+
+CHECKPOINT_PATH = os.getenv("DHT_CHECKPOINT_PATH", "./dht_checkpoint.bin")
+# Seconds between two checkpoints of the routing table
+CHECKPOINT_INTERVAL = float(os.getenv("DHT_CHECKPOINT_INTERVAL", "30"))
+# Nodes not seen for this long before the checkpoint are not restored
+CHECKPOINT_MAX_AGE = 24 * 60 * 60
+CHECKPOINT_VERSION = 1
+
+
+class RoutingCheckpoint:
+    """
+    The routing table, the health of its peers and the seeds of a node, so a
+    restarted node can serve lookups right away instead of discovering the
+    network again. Stored with the binary codec and zlib, written atomically.
+    """
+
+    def __init__(self, nodes: list[RemoteNode], seeds: set[SongKey]):
+        self.nodes: list[RemoteNode] = nodes
+        self.seeds: set[SongKey] = seeds
+
+    def save(self, path: str = CHECKPOINT_PATH) -> int:
+        """Returns the size of the checkpoint in bytes"""
+        state: dict = {
+            "version": CHECKPOINT_VERSION,
+            "saved_at": time.time(),
+            # Least recently seen first, reloading them keeps the bucket order
+            "nodes": [
+                {"id": n.id, "ip": n.ip, **get_peer_health(n.ip).to_dict()}
+                for n in self.nodes
+            ],
+            "seeds": [[song.title, song.artist] for song in self.seeds],
+        }
+        data: bytes = zlib.compress(BINARY_CODEC.dumps(state))
+        temporary: str = f"{path}.tmp"
+        with open(temporary, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, path)
+        write_log(
+            f"Checkpoint of {len(self.nodes)} nodes and {len(self.seeds)} seeds "
+            f"saved in {len(data)} bytes"
+        )
+        return len(data)
+
+    @staticmethod
+    def load(path: str = CHECKPOINT_PATH) -> "RoutingCheckpoint | None":
+        """
+        Restores the health of the saved peers and returns the checkpoint, or
+        None when there is none or it cannot be read
+        """
+        try:
+            with open(path, "rb") as file:
+                state: dict = BINARY_CODEC.loads(zlib.decompress(file.read()))
+        except FileNotFoundError:
+            return None
+        except (OSError, zlib.error, ValueError, IndexError) as e:
+            write_log(f"Ignoring unreadable checkpoint {path}: {e}", 3)
+            return None
+        if not isinstance(state, dict) or state.get("version") != CHECKPOINT_VERSION:
+            write_log(f"Ignoring checkpoint {path} of another version", 3)
+            return None
+
+        try:
+            oldest: float = state["saved_at"] - CHECKPOINT_MAX_AGE
+            entries: list[dict] = [
+                entry for entry in state["nodes"] if entry["last_seen"] >= oldest
+            ]
+            nodes: list[RemoteNode] = [
+                RemoteNode(str(entry["ip"]), int(entry["id"])) for entry in entries
+            ]
+            seeds: set[SongKey] = {
+                SongKey(title, artist) for title, artist in state["seeds"]
+            }
+            for entry in entries:
+                get_peer_health(entry["ip"]).restore(entry)
+        except (KeyError, TypeError, ValueError) as e:
+            write_log(f"Ignoring unreadable checkpoint {path}: {e!r}", 3)
+            return None
+        write_log(
+            f"Restored {len(nodes)} nodes and {len(seeds)} seeds from {path}, "
+            f"saved {time.time() - state['saved_at']:.0f}s ago"
+        )
+        return RoutingCheckpoint(nodes, seeds)
@@ -1,44 +1,511 @@
+import asyncio
 import json
+import math
+import os
+import socket
+import ssl
+import struct
+import time
+import zlib
 from abc import ABC, abstractmethod
+from collections.abc import Callable, Iterable, Iterator
+from enum import IntEnum
+
+# type, flags, request id, body length
+FRAME_HEADER = struct.Struct("!BBII")
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+BODY_CHUNK_SIZE = 256 * 1024
+# Files are pushed in bigger frames, fewer syscalls and TLS records per song
+FILE_CHUNK_SIZE = 1024 * 1024
+# Resumable transfers prefix the data of every DATA frame with the chunk
+# index and the crc32 of the chunk
+CHUNK_HEADER = struct.Struct("!II")
+# The low bits of the frame flags say which codec encoded the body
+FLAG_CODEC_MASK = 0x03
+# Set when the encoded body was compressed with zlib
+FLAG_COMPRESSED = 0x04
+COMPRESSION = "zlib"
+# Offered in HELLO unless disabled, bodies smaller than the threshold (pings,
+# lookups) are never worth compressing
+COMPRESSION_ENABLED = os.getenv("DHT_COMPRESSION", "1") == "1"
+COMPRESSION_THRESHOLD = int(os.getenv("DHT_COMPRESSION_THRESHOLD", str(4 * 1024)))
+COMPRESSION_LEVEL = int(os.getenv("DHT_COMPRESSION_LEVEL", "1"))
+
+
+class MessageType(IntEnum):
+    REQUEST = 1
+    RESPONSE = 2
+    DATA = 3
+    DATA_END = 4
+    ERROR = 5
+    HELLO = 6
+
+
+class FrameError(Exception):
+    pass
+
+
+class CodecError(ValueError):
+    pass
+
+
+class ServerBusyError(Exception):
+    """The peer was overloaded and rejected the request without running it"""
+
+
+# Body of the ERROR frame a server answers with when it sheds load
+BUSY = b"busy"
+
+
+class Codec(ABC):
+    name: str
+    codec_id: int
+
+    @abstractmethod
+    def dumps(self, value) -> bytes:
+        pass
+
+    @abstractmethod
+    def loads(self, data: bytes):
+        pass
+
+
+class JsonCodec(Codec):
+    name = "json"
+    codec_id = 0
+
+    def dumps(self, value) -> bytes:
+        return json.dumps(value).encode()
+
+    def loads(self, data: bytes):
+        return json.loads(data.decode())
+
+
+class BinaryCodec(Codec):
+    """
+    Compact tagged encoding. 160-bit ids take 20 fixed bytes, strings are
+    length prefixed, common dict keys are sent as a one byte reference, lists
+    of nodes are packed as (id, ipv4) pairs and lists of dicts sharing the
+    same keys (e.g. song metadata) write their keys only once.
+    """
+
+    name = "binary"
+    codec_id = 1
+
+    NONE = 0
+    TRUE = 1
+    FALSE = 2
+    INT = 3
+    ID160 = 4
+    BIGINT = 5
+    FLOAT = 6
+    STR = 7
+    BYTES = 8
+    LIST = 9
+    DICT = 10
+    KEY = 11
+    TABLE = 12
+    NODE_LIST = 13
+
+    KEYS: tuple[str, ...] = (
+        "id",
+        "ip",
+        "function",
+        "arguments",
+        "result",
+        "title",
+        "artist",
+        "album",
+        "genre",
+        "duration",
+        "size",
+        "image",
+        "image_data",
+        "file_extension",
+        "audio_data",
+    )
+    _KEY_INDEX: dict[str, int] = {key: i for i, key in enumerate(KEYS)}
+    _NODE_KEYS = frozenset(("id", "ip"))
+
+    _INT = struct.Struct("!q")
+    _FLOAT = struct.Struct("!d")
+
+    def __init__(self):
+        self._readers: list = [None] * 256
+        self._readers[self.NONE] = lambda _, offset: (None, offset)
+        self._readers[self.TRUE] = lambda _, offset: (True, offset)
+        self._readers[self.FALSE] = lambda _, offset: (False, offset)
+        self._readers[self.INT] = self._read_int
+        self._readers[self.ID160] = self._read_id
+        self._readers[self.BIGINT] = self._read_bigint
+        self._readers[self.FLOAT] = self._read_float
+        self._readers[self.STR] = self._read_str
+        self._readers[self.BYTES] = self._read_bytes
+        self._readers[self.LIST] = self._read_list
+        self._readers[self.DICT] = self._read_dict
+        self._readers[self.TABLE] = self._read_table
+        self._readers[self.NODE_LIST] = self._read_nodes
+
+    def dumps(self, value) -> bytes:
+        out = bytearray()
+        self._write(out, value)
+        return bytes(out)
+
+    def loads(self, data: bytes):
+        try:
+            value, offset = self._read(bytes(data), 0)
+        except (IndexError, OSError, struct.error, UnicodeDecodeError) as e:
+            raise CodecError(f"Malformed binary message: {e}") from e
+        if offset != len(data):
+            raise CodecError("Trailing bytes after binary message")
+        return value
+
+    @staticmethod
+    def _write_varint(out: bytearray, value: int) -> None:
+        while value > 0x7F:
+            out.append((value & 0x7F) | 0x80)
+            value >>= 7
+        out.append(value)
+
+    @staticmethod
+    def _read_varint(data: bytes, offset: int) -> tuple[int, int]:
+        if data[offset] < 0x80:
+            return data[offset], offset + 1
+        value = shift = 0
+        while True:
+            byte = data[offset]
+            offset += 1
+            value |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return value, offset
+            shift += 7
+
+    def _write_str(self, out: bytearray, value: str) -> None:
+        encoded = value.encode()
+        self._write_varint(out, len(encoded))
+        out += encoded
+
+    def _read_str(self, data: bytes, offset: int) -> tuple[str, int]:
+        length, offset = self._read_varint(data, offset)
+        end = offset + length
+        if end > len(data):
+            raise CodecError("Truncated string")
+        return data[offset:end].decode(), end
+
+    def _write_key(self, out: bytearray, key: str) -> None:
+        index = self._KEY_INDEX.get(key)
+        if index is None:
+            out.append(self.STR)
+            self._write_str(out, key)
+        else:
+            out.append(self.KEY)
+            out.append(index)
+
+    def _read_key(self, data: bytes, offset: int) -> tuple[str, int]:
+        tag = data[offset]
+        if tag == self.KEY:
+            return self.KEYS[data[offset + 1]], offset + 2
+        if tag == self.STR:
+            return self._read_str(data, offset + 1)
+        raise CodecError(f"Invalid key tag {tag}")
+
+    def _write(self, out: bytearray, value) -> None:
+        if value is None:
+            out.append(self.NONE)
+        elif value is True:
+            out.append(self.TRUE)
+        elif value is False:
+            out.append(self.FALSE)
+        elif isinstance(value, int):
+            if -(1 << 63) <= value < (1 << 63):
+                out.append(self.INT)
+                out += self._INT.pack(value)
+            elif 0 <= value < (1 << 160):
+                out.append(self.ID160)
+                out += value.to_bytes(20, "big")
+            else:
+                raw = value.to_bytes((value.bit_length() + 8) // 8, "big", signed=True)
+                out.append(self.BIGINT)
+                self._write_varint(out, len(raw))
+                out += raw
+        elif isinstance(value, float):
+            out.append(self.FLOAT)
+            out += self._FLOAT.pack(value)
+        elif isinstance(value, str):
+            out.append(self.STR)
+            self._write_str(out, value)
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            out.append(self.BYTES)
+            self._write_varint(out, len(value))
+            out += value
+        elif isinstance(value, dict):
+            out.append(self.DICT)
+            self._write_varint(out, len(value))
+            for key, item in value.items():
+                self._write_key(out, str(key))
+                self._write(out, item)
+        elif isinstance(value, (list, tuple)):
+            self._write_sequence(out, value)
+        else:
+            raise CodecError(f"Cannot encode value of type {type(value)}")
+
+    def _write_sequence(self, out: bytearray, values) -> None:
+        if values and all(isinstance(v, dict) for v in values):
+            keys = list(values[0].keys())
+            if all(list(v.keys()) == keys for v in values):
+                if set(keys) == self._NODE_KEYS and self._write_nodes(out, values):
+                    return
+                out.append(self.TABLE)
+                self._write_varint(out, len(values))
+                self._write_varint(out, len(keys))
+                for key in keys:
+                    self._write_key(out, key)
+                for row in values:
+                    for key in keys:
+                        self._write(out, row[key])
+                return
+
+        out.append(self.LIST)
+        self._write_varint(out, len(values))
+        for item in values:
+            self._write(out, item)
+
+    def _write_nodes(self, out: bytearray, nodes: list[dict]) -> bool:
+        packed = bytearray()
+        for node in nodes:
+            node_id, ip = node["id"], node["ip"]
+            if not isinstance(node_id, int) or not 0 <= node_id < (1 << 160):
+                return False
+            try:
+                packed += node_id.to_bytes(20, "big") + socket.inet_aton(ip)
+            except (OSError, TypeError):
+                return False
+        out.append(self.NODE_LIST)
+        self._write_varint(out, len(nodes))
+        out += packed
+        return True
+
+    def _read(self, data: bytes, offset: int):
+        reader = self._readers[data[offset]]
+        if reader is None:
+            raise CodecError(f"Unknown tag {data[offset]}")
+        return reader(data, offset + 1)
+
+    def _read_int(self, data: bytes, offset: int) -> tuple[int, int]:
+        return self._INT.unpack_from(data, offset)[0], offset + 8
+
+    def _read_id(self, data: bytes, offset: int) -> tuple[int, int]:
+        return int.from_bytes(data[offset : offset + 20], "big"), offset + 20
+
+    def _read_bigint(self, data: bytes, offset: int) -> tuple[int, int]:
+        length, offset = self._read_varint(data, offset)
+        raw = data[offset : offset + length]
+        return int.from_bytes(raw, "big", signed=True), offset + length
+
+    def _read_float(self, data: bytes, offset: int) -> tuple[float, int]:
+        return self._FLOAT.unpack_from(data, offset)[0], offset + 8
+
+    def _read_bytes(self, data: bytes, offset: int) -> tuple[bytes, int]:
+        length, offset = self._read_varint(data, offset)
+        return data[offset : offset + length], offset + length
+
+    def _read_list(self, data: bytes, offset: int) -> tuple[list, int]:
+        count, offset = self._read_varint(data, offset)
+        items = []
+        read = self._read
+        for _ in range(count):
+            item, offset = read(data, offset)
+            items.append(item)
+        return items, offset
+
+    def _read_dict(self, data: bytes, offset: int) -> tuple[dict, int]:
+        count, offset = self._read_varint(data, offset)
+        dct = {}
+        for _ in range(count):
+            key, offset = self._read_key(data, offset)
+            dct[key], offset = self._read(data, offset)
+        return dct, offset
+
+    def _read_table(self, data: bytes, offset: int) -> tuple[list[dict], int]:
+        rows, offset = self._read_varint(data, offset)
+        columns, offset = self._read_varint(data, offset)
+        keys = []
+        for _ in range(columns):
+            key, offset = self._read_key(data, offset)
+            keys.append(key)
+        table = []
+        read = self._read
+        for _ in range(rows):
+            row = {}
+            for key in keys:
+                row[key], offset = read(data, offset)
+            table.append(row)
+        return table, offset
+
+    def _read_nodes(self, data: bytes, offset: int) -> tuple[list[dict], int]:
+        count, offset = self._read_varint(data, offset)
+        nodes = []
+        for _ in range(count):
+            node_id = int.from_bytes(data[offset : offset + 20], "big")
+            ip = socket.inet_ntoa(data[offset + 20 : offset + 24])
+            nodes.append({"id": node_id, "ip": ip})
+            offset += 24
+        if offset > len(data):
+            raise CodecError("Truncated node list")
+        return nodes, offset
+
+
+JSON_CODEC = JsonCodec()
+BINARY_CODEC = BinaryCodec()
+CODECS: dict[int, Codec] = {c.codec_id: c for c in (JSON_CODEC, BINARY_CODEC)}
+CODECS_BY_NAME: dict[str, Codec] = {c.name: c for c in CODECS.values()}
+# Order of preference offered when opening a connection, "json" is useful to
+# read the traffic while debugging
+PREFERRED_CODECS: list[str] = os.getenv("DHT_CODECS", "binary,json").split(",")
+
+
+def get_codec(flags: int) -> Codec:
+    codec = CODECS.get(flags & FLAG_CODEC_MASK)
+    if codec is None:
+        raise FrameError(f"Unknown codec in flags {flags}")
+    return codec
+
+
+def choose_codec(offered: list[str]) -> Codec:
+    for name in offered:
+        if name in CODECS_BY_NAME:
+            return CODECS_BY_NAME[name]
+    return JSON_CODEC
+
+
+def hello_offer() -> bytes:
+    """Body of the HELLO a client opens a connection with"""
+    offered: list[str] = PREFERRED_CODECS + (
+        [COMPRESSION] if COMPRESSION_ENABLED else []
+    )
+    return JSON_CODEC.dumps(offered)
+
+
+def answer_hello(body: bytes) -> tuple[Codec, bool, bytes]:
+    """
+    Codec and compression a server uses for a connection, and its HELLO
+    answer. Older peers never offer compression and get the bare codec name
+    they expect.
+    """
+    offered: list[str] = JSON_CODEC.loads(body)
+    codec: Codec = choose_codec(offered)
+    if COMPRESSION_ENABLED and COMPRESSION in offered:
+        return codec, True, JSON_CODEC.dumps([codec.name, COMPRESSION])
+    return codec, False, JSON_CODEC.dumps(codec.name)
+
+
+def parse_hello_answer(body: bytes) -> tuple[Codec, bool]:
+    answer = JSON_CODEC.loads(body)
+    if isinstance(answer, list):
+        name, compress = answer[0], COMPRESSION in answer[1:]
+    else:
+        name, compress = answer, False
+    return CODECS_BY_NAME.get(name, JSON_CODEC), compress
+
+
+def encode_message(
+    message: "Encodable",
+    codec: Codec,
+    compress: bool = False,
+    level: int = COMPRESSION_LEVEL,
+) -> tuple[bytes, int]:
+    """Body and flags of the frame carrying a request or a response"""
+    body: bytes = message.encode(codec)
+    if compress and len(body) >= COMPRESSION_THRESHOLD:
+        compressed: bytes = zlib.compress(body, level)
+        if len(compressed) < len(body):
+            return compressed, codec.codec_id | FLAG_COMPRESSED
+    return body, codec.codec_id
+
+
+def frame_payload(frame: "Frame") -> bytes:
+    if not frame.flags & FLAG_COMPRESSED:
+        return frame.body
+    inflater = zlib.decompressobj()
+    try:
+        # A tiny body must not inflate into more than a frame may carry
+        payload: bytes = inflater.decompress(frame.body, MAX_FRAME_SIZE)
+    except zlib.error as e:
+        raise FrameError(f"Corrupted compressed body in {frame}") from e
+    if inflater.unconsumed_tail or not inflater.eof:
+        raise FrameError(f"Compressed body in {frame} is too large or truncated")
+    return payload
 
 
 class Encodable(ABC):
 
     @abstractmethod
-    def encode(self) -> bytes:
+    def encode(self, codec: Codec = JSON_CODEC) -> bytes:
         pass
 
     @staticmethod
     @abstractmethod
-    def decode(data):
+    def decode(data, codec: Codec = JSON_CODEC):
         pass
 
 
 class RpcRequest(Encodable):
-    def __init__(self, sender_id: int, function: str, arguments: list):
+    def __init__(
+        self,
+        sender_id: int,
+        function: str,
+        arguments: list,
+        request_id: int = 0,
+        deadline: float | None = None,
+    ):
         self.sender_id: int = sender_id
         self.function: str = function
         self.arguments: list = arguments
+        # Travels in the frame header, it pairs responses with their requests
+        self.request_id: int = request_id
+        # Seconds the sender still waits for the answer, older peers omit it
+        self.deadline: float | None = deadline
+        self.received_at: float = time.monotonic()
 
-    def encode(self) -> bytes:
+    @property
+    def expired(self) -> bool:
+        """Whether the sender stopped waiting, counted from its arrival"""
+        return (
+            self.deadline is not None
+            and time.monotonic() - self.received_at >= self.deadline
+        )
+
+    def encode(self, codec: Codec = JSON_CODEC) -> bytes:
         data = {
             "id": self.sender_id,
             "function": self.function,
             "arguments": self.arguments,
         }
-        return json.dumps(data).encode()
+        if self.deadline is not None:
+            data["deadline"] = self.deadline
+        return codec.dumps(data)
 
     @staticmethod
-    def decode(data: bytes):
+    def decode(data: bytes, codec: Codec = JSON_CODEC):
         try:
-            json_data = json.loads(data.decode())
+            json_data = codec.loads(data)
+            if not isinstance(json_data, dict):
+                return None
+            deadline = json_data.get("deadline")
+            if (
+                isinstance(deadline, bool)
+                or not isinstance(deadline, (int, float))
+                or not math.isfinite(deadline)
+            ):
+                deadline = None
             request = RpcRequest(
                 sender_id=json_data["id"],
                 function=json_data["function"],
                 arguments=json_data["arguments"],
+                deadline=deadline,
             )
             return request
-        except (json.JSONDecodeError, KeyError):
+        except (ValueError, KeyError, TypeError):
             return None
 
     def __str__(self) -> str:
@@ -49,22 +516,23 @@ class RpcRequest(Encodable):
 
 
 class RpcResponse(Encodable):
-    def __init__(self, result):
+    def __init__(self, result, request_id: int = 0):
         self.result = result
+        self.request_id: int = request_id
 
-    def encode(self) -> bytes:
+    def encode(self, codec: Codec = JSON_CODEC) -> bytes:
         data = {"result": self.result}
-        return json.dumps(data).encode()
+        return codec.dumps(data)
 
     @staticmethod
-    def decode(data: bytes):
+    def decode(data: bytes, codec: Codec = JSON_CODEC):
         try:
-            json_data = json.loads(data.decode())
+            json_data = codec.loads(data)
             response = RpcResponse(
                 result=json_data["result"],
             )
             return response
-        except (json.JSONDecodeError, KeyError):
+        except (ValueError, KeyError, TypeError):
             return None
 
     def __str__(self):
@@ -72,3 +540,410 @@ class RpcResponse(Encodable):
 
     def __repr__(self):
         return self.__str__()
+
+
+class Frame:
+    def __init__(
+        self, message_type: MessageType, request_id: int, body: bytes, flags: int = 0
+    ):
+        self.message_type: MessageType = message_type
+        self.request_id: int = request_id
+        self.body: bytes = body
+        self.flags: int = flags
+
+    def encode(self) -> bytes:
+        return (
+            encode_header(
+                self.message_type, self.request_id, len(self.body), self.flags
+            )
+            + self.body
+        )
+
+    def __str__(self) -> str:
+        return f"Frame({self.message_type.name}, id: {self.request_id}, {len(self.body)} bytes)"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+
+def request_from_frame(frame: Frame) -> RpcRequest | None:
+    request = RpcRequest.decode(frame_payload(frame), get_codec(frame.flags))
+    if request:
+        request.request_id = frame.request_id
+    return request
+
+
+def response_from_frame(frame: Frame) -> RpcResponse | None:
+    if frame.message_type == MessageType.ERROR:
+        if frame.body == BUSY:
+            raise ServerBusyError(f"Request {frame.request_id} rejected, peer is busy")
+        raise FrameError(f"Request {frame.request_id} failed: {frame.body!r}")
+    response = RpcResponse.decode(frame_payload(frame), get_codec(frame.flags))
+    if response:
+        response.request_id = frame.request_id
+    return response
+
+
+def encode_header(
+    message_type: MessageType, request_id: int, length: int, flags: int = 0
+) -> bytes:
+    return FRAME_HEADER.pack(message_type, flags, request_id, length)
+
+
+def decode_header(header: bytes) -> tuple[MessageType, int, int, int]:
+    raw_type, flags, request_id, length = FRAME_HEADER.unpack(header)
+    try:
+        message_type = MessageType(raw_type)
+    except ValueError as e:
+        raise FrameError(f"Unknown message type {raw_type}") from e
+    if length > MAX_FRAME_SIZE:
+        raise FrameError(f"Frame of {length} bytes exceeds the maximum size")
+    return message_type, flags, request_id, length
+
+
+def recv_exactly(sock: socket.socket, size: int) -> bytes:
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:], size - received)
+        if n == 0:
+            raise ConnectionResetError("Connection closed in the middle of a frame")
+        received += n
+    return bytes(buffer)
+
+
+def read_frame(sock: socket.socket) -> Frame | None:
+    """Returns None when the peer closed the connection between frames"""
+    first = sock.recv(FRAME_HEADER.size)
+    if not first:
+        return None
+    header = first + recv_exactly(sock, FRAME_HEADER.size - len(first))
+    message_type, flags, request_id, length = decode_header(header)
+    body = recv_exactly(sock, length) if length else b""
+    return Frame(message_type, request_id, body, flags)
+
+
+def write_frame(
+    sock: socket.socket,
+    message_type: MessageType,
+    request_id: int,
+    body: bytes = b"",
+    flags: int = 0,
+) -> None:
+    if len(body) > MAX_FRAME_SIZE:
+        raise FrameError(f"Frame of {len(body)} bytes exceeds the maximum size")
+    sock.sendall(encode_header(message_type, request_id, len(body), flags) + body)
+
+
+def write_body(
+    sock: socket.socket,
+    request_id: int,
+    data: bytes | Iterable[bytes],
+    chunk_size: int = BODY_CHUNK_SIZE,
+) -> int:
+    """
+    Streams a body as DATA frames followed by an empty DATA_END frame, so the
+    receiver knows where it ends without waiting for a timeout
+    """
+    chunks = (
+        _split(data, chunk_size)
+        if isinstance(data, (bytes, bytearray, memoryview))
+        else data
+    )
+    sent = 0
+    for chunk in chunks:
+        if not chunk:
+            continue
+        sock.sendall(encode_header(MessageType.DATA, request_id, len(chunk)))
+        sock.sendall(chunk)
+        sent += len(chunk)
+    write_frame(sock, MessageType.DATA_END, request_id)
+    return sent
+
+
+def write_file_body(
+    sock: socket.socket,
+    path: str,
+    request_id: int,
+    chunk_size: int = FILE_CHUNK_SIZE,
+) -> int:
+    """
+    Streams a file as a body without loading it. Plain sockets let the kernel
+    copy it with sendfile, TLS ones reuse one buffer for large writes
+    """
+    sent = 0
+    with open(path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        if not isinstance(sock, ssl.SSLSocket):
+            while sent < size:
+                length = min(chunk_size, size - sent)
+                sock.sendall(encode_header(MessageType.DATA, request_id, length))
+                if sock.sendfile(file, sent, length) != length:
+                    raise ConnectionResetError("File truncated while sending it")
+                sent += length
+        else:
+            view = memoryview(bytearray(chunk_size))
+            while n := file.readinto(view):
+                sock.sendall(encode_header(MessageType.DATA, request_id, n))
+                sock.sendall(view[:n])
+                sent += n
+    write_frame(sock, MessageType.DATA_END, request_id)
+    return sent
+
+
+def iter_chunks(
+    data: bytes | None, path: str | None, first_chunk: int, chunk_size: int
+) -> Iterator[memoryview]:
+    """
+    Chunks of a payload from first_chunk on. File chunks share one buffer, so
+    each one is only valid until the next is read
+    """
+    if path is None:
+        view = memoryview(data or b"")
+        for offset in range(first_chunk * chunk_size, len(view), chunk_size):
+            yield view[offset : offset + chunk_size]
+        return
+    buffer = memoryview(bytearray(chunk_size))
+    with open(path, "rb") as file:
+        file.seek(first_chunk * chunk_size)
+        while n := file.readinto(buffer):
+            yield buffer[:n]
+
+
+def write_chunks(
+    sock: socket.socket,
+    request_id: int,
+    chunks: Iterable[memoryview],
+    first_chunk: int,
+) -> int:
+    sent = 0
+    for index, chunk in enumerate(chunks, first_chunk):
+        sock.sendall(
+            encode_header(MessageType.DATA, request_id, CHUNK_HEADER.size + len(chunk))
+            + CHUNK_HEADER.pack(index, zlib.crc32(chunk))
+        )
+        sock.sendall(chunk)
+        sent += len(chunk)
+    write_frame(sock, MessageType.DATA_END, request_id)
+    return sent
+
+
+def read_chunks(
+    sock: socket.socket,
+    request_id: int,
+    on_chunk: Callable[[int, memoryview], None],
+    chunk_size: int,
+) -> int:
+    """
+    Reads a chunked body, every chunk lands in the same buffer and is handed
+    to on_chunk with its index once its checksum matches
+    """
+    buffer = memoryview(bytearray(CHUNK_HEADER.size + chunk_size))
+    received = 0
+    while True:
+        length = _body_frame_length(recv_exactly(sock, FRAME_HEADER.size), request_id)
+        if length is None:
+            return received
+        if not CHUNK_HEADER.size < length <= len(buffer):
+            raise FrameError(f"Chunk frame of {length} bytes in body {request_id}")
+        view = buffer[:length]
+        read = 0
+        while read < length:
+            n = sock.recv_into(view[read:], length - read)
+            if not n:
+                raise ConnectionResetError("Connection closed in the middle of a body")
+            read += n
+        received += _check_chunk(view, on_chunk)
+
+
+def _check_chunk(
+    frame_body: memoryview, on_chunk: Callable[[int, memoryview], None]
+) -> int:
+    index, crc = CHUNK_HEADER.unpack_from(frame_body)
+    chunk = frame_body[CHUNK_HEADER.size :]
+    if zlib.crc32(chunk) != crc:
+        raise FrameError(f"Chunk {index} is corrupted")
+    on_chunk(index, chunk)
+    return len(chunk)
+
+
+def _body_frame_length(header: bytes, request_id: int) -> int | None:
+    """Returns the length of a DATA frame, or None for the DATA_END frame"""
+    message_type, _, frame_id, length = decode_header(header)
+    if frame_id != request_id or message_type not in (
+        MessageType.DATA,
+        MessageType.DATA_END,
+    ):
+        raise FrameError(
+            f"Unexpected frame {message_type} {frame_id} while reading body {request_id}"
+        )
+    return length if message_type == MessageType.DATA else None
+
+
+def read_body(
+    sock: socket.socket,
+    request_id: int,
+    sink: Callable[[memoryview], None],
+    chunk_size: int = BODY_CHUNK_SIZE,
+) -> int:
+    """
+    Reads a body into one reusable buffer and hands every chunk to sink, so
+    memory stays bounded whatever the size of the body
+    """
+    view = memoryview(bytearray(chunk_size))
+    received = 0
+    while True:
+        length = _body_frame_length(recv_exactly(sock, FRAME_HEADER.size), request_id)
+        if length is None:
+            return received
+        while length:
+            n = sock.recv_into(view, min(length, chunk_size))
+            if not n:
+                raise ConnectionResetError("Connection closed in the middle of a body")
+            sink(view[:n])
+            length -= n
+            received += n
+
+
+async def aread_frame(reader: asyncio.StreamReader) -> Frame | None:
+    """Returns None when the peer closed the connection between frames"""
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise ConnectionResetError("Connection closed in the middle of a frame") from e
+    message_type, flags, request_id, length = decode_header(header)
+    try:
+        body = await reader.readexactly(length) if length else b""
+    except asyncio.IncompleteReadError as e:
+        raise ConnectionResetError("Connection closed in the middle of a frame") from e
+    return Frame(message_type, request_id, body, flags)
+
+
+async def awrite_frame(
+    writer: asyncio.StreamWriter,
+    message_type: MessageType,
+    request_id: int,
+    body: bytes = b"",
+    flags: int = 0,
+) -> None:
+    if len(body) > MAX_FRAME_SIZE:
+        raise FrameError(f"Frame of {len(body)} bytes exceeds the maximum size")
+    # A single write keeps frames whole when several tasks share the writer
+    writer.write(encode_header(message_type, request_id, len(body), flags) + body)
+    await writer.drain()
+
+
+async def awrite_body(
+    writer: asyncio.StreamWriter,
+    request_id: int,
+    data: bytes,
+    chunk_size: int = BODY_CHUNK_SIZE,
+) -> int:
+    sent = 0
+    for chunk in _split(data, chunk_size):
+        writer.write(encode_header(MessageType.DATA, request_id, len(chunk)))
+        writer.write(chunk)
+        await writer.drain()
+        sent += len(chunk)
+    await awrite_frame(writer, MessageType.DATA_END, request_id)
+    return sent
+
+
+async def awrite_file_body(
+    writer: asyncio.StreamWriter,
+    path: str,
+    request_id: int,
+    chunk_size: int = FILE_CHUNK_SIZE,
+) -> int:
+    sent = 0
+    with open(path, "rb") as file:
+        # The transport keeps references to written chunks, so they can not
+        # share a buffer; disk reads stay off the event loop
+        while chunk := await asyncio.to_thread(file.read, chunk_size):
+            writer.write(encode_header(MessageType.DATA, request_id, len(chunk)))
+            writer.write(chunk)
+            await writer.drain()
+            sent += len(chunk)
+    await awrite_frame(writer, MessageType.DATA_END, request_id)
+    return sent
+
+
+async def awrite_chunks(
+    writer: asyncio.StreamWriter,
+    request_id: int,
+    chunks: Iterable[memoryview],
+    first_chunk: int,
+) -> int:
+    sent = 0
+    index = first_chunk
+    iterator = iter(chunks)
+    # Disk reads stay off the event loop
+    while (chunk := await asyncio.to_thread(next, iterator, None)) is not None:
+        # The transport keeps what it is given, so shared buffers are copied
+        writer.write(
+            encode_header(MessageType.DATA, request_id, CHUNK_HEADER.size + len(chunk))
+            + CHUNK_HEADER.pack(index, zlib.crc32(chunk))
+            + chunk
+        )
+        await writer.drain()
+        sent += len(chunk)
+        index += 1
+    await awrite_frame(writer, MessageType.DATA_END, request_id)
+    return sent
+
+
+async def aread_chunks(
+    reader: asyncio.StreamReader,
+    request_id: int,
+    on_chunk: Callable[[int, memoryview], None],
+    chunk_size: int,
+) -> int:
+    received = 0
+    try:
+        while True:
+            header = await reader.readexactly(FRAME_HEADER.size)
+            length = _body_frame_length(header, request_id)
+            if length is None:
+                return received
+            if not CHUNK_HEADER.size < length <= CHUNK_HEADER.size + chunk_size:
+                raise FrameError(f"Chunk frame of {length} bytes in body {request_id}")
+            received += _check_chunk(
+                memoryview(await reader.readexactly(length)), on_chunk
+            )
+    except asyncio.IncompleteReadError as e:
+        raise ConnectionResetError("Connection closed in the middle of a body") from e
+
+
+async def aread_body(
+    reader: asyncio.StreamReader,
+    request_id: int,
+    sink: Callable[[memoryview], None],
+    chunk_size: int = BODY_CHUNK_SIZE,
+) -> int:
+    received = 0
+    while True:
+        try:
+            header = await reader.readexactly(FRAME_HEADER.size)
+        except asyncio.IncompleteReadError as e:
+            raise ConnectionResetError(
+                "Connection closed in the middle of a body"
+            ) from e
+        length = _body_frame_length(header, request_id)
+        if length is None:
+            return received
+        while length:
+            chunk = await reader.read(min(length, chunk_size))
+            if not chunk:
+                raise ConnectionResetError("Connection closed in the middle of a body")
+            sink(memoryview(chunk))
+            length -= len(chunk)
+            received += len(chunk)
+
+
+def _split(data: bytes, chunk_size: int) -> Iterator[memoryview]:
+    view = memoryview(data)
+    for offset in range(0, len(view), chunk_size):
+        yield view[offset : offset + chunk_size]
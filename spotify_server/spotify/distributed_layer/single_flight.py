@@ -0,0 +1,59 @@
+import asyncio
+from collections.abc import Awaitable, Callable, Hashable
+from typing import TypeVar
+
+from .deadline import Deadline
+
+from ..logs import write_log
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """
+    Concurrent callers of the same operation share a single run of it. The
+    first caller starts it with its deadline, the others wait for its result
+    at most until their own deadline. Only used from the DHT event loop, so
+    it needs no lock.
+    """
+
+    def __init__(self):
+        self._running: dict[Hashable, asyncio.Task] = {}
+        self.started: int = 0
+        self.joined: int = 0
+
+    async def run(
+        self,
+        key: Hashable,
+        operation: Callable[[], Awaitable[T]],
+        deadline: Deadline | None = None,
+    ) -> T | None:
+        """The result of the operation, None when the deadline passed first"""
+        task: asyncio.Task | None = self._running.get(key)
+        if task is None:
+            task = asyncio.ensure_future(operation())
+            self._running[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+            self.started += 1
+            # The operation itself stops at the deadline of its first caller
+            return await asyncio.shield(task)
+
+        self.joined += 1
+        write_log(f"Joining the running {key}", 1)
+        if deadline is None:
+            return await asyncio.shield(task)
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), deadline.remaining())
+        except asyncio.TimeoutError:
+            return None
+
+    def _forget(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._running.get(key) is task:
+            del self._running[key]
+
+    def to_dict(self) -> dict:
+        return {
+            "running": len(self._running),
+            "started": self.started,
+            "joined": self.joined,
+        }
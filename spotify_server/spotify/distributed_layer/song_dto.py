@@ -1,5 +1,18 @@
+import os
+from hashlib import sha256
+
 from ..logs import write_log
 
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_sha256(path: str) -> str:
+    digest = sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
 
 class SongKey:
 
@@ -29,16 +42,27 @@ class SongKey:
 
 
 class ImageSongDto:
-    def __init__(self, file_extension: str, image_data: bytes):
+    def __init__(
+        self,
+        file_extension: str,
+        image_data: bytes,
+        image_path: str | None = None,
+        image_sha256: str | None = None,
+    ):
         self.file_extension: str = file_extension
         self.image_data: bytes | None = image_data
+        # Set instead of image_data when the image lives in a file
+        self.image_path: str | None = image_path
+        self.image_sha256: str | None = image_sha256
 
     @staticmethod
     def from_dict(data: dict):
         try:
             return ImageSongDto(
                 data["file_extension"],
-                data["image_data"] if data["image_data"] else None,
+                data["image_data"] if data.get("image_data") else None,
+                data.get("image_path"),
+                data.get("image_sha256"),
             )
         except KeyError:
             write_log(f"Error al crear el objeto ImageSongDto with {data}", 3)
@@ -46,6 +70,22 @@ class ImageSongDto:
         except Exception as e:
             write_log(f"Error al crear imagenSongDto from dict {e}", 3)
 
+    @property
+    def image_size(self) -> int:
+        if self.image_path:
+            return os.path.getsize(self.image_path)
+        return len(self.image_data or b"")
+
+    @property
+    def image_hash(self) -> str:
+        if not self.image_sha256:
+            self.image_sha256 = (
+                file_sha256(self.image_path)
+                if self.image_path
+                else sha256(self.image_data or b"").hexdigest()
+            )
+        return self.image_sha256
+
     def to_dict(self) -> dict:
         return {
             "file_extension": self.file_extension,
@@ -71,6 +111,8 @@ class SongDto:
         size: int,
         image: ImageSongDto,
         audio_data: bytes,
+        audio_path: str | None = None,
+        audio_sha256: str | None = None,
     ):
         self.title: str = title
         self.artist: str = artist
@@ -80,6 +122,9 @@ class SongDto:
         self.size: int = size
         self.image: ImageSongDto | None = image
         self.audio_data: bytes | None = audio_data
+        # Set instead of audio_data when the audio lives in a file
+        self.audio_path: str | None = audio_path
+        self.audio_sha256: str | None = audio_sha256
 
     @staticmethod
     def from_dict(data: dict):
@@ -92,7 +137,9 @@ class SongDto:
                 duration=data["duration"],
                 size=data["size"],
                 image=ImageSongDto.from_dict(data["image"]),
-                audio_data=data["audio_data"] if data["audio_data"] else None,
+                audio_data=data["audio_data"] if data.get("audio_data") else None,
+                audio_path=data.get("audio_path"),
+                audio_sha256=data.get("audio_sha256"),
             )
             return song
         except Exception as e:
@@ -114,6 +161,22 @@ class SongDto:
     def key(self) -> SongKey:
         return SongKey(self.title, self.artist)
 
+    @property
+    def audio_size(self) -> int:
+        if self.audio_path:
+            return os.path.getsize(self.audio_path)
+        return len(self.audio_data or b"")
+
+    @property
+    def audio_hash(self) -> str:
+        if not self.audio_sha256:
+            self.audio_sha256 = (
+                file_sha256(self.audio_path)
+                if self.audio_path
+                else sha256(self.audio_data or b"").hexdigest()
+            )
+        return self.audio_sha256
+
     def __str__(self):
         dct = self.to_dict()
         dct["audio_data"] = "a lot of bytes"
@@ -0,0 +1,305 @@
+import os
+import tempfile
+import threading
+import time
+from hashlib import sha256
+
+from .rpc_message import FrameError
+from .song_dto import HASH_CHUNK_SIZE
+
+from ..logs import write_log
+
+# Payloads up to this size go to a preallocated buffer, bigger ones are
+# spooled straight to a temporary file
+SPOOL_MEMORY_LIMIT = 1024 * 1024
+# Interrupted chunked transfers are kept here until they are resumed
+PARTIAL_TRANSFERS_DIR = os.getenv(
+    "DHT_PARTIAL_TRANSFERS_DIR",
+    os.path.join(tempfile.gettempdir(), "spotify-partial-transfers"),
+)
+# Partial transfers nobody resumed for this long are deleted
+PARTIAL_TRANSFER_TTL = 24 * 60 * 60
+MIN_TRANSFER_CHUNK_SIZE = 64 * 1024
+MAX_TRANSFER_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+class IncomingPayload:
+    """
+    Receives one payload of a SAVE_KEY transfer. Every chunk is hashed as it
+    arrives, so the digest is checked right after the last declared byte.
+    """
+
+    def __init__(self, declared_size: int | None, expected_hash: str):
+        self.declared_size: int | None = declared_size
+        self.expected_hash: str = expected_hash
+        self.received: int = 0
+        self.verified: bool | None = None
+        self.path: str | None = None
+        self._hasher = sha256()
+        self._buffer: bytearray | None = None
+        self._file = None
+        self._open()
+
+    def _open(self) -> None:
+        if self.declared_size is not None and self.declared_size <= SPOOL_MEMORY_LIMIT:
+            self._buffer = bytearray(self.declared_size)
+        else:
+            fd, self.path = tempfile.mkstemp(prefix="incoming-song-")
+            self._file = os.fdopen(fd, "wb")
+
+    def feed(self, chunk: memoryview) -> None:
+        end: int = self.received + len(chunk)
+        if self.declared_size is not None and end > self.declared_size:
+            raise FrameError(
+                f"Received more than the {self.declared_size} declared bytes"
+            )
+        self._hasher.update(chunk)
+        if self._file:
+            self._file.write(chunk)
+        else:
+            self._buffer[self.received : end] = chunk
+        self.received = end
+        if end == self.declared_size:
+            self._verify()
+
+    def finish(self) -> bool:
+        if self._file:
+            self._file.close()
+            self._file = None
+        if self.verified is None:
+            self._verify()
+        return self.verified
+
+    def _verify(self) -> None:
+        complete: bool = (
+            self.declared_size is None or self.received == self.declared_size
+        )
+        self.verified = complete and self._hasher.hexdigest() == self.expected_hash
+        write_log(
+            f"Payload of {self.received} bytes verified: {self.verified}",
+            1,
+        )
+
+    @property
+    def data(self) -> bytearray | None:
+        return self._buffer
+
+    def discard(self) -> None:
+        if self._file:
+            self._file.close()
+            self._file = None
+        if self.path:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                # Already moved into the media storage
+                pass
+            self.path = None
+        self._buffer = None
+
+
+class ResumablePayload(IncomingPayload):
+    """
+    Payload of a chunked transfer, written to the partial transfer store. The
+    whole chunks of an interrupted attempt are kept and the next attempt
+    resumes right after them.
+
+    The digest covers the whole payload, so the kept chunks are hashed again,
+    but in the background: the resume points are answered right away and the
+    new chunks are hashed inline once the hashing caught up with them.
+    """
+
+    def __init__(
+        self, declared_size: int, expected_hash: str, path: str, chunk_size: int
+    ):
+        self.chunk_size: int = chunk_size
+        self._partial_path: str = path
+        self._finished: bool = False
+        # Bytes of the file the digest covers so far
+        self._hashed: int = 0
+        self._hashing: threading.Thread | None = None
+        self._hashing_error: OSError | None = None
+        self._closed: bool = False
+        self._hash_lock = threading.Lock()
+        super().__init__(declared_size, expected_hash)
+
+    def _open(self) -> None:
+        self.path = self._partial_path
+        self._file = open(self.path, "a+b")
+        size: int = self._file.seek(0, os.SEEK_END)
+        kept: int = (
+            self.declared_size
+            if size >= self.declared_size
+            else size - size % self.chunk_size
+        )
+        self._file.truncate(kept)
+        self.received = kept
+        if kept:
+            write_log(f"Resuming {self.path} after {kept} bytes", 1)
+            self._hashing = threading.Thread(target=self._hash_kept, daemon=True)
+            self._hashing.start()
+
+    def _hash_kept(self) -> None:
+        """Hashes the file until it reaches the chunks fed since it was opened"""
+        try:
+            with open(self.path, "rb") as file:
+                while not self._closed:
+                    with self._hash_lock:
+                        end: int = self.received
+                        if self._hashed == end:
+                            return
+                    data: bytes = file.read(min(HASH_CHUNK_SIZE, end - self._hashed))
+                    if not data:
+                        raise OSError(f"{self.path} is shorter than {end} bytes")
+                    with self._hash_lock:
+                        self._hasher.update(data)
+                        self._hashed += len(data)
+        except OSError as e:
+            write_log(f"Error hashing the kept chunks of {self.path}: {e}", 3)
+            self._hashing_error = e
+
+    def feed(self, chunk: memoryview) -> None:
+        end: int = self.received + len(chunk)
+        if end > self.declared_size:
+            raise FrameError(
+                f"Received more than the {self.declared_size} declared bytes"
+            )
+        self._file.write(chunk)
+        with self._hash_lock:
+            if self._hashed == self.received:
+                self._hasher.update(chunk)
+                self._hashed = end
+            else:
+                # Still hashing the kept chunks, it reads this one from the file
+                self._file.flush()
+            self.received = end
+        if end == self.declared_size:
+            self._verify()
+
+    def _verify(self) -> None:
+        if self._hashing is not None:
+            self._hashing.join()
+        if self._hashing_error is not None:
+            self.verified = False
+            return
+        super()._verify()
+
+    @property
+    def next_chunk(self) -> int:
+        return -(-self.received // self.chunk_size)
+
+    def feed_chunk(self, index: int, chunk: memoryview) -> None:
+        if index != self.next_chunk:
+            raise FrameError(f"Expected chunk {self.next_chunk} but got {index}")
+        if (
+            len(chunk) != self.chunk_size
+            and self.received + len(chunk) != self.declared_size
+        ):
+            raise FrameError(f"Chunk {index} has {len(chunk)} bytes")
+        self.feed(chunk)
+
+    def finish(self) -> bool:
+        self._finished = True
+        return super().finish()
+
+    def discard(self) -> None:
+        self._closed = True
+        if not self._finished and self.verified is not False:
+            # Interrupted, the chunks received so far wait for the next attempt
+            if self._file:
+                self._file.close()
+                self._file = None
+            return
+        super().discard()
+
+
+class IncomingTransfer:
+    """The image and the audio of one SAVE_KEY transfer"""
+
+    def __init__(
+        self,
+        image: IncomingPayload,
+        audio: IncomingPayload,
+        chunk_size: int | None = None,
+        on_close=None,
+    ):
+        self.image: IncomingPayload = image
+        self.audio: IncomingPayload = audio
+        # Set when the transfer is chunked and can be resumed
+        self.chunk_size: int | None = chunk_size
+        self._on_close = on_close
+
+    @property
+    def handshake(self):
+        """First answer to the sender, where to resume if the transfer is chunked"""
+        if self.chunk_size is None:
+            return "Ok"
+        return {"image": self.image.next_chunk, "audio": self.audio.next_chunk}
+
+    def close(self) -> None:
+        self.image.discard()
+        self.audio.discard()
+        if self._on_close:
+            self._on_close()
+
+
+class PartialTransferStore:
+    """Partial chunked transfers, by the content hashes of the song"""
+
+    def __init__(self, root: str = PARTIAL_TRANSFERS_DIR):
+        self.root: str = root
+        self._active: set[str] = set()
+        self._lock = threading.Lock()
+
+    def open(
+        self,
+        image_hash: str,
+        audio_hash: str,
+        image_size: int,
+        audio_size: int,
+        chunk_size: int,
+    ) -> IncomingTransfer | None:
+        """None when the same song is already being received"""
+        key: str = sha256(
+            f"{image_hash}:{audio_hash}:{chunk_size}".encode()
+        ).hexdigest()
+        with self._lock:
+            if key in self._active:
+                return None
+            self._active.add(key)
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            self.prune()
+            return IncomingTransfer(
+                ResumablePayload(
+                    image_size,
+                    image_hash,
+                    os.path.join(self.root, f"{key}.image.part"),
+                    chunk_size,
+                ),
+                ResumablePayload(
+                    audio_size,
+                    audio_hash,
+                    os.path.join(self.root, f"{key}.audio.part"),
+                    chunk_size,
+                ),
+                chunk_size,
+                lambda: self.release(key),
+            )
+        except Exception:
+            self.release(key)
+            raise
+
+    def release(self, key: str) -> None:
+        with self._lock:
+            self._active.discard(key)
+
+    def prune(self) -> None:
+        limit: float = time.time() - PARTIAL_TRANSFER_TTL
+        for entry in os.scandir(self.root):
+            if entry.name.endswith(".part") and entry.stat().st_mtime < limit:
+                write_log(f"Deleting abandoned partial transfer {entry.name}", 1)
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.3 on 2026-10-18 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spotify', '0004_song_size'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='song',
+            name='audio_sha256',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='song',
+            name='image_sha256',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
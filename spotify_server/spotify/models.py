@@ -12,6 +12,9 @@ class Song(models.Model):
     genre = models.CharField(max_length=255, null=True)
     image = models.FileField(upload_to="song_images/", null=True)
     audio = models.FileField(upload_to="songs/")
+    # Content hashes, filled on store or lazily the first time a song is replicated
+    audio_sha256 = models.CharField(max_length=64, blank=True, default="")
+    image_sha256 = models.CharField(max_length=64, blank=True, default="")
 
     def to_dict_metadata(self) -> dict:
         return {
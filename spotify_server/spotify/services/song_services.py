@@ -11,12 +11,28 @@ from django.conf import settings
 
 
 from ..models import Song
-from ..distributed_layer.song_dto import SongKey, SongDto
+from ..distributed_layer.song_dto import ImageSongDto, SongKey, SongDto, file_sha256
 from ..logs import write_log
 
 # pylint: disable=no-member
 
 
+class ReceivedFile(File):
+    """
+    A payload that a peer already spooled to disk, the storage moves it into
+    MEDIA_ROOT instead of copying it again
+    """
+
+    def temporary_file_path(self) -> str:
+        return self.file.name
+
+
+def _song_file(data: bytes | None, path: str | None, name: str) -> File:
+    if path:
+        return ReceivedFile(open(path, "rb"), name=name)
+    return File(io.BytesIO(data or b""), name=name)
+
+
 class SongServices:
     """"""
 
@@ -26,10 +42,20 @@ class SongServices:
         return Song.objects.filter(title=title, artist=artist).first()
 
     @staticmethod
-    def exists_song(song_key: SongKey) -> bool:
-        """"""
+    def exists_song(song_key: SongKey, audio_sha256: str | None = None) -> bool:
+        """With a hash, only a song with that same audio counts"""
         title, artist = song_key.key
-        return Song.objects.filter(title=title, artist=artist).exists()
+        songs: BaseManager[Song] = Song.objects.filter(title=title, artist=artist)
+        if audio_sha256 is None:
+            return songs.exists()
+        song: Song | None = songs.first()
+        if song is None:
+            return False
+        if not song.audio_sha256:
+            # Older rows were stored before hashes were kept
+            song.audio_sha256 = file_sha256(song.audio.path)
+            song.save(update_fields=["audio_sha256"])
+        return song.audio_sha256 == audio_sha256
 
     @staticmethod
     def get_all_songs_metadata() -> BaseManager[Song]:
@@ -58,14 +84,17 @@ class SongServices:
         """"""
         try:
             image: File | None = (
-                File(
-                    io.BytesIO(song.image.image_data),
-                    name=str(song.key) + "img." + song.image.file_extension,
+                _song_file(
+                    song.image.image_data,
+                    song.image.image_path,
+                    str(song.key) + "img." + song.image.file_extension,
                 )
                 if song.image
                 else None
             )
-            audio: File = File(io.BytesIO(song.audio_data), name=str(song.key) + ".mp3")
+            audio: File = _song_file(
+                song.audio_data, song.audio_path, str(song.key) + ".mp3"
+            )
 
             created_song: Song = Song(
                 title=song.title,
@@ -76,9 +105,16 @@ class SongServices:
                 genre=song.genre,
                 image=image,
                 audio=audio,
+                audio_sha256=song.audio_hash,
+                image_sha256=song.image.image_hash if song.image else "",
             )
 
-            created_song.save()
+            try:
+                created_song.save()
+            finally:
+                audio.close()
+                if image:
+                    image.close()
 
             return created_song
 
@@ -87,6 +123,44 @@ class SongServices:
             print(f"Error al guardar la cancion {e}")
             return None
 
+    @staticmethod
+    def song_source(song: Song) -> SongDto:
+        """
+        A SongDto backed by the stored files, so replicating it never loads the
+        song in memory. Hashes missing from older rows are computed once here
+        """
+        missing: list[str] = []
+        if not song.audio_sha256:
+            song.audio_sha256 = file_sha256(song.audio.path)
+            missing.append("audio_sha256")
+        if song.image and not song.image_sha256:
+            song.image_sha256 = file_sha256(song.image.path)
+            missing.append("image_sha256")
+        if missing:
+            song.save(update_fields=missing)
+
+        return SongDto(
+            title=song.title,
+            artist=song.artist,
+            album=song.album,
+            genre=song.genre if song.genre else "unknown",
+            duration=song.duration,
+            size=song.size,
+            image=(
+                ImageSongDto(
+                    song.image.name.split(".")[-1],
+                    None,
+                    song.image.path,
+                    song.image_sha256,
+                )
+                if song.image
+                else ImageSongDto("", b"")
+            ),
+            audio_data=None,
+            audio_path=song.audio.path,
+            audio_sha256=song.audio_sha256,
+        )
+
     @staticmethod
     def stream_song(song_key: SongKey, rang: tuple[int, int] = None):
         """"""
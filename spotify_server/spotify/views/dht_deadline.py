@@ -0,0 +1,13 @@
+from ..distributed_layer.deadline import DEFAULT_REQUEST_DEADLINE, Deadline
+
+
+class DhtDeadlineMixin:
+    """
+    Views that query the DHT answer within a deadline. Endpoints can set
+    another one with dht_deadline, or pass it to as_view() in the urls.
+    """
+
+    dht_deadline: float = DEFAULT_REQUEST_DEADLINE
+
+    def request_deadline(self) -> Deadline:
+        return Deadline(self.dht_deadline)
@@ -4,9 +4,10 @@ from rest_framework.request import Request
 from rest_framework import status
 from ..distributed_layer.distributed_interface import DistributedInterface
 from ..distributed_layer.song_dto import SongKey
+from .dht_deadline import DhtDeadlineMixin
 
 
-class FindStreamersView(APIView):
+class FindStreamersView(DhtDeadlineMixin, APIView):
     def get(self, request: Request, __=None) -> Response:
         song_id: str | None = request.query_params.get("song_id")
         if not song_id:
@@ -25,7 +26,9 @@ class FindStreamersView(APIView):
             )
 
         distributed_interface = DistributedInterface()
-        streamers, active_nodes = distributed_interface.search_song_streamers(song_key)
+        streamers, active_nodes = distributed_interface.search_song_streamers(
+            song_key, self.request_deadline()
+        )
 
         return Response(
             {
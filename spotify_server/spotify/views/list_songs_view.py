@@ -7,9 +7,10 @@ from rest_framework import status
 
 from ..logs import write_log
 from ..distributed_layer.distributed_interface import DistributedInterface
+from .dht_deadline import DhtDeadlineMixin
 
 
-class ListSongsMetadataView(APIView):
+class ListSongsMetadataView(DhtDeadlineMixin, APIView):
     """
     ListSongsMetadataView is a Django Rest Framework APIView that handles GET requests to retrieve metadata for all songs.
 
@@ -33,7 +34,9 @@ class ListSongsMetadataView(APIView):
         i = time.time()
         write_log("Getting all", 2)
         distributed_interface = DistributedInterface()
-        result, active_nodes = distributed_interface.get_all_songs()
+        result, active_nodes = distributed_interface.get_all_songs(
+            self.request_deadline()
+        )
 
         return Response(
             {
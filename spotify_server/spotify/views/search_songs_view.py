@@ -9,9 +9,10 @@ from rest_framework import status
 from rest_framework.request import Request
 
 from ..distributed_layer.distributed_interface import DistributedInterface
+from .dht_deadline import DhtDeadlineMixin
 
 
-class SearchSongsView(APIView):
+class SearchSongsView(DhtDeadlineMixin, APIView):
     def get(self, request: Request, _=None) -> Response:
 
         search_by: str | None = request.query_params.get("searchBy")
@@ -27,7 +28,9 @@ class SearchSongsView(APIView):
 
         distributed_interface = DistributedInterface()
 
-        songs, active_nodes = distributed_interface.search_songs_by(search_by, query)
+        songs, active_nodes = distributed_interface.search_songs_by(
+            search_by, query, self.request_deadline()
+        )
         result = [n.to_dict() for n in songs]
 
         return Response(
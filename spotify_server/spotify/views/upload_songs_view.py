@@ -9,9 +9,10 @@ from ..decoders.mp3_decoder import Mp3Decoder
 from ..distributed_layer.distributed_interface import DistributedInterface
 from ..distributed_layer.distributed_interface import SongDto
 from ..logs import write_log
+from .dht_deadline import DhtDeadlineMixin
 
 
-class UploadSongView(APIView):
+class UploadSongView(DhtDeadlineMixin, APIView):
     def post(self, request: Request, _=None) -> Response:
         """"""
         try:
@@ -25,7 +26,9 @@ class UploadSongView(APIView):
                 if song_dto:
                     distributed_interface = DistributedInterface()
                     write_log("calling kademlia", 2)
-                    succes, active_nodes = distributed_interface.store_song(song_dto)
+                    succes, active_nodes = distributed_interface.store_song(
+                        song_dto, self.request_deadline()
+                    )
                     if succes:
                         return Response(
                             {